@@ -1,3 +1,3 @@
-from .seed_to_voxel_analysis import (
+from ..utils.cohort import (
     get_subjs, get_group
-)
\ No newline at end of file
+)
@@ -0,0 +1,116 @@
+# Parcel-level functional connectivity matrices (connectomes), inputs of the Network Based Statistics
+# Author: Sebastien Naze
+# QIMR Berghofer 2021-2022
+#
+# Parcel timeseries of all labels of an atlas are extracted in one pass with the sparse
+# (parcels x voxels) projection of the atlas (see parcellation.py), built once per atlas and
+# image grid, instead of fitting a NiftiLabelsMasker per image. Connectomes are written per
+# subject/session in HDF5 files at the location read by compute_nbs (seed_to_voxel_analysis.py).
+
+import argparse
+import itertools
+from joblib import Parallel, delayed
+import nibabel as nib
+import numpy as np
+import os
+
+from OCD_clinical_trial.functional.parcellation import get_atlas_projection, parcel_means
+from OCD_clinical_trial.utils import profiling
+from OCD_clinical_trial.utils.config import deriv_dir, proj_dir
+from OCD_clinical_trial.utils.cohort import get_subjs
+
+# atlas names used in connectome file names
+atlas_fnames = {'schaefer100_tianS1': 'Schaefer2018_100_17+Tian_S1',
+                'schaefer200_tianS2': 'Schaefer2018_200_17+Tian_S2',
+                'schaefer400_tianS4': 'Schaefer2018_400_17+Tian_S4'}
+
+
+def get_fc_fpath(subj, ses, atlas, desc='detrend_filtered_scrub_gsr', kind='corr', fc_deriv_dir=None):
+    """ path of a subject's connectome, e.g. <deriv>/post-fmriprep-fix/<subj>/<ses>/fc/<subj>_<ses>_task-rest_atlas-<atlas>_desc-corr-<desc>.h5 """
+    if fc_deriv_dir is None:
+        fc_deriv_dir = deriv_dir
+    fname = '{}_{}_task-rest_atlas-{}_desc-{}-{}.h5'.format(subj, ses, atlas_fnames.get(atlas, atlas), kind, desc)
+    return os.path.join(fc_deriv_dir, 'post-fmriprep-fix', subj, ses, 'fc', fname)
+
+
+def connectivity_matrix(ts, kind='corr', fisher_z=False):
+    """ connectivity matrix of (time x parcels) timeseries
+        kind: 'corr' (Pearson correlation) or 'pcorr' (partial correlation from Ledoit-Wolf shrunk precision)
+        fisher_z: Fisher z-transform (arctanh) of the coefficients, diagonal set to 0
+    """
+    valid = ~np.isnan(ts).any(axis=0) & (ts.std(axis=0)>0)
+    X = ts[:,valid]
+    if kind=='corr':
+        fc_valid = np.corrcoef(X.T)
+    elif kind=='pcorr':
+        from sklearn.covariance import LedoitWolf
+        prec = LedoitWolf().fit((X - X.mean(axis=0))/X.std(axis=0)).precision_
+        d = 1./np.sqrt(np.diag(prec))
+        fc_valid = -prec*np.outer(d,d)
+        np.fill_diagonal(fc_valid, 1.)
+    else:
+        raise ValueError("Unknown connectivity kind {}, choose 'corr' or 'pcorr'".format(kind))
+    fc = np.full((ts.shape[1], ts.shape[1]), np.nan)
+    fc[np.ix_(valid,valid)] = fc_valid
+    if fisher_z:
+        np.fill_diagonal(fc, 0.)
+        fc = np.arctanh(fc)
+    return fc
+
+
+@profiling.profiled(verbose=True)
+def build_connectomes(subj, ses, args):
+    """ extract parcel timeseries once per atlas and write connectomes of a subject/session to HDF5 """
+    import h5py
+
+    img_space = 'MNI152NLin2009cAsym'
+    bold_file = os.path.join(deriv_dir, 'post-fmriprep-fix', subj, ses, 'func', \
+                             subj+'_'+ses+'_task-rest_space-'+img_space+'_desc-'+args.metric+'.nii.gz')
+    if not os.path.exists(bold_file):
+        print("{} {} bold file not found, skip".format(subj, ses))
+        return
+    with profiling.stage('load'):
+        bold_img = nib.load(bold_file)
+        bold_data = np.asarray(bold_img.dataobj).reshape(-1, bold_img.shape[-1])
+    for atlas in args.atlases:
+        with profiling.stage('parcellation', atlas=atlas):
+            proj = get_atlas_projection(atlas, bold_img)
+            ts = parcel_means(proj, bold_data).T
+        with profiling.stage('connectivity', atlas=atlas):
+            fc = connectivity_matrix(ts, kind=args.kind, fisher_z=args.fisher_z)
+
+        fpath = get_fc_fpath(subj, ses, atlas, desc=args.desc, kind=args.kind+('Z' if args.fisher_z else ''), fc_deriv_dir=args.fc_deriv_dir)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with h5py.File(fpath+'.tmp', 'w') as f:
+            f.create_dataset('fc', data=fc)
+            if args.save_ts:
+                f.create_dataset('ts', data=ts.astype(np.float32), compression='gzip')
+            f.create_dataset('node_ids', data=proj['node_ids'])
+            f.attrs['atlas'] = atlas
+            f.attrs['bold_file'] = bold_file
+        os.replace(fpath+'.tmp', fpath)
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subj', default=None, action='store', help='to process a single subject, give subject ID (default: process all subjects)')
+    parser.add_argument('--atlases', default=['schaefer400_tianS4'], nargs='+', action='store', help='atlases (keys of atlas_config.json), e.g. schaefer100_tianS1 schaefer400_tianS4')
+    parser.add_argument('--metric', default='detrend_gsr_filtered_scrubFD05', type=str, action='store', help='denoised BOLD (desc) used as input')
+    parser.add_argument('--desc', default='detrend_filtered_scrub_gsr', type=str, action='store', help='description of the denoising in output file names')
+    parser.add_argument('--kind', default='corr', type=str, action='store', help="'corr' (Pearson) or 'pcorr' (Ledoit-Wolf partial correlation)")
+    parser.add_argument('--fisher_z', default=False, action='store_true', help='Fisher z-transform connectivity coefficients')
+    parser.add_argument('--save_ts', default=False, action='store_true', help='also save parcel timeseries in HDF5 files')
+    parser.add_argument('--fc_deriv_dir', default=None, action='store', help='derivatives folder of outputs (default: project derivatives)')
+    parser.add_argument('--n_jobs', type=int, default=10, action='store', help="number of parallel processes launched")
+    parser.add_argument('--profile_log', type=str, default=None, action='store', help="JSONL log of stage timings and memory (default: <proj_dir>/postprocessing/profiling.jsonl, 'None' to keep records in memory)")
+    args = parser.parse_args()
+
+    if args.profile_log is None:
+        args.profile_log = os.path.join(proj_dir, 'postprocessing', 'profiling.jsonl')
+    profiling.configure(None if args.profile_log=='None' else args.profile_log)
+
+    subjs = get_subjs(args)
+    seses = ['ses-pre', 'ses-post']
+    Parallel(n_jobs=args.n_jobs)(delayed(build_connectomes)(subj, ses, args) for subj,ses in itertools.product(subjs, seses))
+    profiling.print_summary()
@@ -0,0 +1,94 @@
+# Sliding-window (dynamic) seed-to-voxel functional connectivity
+# Author: Sebastien Naze
+# QIMR Berghofer 2021-2022
+#
+# Windowed Pearson correlations are obtained from running sums (sum x, sum x^2, sum y, sum y^2,
+# sum xy) updated at each step by adding the samples entering the window and removing those
+# leaving it, i.e. O(step) work per voxel instead of O(window). Sums are recomputed exactly every
+# `refresh` windows to bound the accumulation of rounding errors. Windows are produced in chunks,
+# which are written to HDF5 as they come, so that the full (windows x seeds x voxels) array
+# never needs to be held in memory.
+
+import os
+
+import numpy as np
+
+
+def get_window_sums(X, Y):
+    """ sums of a window of seed timeseries X (time x seeds) and voxels timeseries Y (time x voxels) """
+    return [X.sum(axis=0), (X**2).sum(axis=0), Y.sum(axis=0), (Y**2).sum(axis=0), X.T @ Y]
+
+
+def sums_to_corr(sums, n):
+    """ Pearson correlations (seeds x voxels) of a window of n samples from its running sums """
+    Sx, Sxx, Sy, Syy, Sxy = sums
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (n*Sxy - np.outer(Sx, Sy)) / np.sqrt(np.outer(n*Sxx - Sx**2, n*Syy - Sy**2))
+
+
+def sliding_window_corr(X, Y, window, step=1, chunk_size=64, refresh=256):
+    """ Generator of sliding-window correlations between seeds and voxels
+        inputs:
+            X: (time x seeds) seed timeseries
+            Y: (time x voxels) voxels (or VOI) timeseries
+            window: window length (samples)
+            step: shift between consecutive windows (samples)
+            chunk_size: number of windows per yielded chunk
+            refresh: sums are recomputed from scratch every `refresh` windows
+        yields:
+            starts: (windows,) first sample of each window of the chunk
+            r: (windows x seeds x voxels) float32 correlations
+    """
+    X, Y = np.asarray(X, dtype=float), np.asarray(Y, dtype=float)
+    if X.ndim==1:
+        X = X[:,np.newaxis]
+    starts = np.arange(0, X.shape[0]-window+1, step)
+    for c in range(0, len(starts), chunk_size):
+        chunk = starts[c:c+chunk_size]
+        r = np.empty((len(chunk), X.shape[1], Y.shape[1]), dtype=np.float32)
+        for j,start in enumerate(chunk):
+            i = c+j
+            if (i % refresh == 0) or (step >= window):
+                sums = get_window_sums(X[start:start+window], Y[start:start+window])
+            else:
+                new, old = slice(start+window-step, start+window), slice(start-step, start)
+                for s,add,rem in zip(sums, get_window_sums(X[new], Y[new]), get_window_sums(X[old], Y[old])):
+                    s += add - rem
+            r[j] = sums_to_corr(sums, window)
+        yield chunk, r
+
+
+def write_dynamic_fc(fpath, X, Y, window, step=1, seeds=None, t_r=0.81, mask_img=None, chunk_size=64, max_chunk_voxels=2**18):
+    """ compute sliding-window correlations and write them to a chunked HDF5 file
+        datasets:
+            dfc: (windows x seeds x voxels) float32, in HDF5 chunks of one window, one seed and at most
+                 max_chunk_voxels voxels (1MB)
+            window_starts, window_centers_s: start sample and center time (s) of each window
+            mask, affine: (optional) brain mask and affine to map voxels back to a 4D image
+    """
+    import h5py
+
+    n_windows = len(range(0, X.shape[0]-window+1, step))
+    if n_windows==0:
+        raise ValueError("Timeseries of {} samples are shorter than the window ({} samples), no window to write to {}".format(X.shape[0], window, fpath))
+    n_seeds = 1 if np.ndim(X)==1 else X.shape[1]
+    tmp_fpath = fpath+'.tmp'
+    with h5py.File(tmp_fpath, 'w') as f:
+        dset = f.create_dataset('dfc', shape=(n_windows, n_seeds, Y.shape[1]), dtype='float32',
+                                chunks=(1, 1, min(Y.shape[1], max_chunk_voxels)), compression='gzip')
+        starts = f.create_dataset('window_starts', shape=(n_windows,), dtype='int64')
+        for chunk,r in sliding_window_corr(X, Y, window, step=step, chunk_size=chunk_size):
+            i = chunk[0]//step
+            dset[i:i+len(chunk)] = r
+            starts[i:i+len(chunk)] = chunk
+        f.create_dataset('window_centers_s', data=(starts[()] + (window-1)/2.)*t_r)
+        if mask_img is not None:
+            f.create_dataset('mask', data=np.asarray(mask_img.dataobj).astype(bool), compression='gzip')
+            f.create_dataset('affine', data=mask_img.affine)
+        if seeds is not None:
+            f.attrs['seeds'] = [str(seed) for seed in seeds]
+        f.attrs['window'] = window
+        f.attrs['step'] = step
+        f.attrs['t_r'] = t_r
+    os.replace(tmp_fpath, fpath)
+    return fpath
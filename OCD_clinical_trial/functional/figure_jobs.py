@@ -0,0 +1,168 @@
+# Figure generation of all result variants of the results store, in parallel
+# Author: Sebastien Naze
+# QIMR Berghofer 2021-2022
+#
+# Variants (metric, seed type, smoothing, stim radius, stim site, seed side) are enumerated from the
+# partitions of the voi_corr and alff tables of the results store, and one job is created per figure:
+# VOI correlations and pointplots per variant and seed, ALFF per variant. Jobs are rendered in a pool
+# of processes with the Agg backend, using the plotting functions of seed_to_voxel_analysis.py.
+# Figures of a variant are saved in their own folder with their usual file names:
+#     <out_dir>/<variant>/[<seed>/]<figure>
+# and a manifest (JSON) lists the jobs, their variant, output files, rendering time and errors.
+#
+# usage: python figure_jobs.py [--kinds voi_corr alff pointplot] [--n_jobs 8] [--out_dir <dir>] [--dry_run]
+
+import argparse
+from datetime import datetime
+from joblib import Parallel, delayed
+import json
+import os
+from time import time
+
+from OCD_clinical_trial.utils import config
+from OCD_clinical_trial.utils.results_store import get_partition_cols, get_store_dir, load_results
+
+figure_kinds = ['voi_corr', 'alff', 'pointplot']
+
+# results table of the variants of each kind of figure
+kind_tables = {'voi_corr':'voi_corr', 'alff':'alff', 'pointplot':'voi_corr'}
+
+manifest_fname = 'manifest.json'
+
+
+def get_variants(table, store_dir=None):
+    """ partitions of a results table (list of dicts), with the seeds of each partition for voi_corr """
+    partition_cols = get_partition_cols(os.path.join(get_store_dir(store_dir), table))
+    if partition_cols is None:
+        return []
+    columns = partition_cols+['pathway'] if table=='voi_corr' else partition_cols
+    df = load_results(table, columns=columns, store_dir=store_dir).drop_duplicates()
+    variants = []
+    for keys,df_part in df.groupby(partition_cols, sort=True):
+        variant = dict(zip(partition_cols, keys))
+        if table=='voi_corr':
+            variant['seeds'] = sorted(p.split('_to_')[0] for p in df_part['pathway'].unique())
+        variants.append(variant)
+    return variants
+
+
+def get_variant_name(variant):
+    """ folder name of a variant, e.g. metric-detrend_gsr_filtered_scrubFD05_seed_type-Harrison2009_... """
+    return '_'.join('{}-{}'.format(k, v) for k,v in variant.items() if k!='seeds')
+
+
+def get_variant_args(variant, img_dir):
+    """ arguments of seed_to_voxel_analysis plotting functions for a variant """
+    return argparse.Namespace(metrics=[variant['metric']], seed_type=variant['seed_type'], fwhm=variant['fwhm'],
+                              stim_radius=float(variant['stim_radius']), stim_radii=None,
+                              use_group_avg_stim_site=(variant['stim_site']=='group_avg'),
+                              unilateral_seed=(variant.get('seed_side')=='unilateral'),
+                              save_figs=True, plot_figs=False, img_dir=img_dir)
+
+
+def make_jobs(kinds=figure_kinds, seeds=None, store_dir=None):
+    """ list of figure jobs {'kind', 'variant', 'seed'} of all variants in the results store
+        seeds: restrict voi_corr and pointplot figures to these seeds (default: all seeds of a variant)
+    """
+    tables = set(kind_tables[k] for k in kinds) | ({'alff'} if 'pointplot' in kinds else set())
+    variants = dict((table, get_variants(table, store_dir=store_dir)) for table in tables)
+    alff_keys = set(tuple(sorted(v.items())) for v in variants.get('alff', []))
+
+    jobs = []
+    for kind in kinds:
+        for variant in variants[kind_tables[kind]]:
+            if kind=='alff':
+                jobs.append({'kind':kind, 'variant':variant, 'seed':None})
+                continue
+            if kind=='pointplot':
+                # pointplots need the ALFF results of the same variant
+                alff_key = tuple(sorted((k,v) for k,v in variant.items() if k not in ['seed_side', 'seeds']))
+                if alff_key not in alff_keys:
+                    continue
+            for seed in variant['seeds']:
+                if (seeds is None) or (seed in seeds):
+                    jobs.append({'kind':kind, 'variant':variant, 'seed':seed})
+    return jobs
+
+
+def render_job(job, out_dir, store_dir=None):
+    """ render a figure job with the Agg backend, returns its manifest entry """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from OCD_clinical_trial.functional import seed_to_voxel_analysis as s2v
+
+    variant, seed = job['variant'], job['seed']
+    img_dir = os.path.join(out_dir, get_variant_name(variant), seed or '')
+    args = get_variant_args(variant, img_dir)
+    partitions = dict((k,v) for k,v in variant.items() if k!='seeds')
+    entry = {'kind':job['kind'], 'variant':partitions, 'seed':seed, 'files':[], 'time':None, 'error':None}
+    t0 = time()
+    try:
+        with plt.rc_context():
+            if job['kind']=='voi_corr':
+                df_voi_corr = load_results('voi_corr', store_dir=store_dir, **partitions)
+                fpaths = s2v.plot_voi_corr(df_voi_corr, seeds=[seed], args=args)
+            elif job['kind']=='alff':
+                df_alff = load_results('alff', store_dir=store_dir, **partitions)
+                fpaths = s2v.plot_ALFF(df_alff, args)
+            elif job['kind']=='pointplot':
+                df_voi_corr = load_results('voi_corr', store_dir=store_dir, pathway='_'.join([seed,'to','stim']), **partitions)
+                df_alff = load_results('alff', store_dir=store_dir, **dict((k,v) for k,v in partitions.items() if k!='seed_side'))
+                df_summary = s2v.load_df_summary(args, df_alff=df_alff, df_voi_corr=df_voi_corr)[0]
+                fpaths = s2v.plot_pointplot(df_summary, args)
+            else:
+                raise ValueError("Unknown figure kind {}".format(job['kind']))
+        entry['files'] = [os.path.relpath(fpath, out_dir) for fpath in fpaths]
+    except Exception as e:
+        entry['error'] = '{}: {}'.format(type(e).__name__, e)
+    finally:
+        plt.close('all')
+    entry['time'] = time()-t0
+    return entry
+
+
+def write_manifest(entries, out_dir):
+    """ write manifest of rendered figures in out_dir (replaced atomically) """
+    fpath = os.path.join(out_dir, manifest_fname)
+    manifest = {'created':datetime.now().isoformat(timespec='seconds'), 'n_figures':sum(len(e['files']) for e in entries),
+                'n_errors':sum(e['error'] is not None for e in entries), 'jobs':entries}
+    with open(fpath+'.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(fpath+'.tmp', fpath)
+    return fpath
+
+
+def render_figures(jobs, out_dir, n_jobs=8, store_dir=None, verbose=1):
+    """ render figure jobs in a process pool and write their manifest, returns manifest entries """
+    os.makedirs(out_dir, exist_ok=True)
+    entries = Parallel(n_jobs=n_jobs, verbose=verbose)(delayed(render_job)(job, out_dir, store_dir) for job in jobs)
+    write_manifest(entries, out_dir)
+    return entries
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--kinds', type=str, nargs='+', default=figure_kinds, choices=figure_kinds, help='kinds of figures to render')
+    parser.add_argument('--seeds', type=str, nargs='+', default=None, action='store', help='restrict VOI and pointplot figures to these seeds (e.g. Acc dPut vPut)')
+    parser.add_argument('--n_jobs', type=int, default=8, action='store', help="number of parallel processes launched")
+    parser.add_argument('--out_dir', type=str, default=None, action='store', help='output folder (default: <proj_dir>/img/figures)')
+    parser.add_argument('--store_dir', type=str, default=None, action='store', help='results store (default: <proj_dir>/postprocessing/results_store)')
+    parser.add_argument('--dry_run', default=False, action='store_true', help='only list figure jobs')
+    args = parser.parse_args()
+
+    if args.out_dir is None:
+        args.out_dir = os.path.join(config.proj_dir, 'img', 'figures')
+
+    jobs = make_jobs(kinds=args.kinds, seeds=args.seeds, store_dir=args.store_dir)
+    print('{} figure jobs'.format(len(jobs)))
+    if args.dry_run:
+        for job in jobs:
+            print(job['kind'], get_variant_name(job['variant']), job['seed'] or '')
+    else:
+        t0 = time()
+        entries = render_figures(jobs, args.out_dir, n_jobs=args.n_jobs, store_dir=args.store_dir)
+        for e in entries:
+            if e['error'] is not None:
+                print('{} {} {}: {}'.format(e['kind'], get_variant_name(e['variant']), e['seed'] or '', e['error']))
+        print('{} figures rendered in {:.1f}s, manifest in {}'.format(sum(len(e['files']) for e in entries), time()-t0, args.out_dir))
@@ -0,0 +1,184 @@
+# Out-of-core seed-to-voxel correlation, processing BOLD runs by slabs of slices
+# Author: Sebastien Naze
+# QIMR Berghofer 2021-2022
+#
+# The (time x voxels) matrix of a run is never materialised. Slabs of axial slices are read
+# from the image, smoothed, masked, filtered, standardised and correlated with the seeds, and
+# the result is written into a preallocated output map. Slabs are extended by a halo of slices
+# covering the smoothing kernel support, so that results are equal to whole-image processing
+# with NiftiMasker up to float rounding (see benchmarks/bench_out_of_core.py).
+#
+# Compressed runs (.nii.gz) are decompressed once to a temporary .nii, from which slabs are
+# read slice by slice (seeking in the file, without memory map). Peak memory is set by the slab
+# depth, derived from a memory budget covering every copy of a slab: the slab read (and
+# smoothed in place), its masked (time x voxels) copy, and the working arrays of temporal
+# filtering, which is applied to blocks of voxels of the masked copy (in place) so that its
+# working arrays stay within one slab (see clean_copies).
+#
+# A first pass over the slabs computes the mean image (for the background brain mask, as in
+# NiftiMasker) and the raw timeseries of seed spheres (as in NiftiSpheresMasker).
+
+from contextlib import contextmanager
+import gzip
+import os
+import shutil
+import tempfile
+
+import nibabel as nib
+import numpy as np
+
+
+fwhm_over_sigma_ratio = np.sqrt(8*np.log(2))
+
+# copies of a slab held at once: slab read, masked copy, working arrays of temporal filtering
+slab_copies = 3
+# peak working memory of temporal filtering, in float32 copies of its input: about 3 for signal.clean
+# (float64 cast, filtfilt output and standardised copy, not all held at once) and for clean_fft,
+# measured with utils/profiling stages; 4 leaves a margin
+clean_copies = 4
+
+
+def get_smoothing_sigma(affine, fwhm):
+    """ gaussian sigma (in voxels) along each axis for a FWHM in mm (as in nilearn.image.smooth_img) """
+    if fwhm is None:
+        return np.zeros(3)
+    vox_size = np.sqrt(np.sum(affine[:3,:3]**2, axis=0))
+    return fwhm / (fwhm_over_sigma_ratio * vox_size)
+
+
+def get_slab_depth(shape, n_vols, halo, mem_budget_gb, dtype=np.float32, n_copies=slab_copies):
+    """ number of slices per slab so that n_copies of a slab (with halo) fit in the memory budget """
+    slice_bytes = shape[0]*shape[1]*n_vols*np.dtype(dtype).itemsize*n_copies
+    depth = int(mem_budget_gb*1e9 // slice_bytes) - 2*halo
+    if depth < 1:
+        raise MemoryError("Memory budget of {}GB too small for slabs of {} slices with halo {}".format(mem_budget_gb, 1, halo))
+    return min(depth, shape[2])
+
+
+def iter_slabs(n_slices, depth, halo=0):
+    """ yields (z0, z1, c0, c1): slab with halo [z0,z1) and its core [c0,c1) relative to z0 """
+    for start in range(0, n_slices, depth):
+        stop = min(start+depth, n_slices)
+        z0, z1 = max(start-halo, 0), min(stop+halo, n_slices)
+        yield z0, z1, start-z0, stop-z0
+
+
+def get_block_size(n_slab_voxels, dtype=np.float32):
+    """ number of voxels filtered at once so that the working arrays of filtering fit in a slab """
+    return max(1, int(n_slab_voxels*np.dtype(dtype).itemsize // (np.dtype(np.float32).itemsize*clean_copies)))
+
+
+@contextmanager
+def open_slab_img(bold_img, tmp_dir=None):
+    """ image to read slabs from: a compressed file is decompressed once to a temporary .nii (removed on exit)
+        and files are read without memory map (only the slices of a slab are read) """
+    fpath = bold_img if isinstance(bold_img, str) else bold_img.get_filename()
+    if fpath is None: # image in memory
+        yield bold_img
+        return
+    if not fpath.endswith('.gz'):
+        yield nib.load(fpath, mmap=False)
+        return
+    fd, tmp_fpath = tempfile.mkstemp(suffix='.nii', dir=tmp_dir)
+    try:
+        with gzip.open(fpath, 'rb') as f_in, os.fdopen(fd, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, length=2**24)
+        yield nib.load(tmp_fpath, mmap=False)
+    finally:
+        os.remove(tmp_fpath)
+
+
+def read_slab(img, z0, z1, dtype=np.float32):
+    """ (x, y, slices, time) slab of a 4D image read slice by slice, non-finite values set to 0 """
+    data = np.empty(img.shape[:2]+(z1-z0, img.shape[3]), dtype=dtype) # slabs are smoothed in place
+    for z in range(z0, z1):
+        data[:,:,z-z0] = img.dataobj[:,:,z]
+    data[~np.isfinite(data)] = 0
+    return data
+
+
+def smooth_slab(data, sigma):
+    """ separable gaussian smoothing of a slab (in place), as nilearn's smooth_array """
+    from scipy.ndimage import gaussian_filter1d
+
+    for n,s in enumerate(sigma):
+        if s > 0.:
+            gaussian_filter1d(data, s, output=data, axis=n)
+    return data
+
+
+def first_pass(img, sphere_idx, depth, dtype=np.float32):
+    """ mean image and raw mean timeseries of spheres (list of flat voxel indices) from slabs of img """
+    shape, n_vols = img.shape[:3], img.shape[3]
+    mean = np.zeros(shape, dtype=np.float64)
+    sums = np.zeros((n_vols, len(sphere_idx)))
+    counts = np.array([len(idx) for idx in sphere_idx], dtype=float)
+    coords = [np.unravel_index(idx, shape) for idx in sphere_idx]
+    for z0,z1,_,_ in iter_slabs(shape[2], depth):
+        data = read_slab(img, z0, z1, dtype)
+        mean[:,:,z0:z1] = data.mean(axis=-1)
+        for s,(i,j,k) in enumerate(coords):
+            in_slab = (k>=z0) & (k<z1)
+            sums[:,s] += data[i[in_slab], j[in_slab], k[in_slab]-z0].sum(axis=0)
+    return nib.Nifti1Image(mean, img.affine), sums/counts
+
+
+def chunked_seed_to_voxel(bold_img, seed_coords, seed_radius=3.5, smoothing_fwhm=None, t_r=0.81, low_pass=0.1, high_pass=0.01,
+                          mem_budget_gb=4., dtype=np.float32, clean=None, tmp_dir=None, verbose=False):
+    """ seed-to-voxel correlation maps of a BOLD run within a memory budget
+        inputs:
+            bold_img: 4D image or path (.nii.gz files are decompressed to a temporary .nii in tmp_dir)
+            seed_coords: list of MNI coordinates of sphere seeds
+            seed_radius, smoothing_fwhm, t_r, low_pass, high_pass: as in sphere_seed_to_voxel maskers
+            mem_budget_gb: memory budget of slabs (GB)
+            dtype: precision of slabs, timeseries and output maps
+            clean: temporal filtering function with signal.clean's arguments (default: signal.clean)
+            tmp_dir: folder of the decompressed run (default: system temporary folder)
+        outputs:
+            corr_img: 4D image (x, y, z, seeds) of correlation maps (0 outside brain mask)
+            mask_img: background brain mask
+    """
+    if clean is None:
+        from nilearn.signal import clean
+
+    with open_slab_img(bold_img, tmp_dir=tmp_dir) as slab_img:
+        return slab_seed_to_voxel(slab_img, seed_coords, seed_radius, smoothing_fwhm, t_r, low_pass, high_pass,
+                                  mem_budget_gb, dtype, clean, verbose)
+
+
+def slab_seed_to_voxel(bold_img, seed_coords, seed_radius, smoothing_fwhm, t_r, low_pass, high_pass, mem_budget_gb, dtype, clean, verbose):
+    """ chunked_seed_to_voxel of an image opened for slab reads (see open_slab_img) """
+    from nilearn.masking import compute_background_mask
+    from OCD_clinical_trial.functional.stim_site import get_nested_spheres
+
+    shape, n_vols = bold_img.shape[:3], bold_img.shape[3]
+    sigma = get_smoothing_sigma(bold_img.affine, smoothing_fwhm)
+    halo = int(4.*sigma[2]+0.5) # gaussian_filter1d kernel radius (truncate=4)
+    depth = get_slab_depth(shape, n_vols, halo, mem_budget_gb, dtype=dtype)
+    if verbose:
+        print('Slabs of {} slices (+{} halo) for a {}GB budget'.format(depth, halo, mem_budget_gb))
+
+    # first pass: mean image for mask, seeds timeseries
+    sphere_idx = []
+    for coords in seed_coords:
+        idx, counts = get_nested_spheres(np.asarray(coords, dtype=float), bold_img, [seed_radius])
+        sphere_idx.append(idx[:counts[0]])
+    mean_img, seeds_ts = first_pass(bold_img, sphere_idx, depth, dtype=dtype)
+    mask_img = compute_background_mask(mean_img)
+    mask = np.asarray(mask_img.dataobj).astype(bool)
+    seeds_ts = clean(seeds_ts, t_r=t_r, low_pass=low_pass, high_pass=high_pass, detrend=False, standardize='zscore').astype(dtype)
+
+    # second pass: smoothed, masked and cleaned voxels correlated with seeds by slab
+    corr = np.zeros(shape+(len(seed_coords),), dtype=dtype)
+    for z0,z1,c0,c1 in iter_slabs(shape[2], depth, halo):
+        slab_mask = mask[:,:,z0+c0:z0+c1]
+        if not slab_mask.any():
+            continue
+        data = smooth_slab(read_slab(bold_img, z0, z1, dtype), sigma)
+        block = get_block_size(data.size//n_vols, dtype)
+        voxels_ts = data[:,:,c0:c1][slab_mask].T # (time x voxels) copy
+        del data
+        for b in range(0, voxels_ts.shape[1], block):
+            voxels_ts[:,b:b+block] = clean(voxels_ts[:,b:b+block], t_r=t_r, low_pass=low_pass, high_pass=high_pass, detrend=False, standardize='zscore')
+        corr[:,:,z0+c0:z0+c1][slab_mask] = (voxels_ts.T @ seeds_ts) / n_vols
+    return nib.Nifti1Image(corr, bold_img.affine), mask_img
@@ -0,0 +1,105 @@
+# Sparse voxel <-> parcel projection operators of atlases, cached per atlas and image grid
+# Author: Sebastien Naze
+# QIMR Berghofer 2021-2022
+#
+# An atlas is rasterised (and resampled if needed) once per image grid into a sparse
+# (parcels x voxels) indicator matrix. Parcel means of any subset of labels are then a sparse
+# product with the voxel data, and brain maps of node values are the transposed product. This
+# replaces the sub-atlas images and label maskers that were re-created for each seed, atlas and
+# subject.
+
+from functools import lru_cache
+
+import nibabel as nib
+import numpy as np
+import os
+import scipy.sparse
+
+from OCD_clinical_trial.utils.config import get_atlas_cfg, atlas_dir
+
+
+@lru_cache(maxsize=None)
+def get_atlas_info(atlas):
+    """ label image path, node IDs and node names of an atlas (qsirecon atlas config) """
+    cfg = get_atlas_cfg()[atlas]
+    node_ids = np.array(cfg['node_ids'], dtype=int)
+    node_names = np.array(cfg.get('node_names', [str(i) for i in node_ids]))
+    return os.path.join(atlas_dir, cfg['file']), node_ids, node_names
+
+
+@lru_cache(maxsize=16)
+def _get_projection(atlas, shape, affine_bytes):
+    """ cached projection of an atlas in a grid (shape, affine), see get_atlas_projection """
+    from nilearn.image import load_img, resample_img
+
+    labels_fpath, node_ids, node_names = get_atlas_info(atlas)
+    labels_img = load_img(labels_fpath)
+    if shape is None:
+        shape, affine = labels_img.shape[:3], labels_img.affine
+    else:
+        affine = np.frombuffer(affine_bytes).reshape(4,4)
+        if (labels_img.shape[:3]!=shape) or not np.allclose(labels_img.affine, affine):
+            labels_img = resample_img(labels_img, target_affine=affine, target_shape=shape, interpolation='nearest')
+    labels = np.asarray(labels_img.dataobj).astype(int).ravel()
+    vox = np.flatnonzero(np.isin(labels, node_ids))
+    order = np.argsort(node_ids)
+    rows = order[np.searchsorted(node_ids[order], labels[vox])]
+    M = scipy.sparse.csr_matrix((np.ones(len(vox)), (rows, vox)), shape=(len(node_ids), labels.size))
+    return {'atlas':atlas, 'M':M, 'counts':np.asarray(M.sum(axis=1)).ravel(), 'node_ids':node_ids, 'node_names':node_names,
+            'shape':tuple(shape), 'affine':affine}
+
+
+def get_atlas_projection(atlas, ref_img=None):
+    """ sparse (parcels x voxels) indicator matrix of an atlas in the grid of ref_img (native atlas grid if None)
+        outputs a dict with:
+            M: CSR indicator matrix (rows in node_ids order, columns are flat voxel indices of the 3D grid)
+            counts: number of voxels per parcel in this grid
+            node_ids, node_names, shape, affine
+    """
+    if ref_img is None:
+        return _get_projection(atlas, None, None)
+    return _get_projection(atlas, tuple(ref_img.shape[:3]), np.asarray(ref_img.affine, dtype=float).tobytes())
+
+
+def get_roi_rows(proj, rois):
+    """ rows (parcels) whose node name contains any of rois (as in Atlaser.create_subatlas_img) """
+    if isinstance(rois, str):
+        rois = [rois]
+    return np.flatnonzero([any(roi in name for roi in rois) for name in proj['node_names']])
+
+
+def get_node_rows(proj, node_ids):
+    """ rows of given node IDs """
+    lut = dict((node_id,i) for i,node_id in enumerate(proj['node_ids']))
+    return np.array([lut[node_id] for node_id in node_ids], dtype=int)
+
+
+def parcel_means(proj, data, rows=None, vox=None):
+    """ mean of data over parcels
+        inputs:
+            data: (voxels x ...) array, over all voxels of the grid or over the flat indices vox (e.g. masked voxels)
+            rows: subset of parcels (default: all)
+        outputs:
+            (parcels x ...) means, NaN for parcels without voxels
+    """
+    M = proj['M'] if rows is None else proj['M'][rows]
+    if vox is not None:
+        M = M[:, vox]
+    counts = np.asarray(M.sum(axis=1)).ravel()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (M @ np.asarray(data).reshape(M.shape[1], -1)).reshape((M.shape[0],)+np.shape(data)[1:]) / \
+               counts.reshape((-1,)+(1,)*(np.ndim(data)-1))
+
+
+def create_brain_map(proj, values, rows=None):
+    """ 3D (or 4D) image with parcels of rows (default: all) set to values (parcels x ...) -- transpose of parcel sums """
+    M = proj['M'] if rows is None else proj['M'][rows]
+    values = np.asarray(values, dtype=float).reshape(M.shape[0], -1)
+    data = np.asarray(M.T @ values).reshape(proj['shape']+((values.shape[1],) if values.shape[1]>1 else ()))
+    return nib.Nifti1Image(data, proj['affine'])
+
+
+def create_subatlas_mask(proj, rois):
+    """ binary mask image of parcels whose name contains any of rois """
+    rows = get_roi_rows(proj, rois)
+    return create_brain_map(proj, np.ones(len(rows)), rows=rows)
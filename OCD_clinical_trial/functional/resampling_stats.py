@@ -0,0 +1,185 @@
+# Resampling statistics (permutation p-values and bootstrap CIs) of pre-post effects
+# Author: Sebastien Naze
+# QIMR Berghofer 2021-2022
+#
+# All (variable x group x contrast) combinations are computed at once: resamples are drawn as
+# (n_resamples x n_subjects) index/sign matrices and statistics are obtained from weighted sums
+# over the subject axis. Resamples are split in chunks with independent seeds (spawned from a
+# single seed) so that results do not depend on the number of jobs.
+
+import itertools
+from joblib import Parallel, delayed
+import numpy as np
+import pandas as pd
+
+
+def get_deltas(df, variables, subj_col='subj', ses_col='ses', pre='ses-pre', post='ses-post'):
+    """ pre minus post values of variables, one row per subject having both sessions (complete cases) """
+    df = df[df[ses_col].isin([pre, post])]
+    duplicated = df.duplicated([subj_col, ses_col], keep=False)
+    if duplicated.any():
+        pairs = df.loc[duplicated, [subj_col, ses_col]].drop_duplicates()
+        raise ValueError("Several rows per ({}, {}): {}".format(subj_col, ses_col, ', '.join('{} {}'.format(*p) for p in pairs.itertuples(index=False))))
+    wide = df.pivot(index=subj_col, columns=ses_col, values=list(variables))
+    deltas = wide.xs(pre, axis=1, level=ses_col) - wide.xs(post, axis=1, level=ses_col)
+    return deltas[list(variables)].dropna()
+
+
+def get_sums(X, W):
+    """ weighted sums over the subject axis: X (B, n, V), W (n, C) -> (B, V, C) """
+    return np.einsum('bnv,nc->bvc', X, W)
+
+
+def paired_t(X, member):
+    """ one-sample t statistic of X (B, n, V) within each subset of subjects in member (n, C) -> (B, V, C) """
+    n = member.sum(axis=0)
+    S, Q = get_sums(X, member), get_sums(X**2, member)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var = (Q - S**2/n)/(n-1)
+        return (S/n)/np.sqrt(var/n)
+
+
+def ind_t(X, g1, g2):
+    """ two-sample (pooled variance) t statistic of X (B, n, V) between subject indicators g1 and g2 (B, n) -> (B, V) """
+    n1, n2 = g1.sum(axis=1)[:,None], g2.sum(axis=1)[:,None]
+    S1, Q1 = np.einsum('bnv,bn->bv', X, g1), np.einsum('bnv,bn->bv', X**2, g1)
+    S2, Q2 = np.einsum('bnv,bn->bv', X, g2), np.einsum('bnv,bn->bv', X**2, g2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sp2 = ((Q1 - S1**2/n1) + (Q2 - S2**2/n2))/(n1+n2-2)
+        return (S1/n1 - S2/n2)/np.sqrt(sp2*(1./n1 + 1./n2))
+
+
+def corr_r(X, y, member):
+    """ Pearson correlation between X (B, n, V) and y (B, n) within each subset of subjects in member (n, C) -> (B, V, C) """
+    n = member.sum(axis=0)
+    Sx, Sxx = get_sums(X, member), get_sums(X**2, member)
+    Sy = np.einsum('bn,nc->bc', y, member)[:,None,:]
+    Syy = np.einsum('bn,nc->bc', y**2, member)[:,None,:]
+    Sxy = get_sums(X*y[:,:,None], member)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (Sxy - Sx*Sy/n)/np.sqrt((Sxx - Sx**2/n)*(Syy - Sy**2/n))
+
+
+def get_effects(X, y, member, g1, g2):
+    """ effect sizes: mean pre-post deltas (B, V, C), group1-group2 mean difference (B, V), delta-behaviour correlation (B, V, C) """
+    means = get_sums(X, member)/member.sum(axis=0)
+    diff = (np.einsum('bnv,n->bv', X, g1)/g1.sum()) - (np.einsum('bnv,n->bv', X, g2)/g2.sum())
+    r = corr_r(X, y, member) if y is not None else None
+    return means, diff, r
+
+
+def permute_within(rng, idx, strata):
+    """ permute subject indices idx (B, n) independently for each row, within each stratum """
+    idx = idx.copy()
+    for s in np.unique(strata):
+        cols = np.flatnonzero(strata==s)
+        idx[:,cols] = rng.permuted(idx[:,cols], axis=1)
+    return idx
+
+
+def bootstrap_within(rng, n_resamples, strata):
+    """ (n_resamples x n) bootstrap indices, resampling subjects with replacement within each stratum """
+    idx = np.empty((n_resamples, len(strata)), dtype=int)
+    for s in np.unique(strata):
+        cols = np.flatnonzero(strata==s)
+        idx[:,cols] = cols[rng.integers(0, len(cols), size=(n_resamples, len(cols)))]
+    return idx
+
+
+def resample_chunk(seed, n_resamples, D, y, member, g1, g2, strata):
+    """ null statistics and bootstrap effects for one chunk of resamples """
+    rng = np.random.default_rng(seed)
+    n = D.shape[0]
+    idx = np.tile(np.arange(n), (n_resamples,1))
+    out = dict()
+
+    # sign flips of the deltas (paired pre-post contrast)
+    signs = 1. - 2.*rng.integers(0, 2, size=(n_resamples, n))
+    out['t_paired'] = paired_t(D[None]*signs[:,:,None], member)
+
+    # permutation of group labels among subjects of the two contrasted groups
+    in_contrast = np.flatnonzero((g1+g2)>0)
+    perm = idx.copy()
+    perm[:,in_contrast] = rng.permuted(perm[:,in_contrast], axis=1)
+    out['t_ind'] = ind_t(D[None], g1[perm], g2[perm])
+
+    # permutation of behaviour across subjects (within group for group-wise correlations)
+    if y is not None:
+        perm_grp = permute_within(rng, idx, strata)
+        perm_all = rng.permuted(idx, axis=1)
+        r_grp = corr_r(D[None], y[perm_grp], member[:,1:])
+        r_all = corr_r(D[None], y[perm_all], member[:,:1])
+        out['r'] = np.concatenate([r_all, r_grp], axis=2)
+
+    # stratified bootstrap of the effects
+    boot = bootstrap_within(rng, n_resamples, strata)
+    out['boot_means'], out['boot_diff'], out['boot_r'] = get_effects(D[boot], None if y is None else y[boot], member, g1, g2)
+    return out
+
+
+def get_perm_pval(null, obs):
+    """ two-sided permutation p-value, (1 + #|null| >= |obs|) / (1 + n_resamples) """
+    return (1. + np.sum(np.abs(null) >= np.abs(obs)*(1-1e-12), axis=0)) / (1. + null.shape[0])
+
+
+def resampling_stats(df_deltas, groups, y=None, y_name='YBOCS_Total', contrast_groups=('group1', 'group2'),
+                     n_resamples=10000, seed=0, n_jobs=1, chunk_size=1000, alpha=0.05):
+    """ Permutation p-values and bootstrap CIs of all pre-post effects at once
+        inputs:
+            df_deltas: DataFrame (subjects x variables) of pre-post deltas (see get_deltas)
+            groups: Series of group labels indexed by subject
+            y: (optional) Series of pre-post behaviour (e.g. delta YBOCS) indexed by subject, to correlate with deltas
+            contrast_groups: pair of groups compared in the unpaired (interaction) contrast
+            n_resamples: number of permutations (and bootstrap samples)
+            seed: random seed, results are reproducible for a given seed and chunk_size
+            n_jobs: number of parallel processes over chunks of resamples
+            chunk_size: number of resamples per chunk
+            alpha: CI level is 1-alpha (percentile bootstrap)
+        outputs:
+            df_stats: DataFrame with one row per (variable, group, contrast)
+    """
+    subjs = df_deltas.index
+    if y is not None:
+        subjs = subjs.intersection(y.dropna().index)
+    subjs = subjs.intersection(groups.index)
+    D = df_deltas.loc[subjs].to_numpy(dtype=float)
+    variables = list(df_deltas.columns)
+    strata = groups.loc[subjs].to_numpy()
+    grp_names = sorted(np.unique(strata))
+    combos = ['all'] + grp_names
+    member = np.column_stack([np.ones(len(subjs))] + [(strata==g).astype(float) for g in grp_names])
+    g1, g2 = (strata==contrast_groups[0]).astype(float), (strata==contrast_groups[1]).astype(float)
+    y_ = None if y is None else y.loc[subjs].to_numpy(dtype=float)
+
+    # observed statistics and effects
+    t_paired = paired_t(D[None], member)[0]
+    t_ind = ind_t(D[None], g1[None], g2[None])[0]
+    means, diff, r = get_effects(D[None], None if y_ is None else y_[None], member, g1, g2)
+
+    # resampling in chunks
+    n_chunks = int(np.ceil(n_resamples/chunk_size))
+    sizes = [min(chunk_size, n_resamples-i*chunk_size) for i in range(n_chunks)]
+    seeds = np.random.SeedSequence(seed).spawn(n_chunks)
+    outs = Parallel(n_jobs=n_jobs)(delayed(resample_chunk)(s, b, D, y_, member, g1, g2, strata) for s,b in zip(seeds, sizes))
+    null = dict((k, np.concatenate([o[k] for o in outs], axis=0)) for k in outs[0].keys() if outs[0][k] is not None)
+    q = [100*alpha/2, 100*(1-alpha/2)]
+
+    lines = []
+    p_paired = get_perm_pval(null['t_paired'], t_paired)
+    ci_means = np.nanpercentile(null['boot_means'], q, axis=0)
+    for (i,var),(j,grp) in itertools.product(enumerate(variables), enumerate(combos)):
+        lines.append({'var':var, 'group':grp, 'contrast':'pre-post', 'n':int(member[:,j].sum()), 'stat':t_paired[i,j],
+                      'effect':means[0,i,j], 'ci_low':ci_means[0,i,j], 'ci_high':ci_means[1,i,j], 'p_perm':p_paired[i,j]})
+    p_ind = get_perm_pval(null['t_ind'], t_ind)
+    ci_diff = np.nanpercentile(null['boot_diff'], q, axis=0)
+    for i,var in enumerate(variables):
+        lines.append({'var':var, 'group':'all', 'contrast':'-'.join(contrast_groups), 'n':int((g1+g2).sum()), 'stat':t_ind[i],
+                      'effect':diff[0,i], 'ci_low':ci_diff[0,i], 'ci_high':ci_diff[1,i], 'p_perm':p_ind[i]})
+    if y is not None:
+        p_r = get_perm_pval(null['r'], r[0])
+        ci_r = np.nanpercentile(null['boot_r'], q, axis=0)
+        for (i,var),(j,grp) in itertools.product(enumerate(variables), enumerate(combos)):
+            lines.append({'var':var, 'group':grp, 'contrast':'corr_'+y_name, 'n':int(member[:,j].sum()), 'stat':r[0,i,j],
+                          'effect':r[0,i,j], 'ci_low':ci_r[0,i,j], 'ci_high':ci_r[1,i,j], 'p_perm':p_r[i,j]})
+    return pd.DataFrame(lines)
+
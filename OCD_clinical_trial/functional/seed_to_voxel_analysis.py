@@ -3,81 +3,34 @@
 # QIMR Berghofer 2021-2022
 
 import argparse
-import bct
 from datetime import datetime
 import glob
 import gzip
-import h5py
-import importlib
 import itertools
-import joblib
 from joblib import Parallel, delayed
 import json
-import matplotlib
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
 import nibabel as nib
-import nilearn
-from nilearn import datasets
-from nilearn.image import load_img, new_img_like, resample_to_img, binarize_img, iter_img, math_img
-from nilearn.plotting import plot_matrix, plot_glass_brain, plot_stat_map, plot_img_comparison, plot_img, plot_roi, view_img
-from nilearn.input_data import NiftiMasker, NiftiLabelsMasker, NiftiSpheresMasker
-from nilearn.glm.first_level import FirstLevelModel
-from nilearn.glm.second_level import SecondLevelModel, non_parametric_inference
-from nilearn.glm import threshold_stats_img
-from nilearn.reporting import get_clusters_table
-import nltools
 import numpy as np
 import os
 import pickle
 import pandas as pd
 import pdb
 import scipy
-from scipy.io import loadmat
-from scipy import ndimage
-import seaborn as sbn
 import shutil
-import sklearn
-from sklearn.neighbors import KernelDensity
-from sklearn.model_selection import GridSearchCV
-import statsmodels
-from statsmodels.stats import multitest
 import sys
-import time
-from time import time
-import pdb
-import platform
 import warnings
 warnings.filterwarnings('once')
 
-# special imports
-from OCD_baseline.old import qsiprep_analysis
-from OCD_baseline.utils import atlaser
-from OCD_baseline.structural.voxelwise_diffusion_analysis import cohen_d
-
-
-# get computer name to set paths
-if platform.node()=='qimr18844':
-    working_dir = '/home/sebastin/working/'
-    import pingouin as pg
-elif 'hpcnode' in platform.node():
-    working_dir = '/mnt/lustre/working/'
-else:
-    print('Computer unknown! Setting working dir as /working')
-    working_dir = '/working/'
-
-# general paths
-proj_dir = working_dir+'lab_lucac/sebastiN/projects/OCD_clinical_trial'
-deriv_dir = os.path.join(proj_dir, 'data/derivatives')
-
-baseline_dir = working_dir+'lab_lucac/sebastiN/projects/OCDbaseline'
-code_dir = os.path.join(baseline_dir, 'docs/code')
-atlas_dir = os.path.join(baseline_dir, 'utils')
+# heavy dependencies (nilearn, nltools, seaborn, sklearn, pingouin, OCD_baseline, etc.)
+# are imported in the functions using them, so that importing this module stays cheap
 
+# paths and cohort tables are resolved on first use
+from OCD_clinical_trial.utils.config import get_atlas_cfg, proj_dir, deriv_dir, baseline_dir, code_dir, atlas_dir
+from OCD_clinical_trial.utils.cohort import get_df_groups, get_stim_coords, get_subjs, get_group, stim_coords_xls_fname
+from OCD_clinical_trial.utils import profiling
+from OCD_clinical_trial.utils.profiling import profiled, stage
+from OCD_clinical_trial.utils.results_store import append_results, load_results, prune_results, save_arrays
 
-atlas_cfg_path = os.path.join(atlas_dir, 'atlas_config.json')
-with open(atlas_cfg_path) as jsf:
-    atlas_cfg = json.load(jsf)
 
 # Harrison 2009 seed locations:
 seed_loc = {'AccR':[9,9,-8], 'AccL':[-9,9,-8] }
@@ -102,13 +55,9 @@ cut_coords = {'Acc':[25,57,-6],
               'vPut':[-25,56,35],
               'NucleusAccumbens':[25,57,-6]}
 
-df_groups = pd.read_csv(os.path.join(proj_dir, 'data', 'groups.txt'), \
-                        sep=' ', index_col=False, dtype=str, encoding='utf-8')
-
 stim_radius = 5 # radius of sphere around stim site
-stim_coords_xls_fname = 'MNI_coordinates_FINAL.xlsx'
-stim_coords = pd.read_excel(os.path.join(proj_dir, 'data', stim_coords_xls_fname), usecols=['P ID', 'x', 'y', 'z'])
-stim_coords['subjs'] = stim_coords['P ID'].apply(lambda x : 'sub-patient'+x[-2:])
+
+nbs_deriv_dir = '/home/sebastin/working/lab_lucac/shared/projects/ocd_clinical_trial/data/derivatives' # connectomes used in NBS
 
 seed_suffix = { 'Harrison2009': 'sphere_seed_to_voxel',
                 'TianS4':'seed_to_voxel'}
@@ -127,6 +76,31 @@ def none_or_float(value):
         return None
     return float(value)
 
+def get_dtype(args):
+    """ numerical precision of images, timeseries and correlation maps (--precision) """
+    return np.dtype(getattr(args, 'precision', 'float64'))
+
+def get_clean(args):
+    """ temporal filtering and standardization of timeseries: nilearn's signal.clean, or clean_fft with the
+        FilterBank shared by all calls of the process (--fft_filter) """
+    if getattr(args, 'fft_filter', False):
+        from OCD_clinical_trial.functional.filtering import clean_fft
+        return clean_fft
+    from nilearn.signal import clean
+    return clean
+
+def get_masker_kwargs(args, low_pass=0.1, high_pass=0.01, standardize='zscore'):
+    """ filtering arguments of maskers, none with --fft_filter (applied afterwards by filter_ts) """
+    if getattr(args, 'fft_filter', False):
+        return {'t_r':0.81, 'standardize':False}
+    return {'t_r':0.81, 'low_pass':low_pass, 'high_pass':high_pass, 'standardize':standardize}
+
+def filter_ts(ts, args, low_pass=0.1, high_pass=0.01, standardize='zscore'):
+    """ band-pass and standardize (time x signals) masker outputs with the shared FilterBank (--fft_filter) """
+    if not getattr(args, 'fft_filter', False):
+        return ts
+    return get_clean(args)(ts, t_r=0.81, low_pass=low_pass, high_pass=high_pass, standardize=standardize).astype(ts.dtype)
+
 def get_seed_names(args):
     if args.seed_type == 'Harrison2009':
         seeds = list(seed_loc.keys()) #['AccL', 'AccR', 'dCaudL', 'dCaudR', 'dPutL', 'dPutR', 'vPutL', 'vPutR', 'vCaudSupL', 'vCaudSupR', 'drPutL', 'drPutR']
@@ -136,31 +110,28 @@ def get_seed_names(args):
         subrois = ['NucleusAccumbens']
     return seeds, subrois
 
-def get_subjs(args):
-    """ import subjects """
-    if args.subj!=None:
-        subjs = pd.Series([args.subj])
-    else:
-        subjs = pd.read_table(os.path.join(proj_dir, 'code', 'patients_list.txt'), names=['name'])['name']
-    return subjs
-
-def get_group(subj):
-    group = df_groups[df_groups.subj==subj].group
-    if len(group):
-        return group.values[0]
-    else:
-        return 'none'
+def __getattr__(name):
+    """ lazy access to cohort tables and atlas config (e.g. `from seed_to_voxel_analysis import stim_coords`) """
+    if name == 'stim_coords':
+        return get_stim_coords()
+    elif name == 'df_groups':
+        return get_df_groups()
+    elif name == 'atlas_cfg':
+        return get_atlas_cfg()
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
 
 
+@profiled(verbose=True)
 def seed_to_voxel(subj, ses, seeds, metrics, atlases, args=None):
     """ perform seed-to-voxel analysis of bold data based on atlas parcellation """
+    from nilearn.input_data import NiftiMasker
+    from OCD_clinical_trial.functional.parcellation import get_atlas_projection, get_roi_rows, parcel_means
+
     # prepare output directory
     out_dir = os.path.join(proj_dir, 'postprocessing', subj)
     if not os.path.exists(out_dir):
         os.makedirs(out_dir, exist_ok=True)
 
-    t0 = time()
-
     for metric in metrics:
         # get bold time series for each voxel
         img_space = 'MNI152NLin2009cAsym'
@@ -171,29 +142,54 @@ def seed_to_voxel(subj, ses, seeds, metrics, atlases, args=None):
         else:
             print("{} {} bold file not found, skip".format(subj, ses))
             break
-        brain_masker = NiftiMasker(smoothing_fwhm=args.brain_smoothing_fwhm, t_r=0.81, \
-            low_pass=0.1, high_pass=0.01, verbose=0, standardize='zscore')
-        voxels_ts = brain_masker.fit_transform(bold_img)
+        # bold data of the voxels covered by the (cached) atlas projections in the bold grid only,
+        # the full 4D array is released before brain masking
+        projs = dict((atlas, get_atlas_projection(atlas, bold_img)) for atlas in atlases)
+        vox = np.unique(np.concatenate([proj['M'].indices for proj in projs.values()]))
+        atlas_data = np.asarray(bold_img.dataobj, dtype=get_dtype(args)).reshape(-1, bold_img.shape[-1])[vox]
+
+        brain_masker = NiftiMasker(smoothing_fwhm=args.brain_smoothing_fwhm, verbose=0, dtype=get_dtype(args), **get_masker_kwargs(args))
+        voxels_ts = filter_ts(brain_masker.fit_transform(bold_img), args)
 
         for atlas in atlases:
-            # get atlas utility
-            atlazer = atlaser.Atlaser(atlas)
+            # parcel timeseries of the whole atlas, processed as with NiftiLabelsMasker
+            proj = projs[atlas]
+            parcels_ts = parcel_means(proj, atlas_data, vox=vox).T.astype(get_dtype(args))
+            valid = proj['counts']>0
+            parcels_ts[:,valid] = get_clean(args)(parcels_ts[:,valid], t_r=0.81, low_pass=0.1, high_pass=0.01, detrend=False, standardize='zscore').astype(get_dtype(args))
 
             # extract seed timeseries and perform seed-to-voxel correlation
             for seed in seeds:
-                seed_img = atlazer.create_subatlas_img(seed)
-                seed_masker = NiftiLabelsMasker(seed_img, t_r=0.81, \
-                    low_pass=0.1, high_pass=0.01 ,standardize='zscore')
-                seed_ts = np.squeeze(seed_masker.fit_transform(bold_img))
+                rows = get_roi_rows(proj, seed)
+                seed_ts = np.squeeze(parcels_ts[:, rows[valid[rows]]])
                 seed_to_voxel_corr = np.dot(voxels_ts.T, seed_ts)/voxels_ts.shape[0]
                 seed_to_voxel_corr_img = brain_masker.inverse_transform(seed_to_voxel_corr.mean(axis=-1).T)
+                seed_to_voxel_corr_img.set_data_dtype(get_dtype(args))
                 fname = '_'.join([subj,ses,metric,args.fwhm,atlas,seed,seed_suffix[args.seed_type],'corr.nii.gz'])
                 nib.save(seed_to_voxel_corr_img, os.path.join(out_dir, fname))
 
-    print('{} seed_to_voxel performed in {}s'.format(subj,int(time()-t0)))
-
 
 # TODO: could refactor this function, only a few lines changed from the one above
+def get_sphere_seed_timeseries(bold_img, seeds, args):
+    """ filtered and z-scored voxels and Harrison2009 3.5mm sphere seeds timeseries
+        outputs:
+            voxels_ts: (time x voxels) array
+            seeds_ts: (time x seeds) array
+            brain_masker: fitted NiftiMasker (to map voxels back to images)
+    """
+    from nilearn.input_data import NiftiMasker, NiftiSpheresMasker
+
+    with stage('brain_masker'):
+        brain_masker = NiftiMasker(smoothing_fwhm=args.brain_smoothing_fwhm, verbose=0, dtype=get_dtype(args), **get_masker_kwargs(args))
+        voxels_ts = filter_ts(brain_masker.fit_transform(bold_img), args)
+    with stage('seed_masker'):
+        seed_masker = NiftiSpheresMasker([np.array(seed_loc[seed]) for seed in seeds], radius=3.5, allow_overlap=True, \
+                            verbose=0, dtype=get_dtype(args), **get_masker_kwargs(args))
+        seeds_ts = filter_ts(seed_masker.fit_transform(bold_img), args)
+    return voxels_ts, seeds_ts, brain_masker
+
+
+@profiled(verbose=True)
 def sphere_seed_to_voxel(subj, ses, seeds, metrics, atlases=['Harrison2009'], args=None):
     """ perform seed-to-voxel analysis of bold data using Harrison2009 3.5mm sphere seeds """
     # prepare output directory
@@ -201,8 +197,6 @@ def sphere_seed_to_voxel(subj, ses, seeds, metrics, atlases=['Harrison2009'], ar
     if not os.path.exists(out_dir):
         os.makedirs(out_dir, exist_ok=True)
 
-    t0 = time()
-
     for atlas,metric in itertools.product(atlases,metrics):
         # get bold time series for each voxel
         img_space = 'MNI152NLin2009cAsym'
@@ -213,25 +207,79 @@ def sphere_seed_to_voxel(subj, ses, seeds, metrics, atlases=['Harrison2009'], ar
         else:
             print("{} {} bold file not found, skip".format(subj, ses))
             break
-        brain_masker = NiftiMasker(smoothing_fwhm=args.brain_smoothing_fwhm, t_r=0.81, \
-            low_pass=0.1, high_pass=0.01, verbose=0, standardize='zscore')
-        voxels_ts = brain_masker.fit_transform(bold_img)
+        if getattr(args, 'mem_budget_gb', None) is not None:
+            # out-of-core: voxels processed by slabs within the memory budget
+            from nilearn.image import iter_img
+            from OCD_clinical_trial.functional.out_of_core import chunked_seed_to_voxel
+            corr_img, _ = chunked_seed_to_voxel(bold_file, [seed_loc[seed] for seed in seeds], seed_radius=3.5, \
+                smoothing_fwhm=args.brain_smoothing_fwhm, mem_budget_gb=args.mem_budget_gb, dtype=get_dtype(args), clean=get_clean(args))
+            corr_imgs = iter_img(corr_img)
+        else:
+            voxels_ts, seeds_ts, brain_masker = get_sphere_seed_timeseries(bold_img, seeds, args)
+            corr_imgs = (brain_masker.inverse_transform(np.dot(voxels_ts.T, seed_ts)/voxels_ts.shape[0]) for seed_ts in seeds_ts.T)
 
-        # extract seed timeseries and perform seed-to-voxel correlation
-        for seed in seeds:
-            seed_masker = NiftiSpheresMasker([np.array(seed_loc[seed])], radius=3.5, t_r=0.81, \
-                                low_pass=0.1, high_pass=0.01, verbose=0, standardize='zscore')
-            seed_ts = np.squeeze(seed_masker.fit_transform(bold_img))
-            seed_to_voxel_corr = np.dot(voxels_ts.T, seed_ts)/voxels_ts.shape[0]
-            seed_to_voxel_corr_img = brain_masker.inverse_transform(seed_to_voxel_corr)
-            fwhm = 'brainFWHM{}mm'.format(str(int(args.brain_smoothing_fwhm)))
-            fname = '_'.join([subj,ses,metric,fwhm,atlas,seed,seed_suffix[args.seed_type],'corr.nii.gz'])
-            nib.save(seed_to_voxel_corr_img, os.path.join(out_dir, fname))
-    print('{} seed_to_voxel correlation performed in {}s'.format(subj,int(time()-t0)))
+        # perform seed-to-voxel correlation
+        with stage('corr_save'):
+            for seed,seed_to_voxel_corr_img in zip(seeds, corr_imgs):
+                seed_to_voxel_corr_img.set_data_dtype(get_dtype(args))
+                fwhm = 'brainFWHM{}mm'.format(str(int(args.brain_smoothing_fwhm)))
+                fname = '_'.join([subj,ses,metric,fwhm,atlas,seed,seed_suffix[args.seed_type],'corr.nii.gz'])
+                nib.save(seed_to_voxel_corr_img, os.path.join(out_dir, fname))
+
+
+@profiled(verbose=True)
+def compute_dynamic_fc(subj, ses, seeds, metrics, atlases=['Harrison2009'], args=None):
+    """ sliding-window seed-to-voxel (or seed-to-stim VOI with args.dfc_voi) correlations of Harrison2009 sphere seeds
+        voxel-wise windows are written to <subj>_<ses>_..._dfc_win<window>_step<step>.h5, VOI windows are returned as rows
+        Note: VOI windows correlate the seeds with the mean timeseries of the (unsmoothed) stim VOI, whereas voi_corr
+        averages over the VOI the correlations of seeds with brain-smoothed voxels; the two estimands differ and
+        dynamic VOI values are not windowed versions of voi_corr rows. """
+    from nilearn.input_data import NiftiSpheresMasker
+    from OCD_clinical_trial.functional.dynamic_fc import sliding_window_corr, write_dynamic_fc
+    from OCD_clinical_trial.functional.stim_site import get_subj_stim_center
+
+    out_dir = os.path.join(proj_dir, 'postprocessing', subj)
+    os.makedirs(out_dir, exist_ok=True)
+    fwhm = 'brainFWHM{}mm'.format(str(int(args.brain_smoothing_fwhm)))
+    rows = []
+    for atlas,metric in itertools.product(atlases,metrics):
+        img_space = 'MNI152NLin2009cAsym'
+        bold_file = os.path.join(deriv_dir, 'post-fmriprep-fix', subj, ses, 'func', \
+                                 subj+'_'+ses+'_task-rest_space-'+img_space+'_desc-'+metric+'.nii.gz')
+        if not os.path.exists(bold_file):
+            print("{} {} bold file not found, skip".format(subj, ses))
+            break
+        bold_img = nib.load(bold_file)
+        if bold_img.shape[-1] < args.dfc_window:
+            print("{} {} bold run ({} volumes) shorter than dFC window, skip".format(subj, ses, bold_img.shape[-1]))
+            break
+        voxels_ts, seeds_ts, brain_masker = get_sphere_seed_timeseries(bold_img, seeds, args)
+
+        if args.dfc_voi:
+            # stim VOI timeseries, processed as seeds timeseries
+            center = get_subj_stim_center(subj)
+            if center is None:
+                break
+            voi_masker = NiftiSpheresMasker([center], radius=args.stim_radius, verbose=0, dtype=get_dtype(args),
+                                            **get_masker_kwargs(args))
+            voi_ts = filter_ts(voi_masker.fit_transform(bold_img), args)
+            for starts,r in sliding_window_corr(seeds_ts, voi_ts, args.dfc_window, step=args.dfc_step):
+                for (i,start),seed in itertools.product(enumerate(starts), range(len(seeds))):
+                    rows.append({'subj':subj, 'ses':ses, 'metric':metric, 'atlas':atlas, 'fwhm':fwhm, 'group':get_group(subj),
+                                 'pathway':'_'.join([seeds[seed],'to','stim']), 'window_start':start,
+                                 'time':(start + (args.dfc_window-1)/2.)*0.81, 'corr':r[i,seed,0]})
+        else:
+            fname = '_'.join([subj,ses,metric,fwhm,atlas,seed_suffix[args.seed_type],'dfc','win{}'.format(args.dfc_window),'step{}.h5'.format(args.dfc_step)])
+            write_dynamic_fc(os.path.join(out_dir, fname), seeds_ts, voxels_ts, args.dfc_window, step=args.dfc_step,
+                             seeds=seeds, t_r=0.81, mask_img=brain_masker.mask_img_)
+    return rows
 
 
+@profiled()
 def merge_LR_hemis(subjs, seeds, seses, metrics, seed_type='sphere_seed_to_voxel', args=None):
     """ merge the left and right correlation images for each seed in each subject """
+    import nilearn.image
+
     if args.seed_type=='Harrison2009':
         hemis = ['L', 'R']
     else:
@@ -251,6 +299,7 @@ def merge_LR_hemis(subjs, seeds, seses, metrics, seed_type='sphere_seed_to_voxel
                           for hemi in hemis]
                 if os.path.exists(fnames[0]):
                     new_img = nilearn.image.mean_img(fnames)
+                    new_img.set_data_dtype(get_dtype(args))
                 else:
                     print("{} not found, skip".format(fnames[0]))
                     break
@@ -309,38 +358,45 @@ def get_subjs_after_scrubbing(subjs, seses, metrics, min_time=5):
 
 def resample_masks(masks):
     """ resample all given masks to the affine of the first in list """
+    from nilearn.image import resample_to_img
     ref_mask = masks[0]
     out_masks = [ref_mask]
     for mask in masks[1:]:
         out_masks.append(resample_to_img(mask, ref_mask, interpolation='nearest'))
     return out_masks
 
+@profiled(tags=('seed',), verbose=True)
 def mask_imgs(flist, masks=[], seed=None, args=None):
     """ mask input images using intersection of template masks and pre-computed within-groups union mask """
+    import nilearn.masking
+    from nilearn import datasets
+    from nilearn.image import load_img, binarize_img, iter_img
+    from nilearn.input_data import NiftiMasker
+    from OCD_baseline.old import qsiprep_analysis
+    from OCD_clinical_trial.functional.parcellation import get_atlas_projection, get_node_rows, create_brain_map, create_subatlas_mask
+
     # mask images to improve SNR
-    t_mask = time()
     if args.use_gm_mask:
         gm_mask = datasets.load_mni152_gm_mask()
         masks.append(binarize_img(gm_mask))
     if args.use_fspt_mask: ## not sure it works fine
-        fspt_mask = load_img(os.path.join(baseline_dir, 'utils', 'Larger_FrStrPalThal_schaefer400_tianS4MNI_lps_mni.nii'), dtype=np.float64)
+        fspt_mask = load_img(os.path.join(baseline_dir, 'utils', 'Larger_FrStrPalThal_schaefer400_tianS4MNI_lps_mni.nii'), dtype=get_dtype(args))
         masks.append(binarize_img(fspt_mask))
     if args.use_cortical_mask:
-        ctx_mask = load_img(os.path.join(baseline_dir, 'utils', 'schaefer_cortical.nii'), dtype=np.float64)
+        ctx_mask = load_img(os.path.join(baseline_dir, 'utils', 'schaefer_cortical.nii'), dtype=get_dtype(args))
         masks.append(binarize_img(ctx_mask))
     if args.use_frontal_mask:
         Fr_node_ids, _ = qsiprep_analysis.get_fspt_Fr_node_ids('schaefer400_tianS4')
-        atlazer = atlaser.Atlaser(atlas='schaefer400_tianS4')
-        Fr_img = atlazer.create_brain_map(Fr_node_ids, np.ones([len(Fr_node_ids),1]))
+        proj = get_atlas_projection('schaefer400_tianS4')
+        Fr_img = create_brain_map(proj, np.ones([len(Fr_node_ids),1]), rows=get_node_rows(proj, Fr_node_ids))
         masks.append(binarize_img(Fr_img))
     if args.use_seed_specific_mask:
-        atlazer = atlaser.Atlaser(atlas='schaefer400_tianS4')
-        frontal_atlas = atlazer.create_subatlas_img(rois=pathway_mask[seed])
+        frontal_atlas = create_subatlas_mask(get_atlas_projection('schaefer400_tianS4'), rois=pathway_mask[seed])
         masks.append(binarize_img(frontal_atlas))
     if masks != []:
         masks = resample_masks(masks)
         mask = nilearn.masking.intersect_masks(masks, threshold=1, connected=False) # thr=1 : intersection; thr=0 : union
-        masker = NiftiMasker(mask)
+        masker = NiftiMasker(mask, dtype=get_dtype(args))
         masker.fit(imgs=list(flist))
         masker.generate_report() # use for debug
         masked_data = masker.transform(imgs=flist.tolist())
@@ -350,12 +406,13 @@ def mask_imgs(flist, masks=[], seed=None, args=None):
         imgs = list(flist)
         masker=None
         mask = None
-    print('Masking took {:.2f}s'.format(time()-t_mask))
     return imgs, masker, mask
 
 
 def threshold_contrast(contrast, height_control='fpr', alpha=0.005, cluster_threshold=10):
     """ cluster threshold contrast at alpha with height_control method for multiple comparisons """
+    from nilearn.glm import threshold_stats_img
+    from nilearn.reporting import get_clusters_table
     thresholded_img, thresh = threshold_stats_img(
         contrast, alpha=alpha, height_control=height_control, cluster_threshold=cluster_threshold)
     cluster_table = get_clusters_table(
@@ -367,133 +424,269 @@ def threshold_contrast(contrast, height_control='fpr', alpha=0.005, cluster_thre
 
 def get_subj_stim_mask(subj, args):
     """ create sphere mask around stim stim for individuals """
+    import nltools
+    from nilearn.input_data import NiftiSpheresMasker
+
+    stim_coords = get_stim_coords()
     l = stim_coords[stim_coords['subjs']==subj]
     if l.empty:
         print(subj+' not in file '+stim_coords_xls_fname)
         return None,None
     stim_mask = nltools.create_sphere(np.array([l['x'], l['y'], l['z']]).flatten(), radius=args.stim_radius)
     stim_masker = NiftiSpheresMasker([np.array([l['x'], l['y'], l['z']]).flatten()], radius=args.stim_radius,
-                                     smoothing_fwhm=args.brain_smoothing_fwhm, t_r=0.81, low_pass=0.25, standardize=False)
+                                     smoothing_fwhm=args.brain_smoothing_fwhm, **get_masker_kwargs(args, low_pass=0.25, high_pass=None, standardize=False))
     return stim_mask, stim_masker
 
 
-def compute_voi_corr(subjs, seeds = ['Acc', 'dPut', 'vPut'], args=None):
-    """ compute correlation between seed and VOI for each pathway, to extract p-values, effect size, etc. """
-    dfs = []
+def get_input_sig(fpath, voi_sig=None):
+    """ signature of an input file (modification time and size), None if the file does not exist
+        voi_sig: signature of the stim VOI the file is summarized in (appended, see get_stim_sig) """
+    if not os.path.exists(fpath):
+        return None
+    st = os.stat(fpath)
+    sig = '{}-{}'.format(st.st_mtime_ns, st.st_size)
+    return sig if voi_sig is None else '_'.join([sig, voi_sig])
+
+
+def get_stim_sig(subj):
+    """ signature of a subject's individual stim site (MNI coordinates), None if not in the coordinates file """
+    stim_coords = get_stim_coords()
+    l = stim_coords[stim_coords['subjs']==subj]
+    if l.empty:
+        print(subj+' not in file '+stim_coords_xls_fname)
+        return None
+    return 'stim{:g},{:g},{:g}'.format(*l[['x', 'y', 'z']].to_numpy(dtype=float)[0])
+
+
+def get_prev_rows(df_prev, keys, columns):
+    """ previously computed rows (incremental mode), as dict of row records indexed by keys """
+    if (df_prev is None) or ('input_sig' not in df_prev.columns):
+        return dict()
+    df_prev = df_prev.loc[df_prev['ses']!='pre-post', [col for col in columns if col in df_prev.columns]]
+    return dict((tuple(row[k] for k in keys), row) for row in df_prev.to_dict('records'))
+
+
+def get_updated_subjs(df, df_prev, keys):
+    """ subjects with new, changed or removed rows compared to df_prev (incremental mode) """
+    if (df_prev is None) or ('input_sig' not in df_prev.columns):
+        return df['subj'].unique()
+    cols = keys+['input_sig']
+    merged = df[cols].merge(df_prev[cols], how='outer', indicator=True)
+    return merged.loc[merged['_merge']!='both', 'subj'].unique()
+
+
+def load_prev_results(table, args):
+    """ stored results of the slice matching args, None if there is none yet """
+    try:
+        return load_results(table, **get_store_partitions(args, table))
+    except FileNotFoundError:
+        return None
+
+
+def add_pre_post_rows(df, var='corr', id_cols=['subj', 'metric', 'atlas', 'fwhm', 'group', 'pathway']):
+    """ keep sessions rows of complete pre/post pairs and add their pre-post difference (ses='pre-post') """
+    if df.empty:
+        return df
+    if 'stim_radius' in df.columns:
+        id_cols = id_cols+['stim_radius']
+    df = df[df['ses']!='pre-post']
+    wide = df.set_index(id_cols+['ses'])[var].unstack('ses').reindex(columns=['ses-pre', 'ses-post'])
+    df_diff = (wide['ses-pre'] - wide['ses-post']).rename(var).reset_index().assign(ses='pre-post')
+    df_ses = df[df.groupby(id_cols)['ses'].transform('nunique')==2]
+    return pd.concat([df_ses, df_diff], ignore_index=True).sort_values(id_cols, kind='stable', ignore_index=True)
+
+
+def get_corr_map_fpath(subj, ses, metric, fwhm, atlas, seed, group, args):
+    """ path of a seed-to-voxel correlation map """
+    fname = '_'.join([subj, ses, metric, fwhm, atlas, seed, seed_suffix[args.seed_type], 'corr'+seed_ext[args.seed_type]])
+    if args.unilateral_seed:
+        return os.path.join(proj_dir, 'postprocessing', subj, fname)
+    return os.path.join(proj_dir, 'postprocessing/SPM/input_imgs', args.seed_type, 'seed_not_smoothed', metric, fwhm, seed, group, fname)
+
+
+def get_voi_index(voi_mask, ref_img):
+    """ flat indices and weights of VOI voxels in the grid of ref_img """
+    from nilearn.image import resample_to_img
+
+    voi_mask = resample_to_img(voi_mask, ref_img, interpolation='nearest')
+    weights = voi_mask.get_fdata().ravel()
+    idx = np.flatnonzero(weights)
+    return idx, weights[idx]
+
+
+@profiled()
+def compute_subj_voi_corr(subj, seeds, args, prev_rows=dict(), voi_mask=None, voi_sig=None):
+    """ seed to VOI correlation rows of a subject (all atlases, metrics, seeds and sessions)
+        rows of prev_rows whose correlation map and VOI are unchanged are not recomputed (incremental mode)
+        voi_mask, voi_sig: shared VOI mask and its signature (default: individual stim site) """
+    from nilearn.image import load_img
+    from OCD_clinical_trial.functional.stim_site import get_nested_spheres, get_subj_stim_center, sphere_means
+
+    rows = []
+    group = get_group(subj)
+    if group == 'none':
+        print('{} not in group list, removed it.'.format(subj))
+        return rows
+    if voi_sig is None:
+        voi_sig = get_stim_sig(subj)
+        if voi_sig is None:
+            return rows
     fwhm = 'brainFWHM{}mm'.format(int(args.brain_smoothing_fwhm))
+    voi_index = dict() # VOI indices and weights per image grid
     for atlas,metric in itertools.product(args.atlases, args.metrics):
-        for subj in subjs:
-            group = get_group(subj)
-            if group == 'none':
-                print('{} not in group list, removed it.'.format(subj))
-                continue;
-            # get VOI mask
-            if args.use_group_avg_stim_site:
-                voi_mask = load_img(os.path.join(proj_dir, 'utils', 'mask_stim_VOI_5mm.nii.gz'))
-            else:
-                voi_mask,_ = get_subj_stim_mask(subj, args)
-            if voi_mask == None:
-                continue
-            # compute correlation
-            for seed in seeds:
-                pre = post = 0
-                for ses in args.seses:
-                    # load correlation map
-                    if args.unilateral_seed:
-                        fname = '_'.join([subj, ses, metric, fwhm, atlas, seed, seed_suffix[args.seed_type], 'corr'+seed_ext[args.seed_type]])
-                        fpath = os.path.join(proj_dir, 'postprocessing', subj, fname)
-                    else:
-                        fname = '_'.join([subj, ses, metric, fwhm, atlas, seed, seed_suffix[args.seed_type], 'corr'+seed_ext[args.seed_type]])
-                        fpath = os.path.join(proj_dir, 'postprocessing/SPM/input_imgs', args.seed_type, 'seed_not_smoothed',
-                                        metric, fwhm, seed, group, fname)
-                    if os.path.exists(fpath):
-                        corr_map = load_img(fpath)
-                    else:
-                        print("{} {} FC file not found, skip.\n{}".format(subj, ses, fpath))
-                        pre=np.nan
-                        post=np.nan
-                        if ses=='ses-post':
-                            dfs = dfs[:-1]
-                        break
-
-                    # load voi mask
-                    #voi_mask = load_img(os.path.join(proj_dir, 'utils', 'frontal_'+seed+'_mapping_AND_mask_stim_VOI_5mm.nii.gz'))
-                    voi_mask = resample_to_img(voi_mask, corr_map, interpolation='nearest')
-                    # extract correlations
-                    voi_corr = corr_map.get_fdata().copy() * voi_mask.get_fdata().copy()
-                    avg_corr = np.mean(voi_corr[voi_corr!=0])
-                    df_line = {'subj':subj, 'ses':ses, 'metric':metric, 'atlas':atlas, 'fwhm':fwhm, 'group':group, 'pathway':'_'.join([seed,'to','stim']), 'corr':avg_corr}
-                    dfs.append(df_line)
-
-                    # simple way to add pre - post difference to compute interaction
-                    #----------------------- < from here
-                    if ses=='ses-pre':
-                        pre = avg_corr
-                    else:
-                        post = avg_corr
-                df_line = {'subj':subj, 'ses':'pre-post', 'metric':metric, 'atlas':atlas, 'fwhm':fwhm, 'group':group, 'pathway':'_'.join([seed,'to','stim']), 'corr':pre-post}
-                dfs.append(df_line)
-                #--------------------------- < to here
-    df_voi_corr = pd.DataFrame(dfs)
+        fpaths = dict(((seed,ses), get_corr_map_fpath(subj, ses, metric, fwhm, atlas, seed, group, args)) for seed,ses in itertools.product(seeds, args.seses))
+        sigs = dict((k, get_input_sig(fpath, voi_sig)) for k,fpath in fpaths.items())
+        prevs = dict(((seed,ses), prev_rows.get((subj, ses, metric, atlas, fwhm, group, '_'.join([seed,'to','stim'])))) for seed,ses in fpaths.keys())
+        todo = [k for k,sig in sigs.items() if (sig is not None) and ((prevs[k] is None) or (prevs[k]['input_sig']!=sig))]
+        # get VOI mask (or stim site center in radius sweep)
+        if todo and args.stim_radii:
+            center = get_subj_stim_center(subj)
+            if center is None:
+                return rows
+        elif todo and (voi_mask is None):
+            voi_mask,_ = get_subj_stim_mask(subj, args)
+            if voi_mask is None:
+                return rows
+        # compute correlation
+        for seed in seeds:
+            for ses in args.seses:
+                if sigs[(seed,ses)] is None:
+                    print("{} {} FC file not found, skip.\n{}".format(subj, ses, fpaths[(seed,ses)]))
+                    break
+                if (seed,ses) not in todo:
+                    rows.append(prevs[(seed,ses)])
+                    continue
+
+                # load correlation map
+                corr_map = load_img(fpaths[(seed,ses)])
+
+                # VOI voxels in the correlation map grid
+                #voi_mask = load_img(os.path.join(proj_dir, 'utils', 'frontal_'+seed+'_mapping_AND_mask_stim_VOI_5mm.nii.gz'))
+                grid = (corr_map.shape, corr_map.affine.tobytes())
+                if args.stim_radii:
+                    # nested spheres of all radii from one load of the map
+                    if grid not in voi_index:
+                        voi_index[grid] = get_nested_spheres(center, corr_map, args.stim_radii)
+                    avg_corrs = sphere_means(np.asarray(corr_map.get_fdata(dtype=get_dtype(args))).ravel(), *voi_index[grid], exclude_zeros=True)
+                    for radius,avg_corr in zip(args.stim_radii, avg_corrs):
+                        rows.append({'subj':subj, 'ses':ses, 'metric':metric, 'atlas':atlas, 'fwhm':fwhm, 'group':group, 'pathway':'_'.join([seed,'to','stim']),
+                                     'stim_radius':radius, 'corr':avg_corr, 'input_sig':sigs[(seed,ses)]})
+                    continue
+                if grid not in voi_index:
+                    voi_index[grid] = get_voi_index(voi_mask, corr_map)
+                idx, weights = voi_index[grid]
+                # extract correlations
+                voi_corr = np.asarray(corr_map.get_fdata(dtype=get_dtype(args))).ravel()[idx] * weights
+                avg_corr = np.mean(voi_corr[voi_corr!=0])
+                rows.append({'subj':subj, 'ses':ses, 'metric':metric, 'atlas':atlas, 'fwhm':fwhm, 'group':group, 'pathway':'_'.join([seed,'to','stim']),
+                             'corr':avg_corr, 'input_sig':sigs[(seed,ses)]})
+    return rows
+
+
+@profiled()
+def compute_voi_corr(subjs, seeds = ['Acc', 'dPut', 'vPut'], args=None, df_prev=None):
+    """ compute correlation between seed and VOI for each pathway, to extract p-values, effect size, etc.
+        Subjects are processed in parallel (args.n_jobs). In incremental mode (df_prev given), rows of df_prev whose
+        correlation map and VOI are unchanged are not recomputed. With args.stim_radii, rows are computed for all radii at once. """
+    from nilearn.image import load_img
+
+    keys = ['subj', 'ses', 'metric', 'atlas', 'fwhm', 'group', 'pathway']
+    prev_rows = get_prev_rows(df_prev, keys, keys+['corr', 'input_sig'])
+    # group average VOI mask is shared by all subjects
+    voi_mask, voi_sig = None, None
+    if args.use_group_avg_stim_site:
+        voi_fpath = os.path.join(proj_dir, 'utils', 'mask_stim_VOI_5mm.nii.gz')
+        voi_mask, voi_sig = load_img(voi_fpath), get_input_sig(voi_fpath)
+    subj_rows = Parallel(n_jobs=args.n_jobs)(delayed(compute_subj_voi_corr)(subj, seeds, args, dict((k,v) for k,v in prev_rows.items() if k[0]==subj), voi_mask, voi_sig)
+                                             for subj in subjs)
+    # pre - post difference to compute interaction (incomplete pairs have NaN difference)
+    columns = keys+(['stim_radius'] if args.stim_radii else [])+['corr', 'input_sig']
+    df_voi_corr = add_pre_post_rows(pd.DataFrame(itertools.chain(*subj_rows), columns=columns))
     return df_voi_corr
 
 
 
+def get_figure_fname(kind, args, var=None):
+    """ file name of a figure of kind 'voi_corr', 'alff' or 'pointplot' (for variable var) """
+    if kind=='voi_corr':
+        if args.use_group_avg_stim_site:
+            suffix = '_radius5mm_avg'
+        else:
+            suffix = '_indStimSite_{}mm_diameter'.format(int(args.stim_radius*2))
+        return 'seed_to_stim_VOI'+suffix+'_group_by_session.svg'
+    elif kind=='alff':
+        return 'ALFF_fALFF_stim_site_'+str(args.stim_radius)+'mm.svg'
+    elif kind=='pointplot':
+        return '_'.join(['point_plot_distrib',args.metrics[0],var,
+                         '_indStimSite_{}mm_diameter'.format(int(args.stim_radius*2)),datetime.now().strftime('%d%m%Y.pdf')])
+    raise ValueError("Unknown figure kind {}".format(kind))
+
+
+def save_figure(fig, fname, args):
+    """ save figure in args.img_dir (default: <proj_dir>/img), returns its path """
+    img_dir = getattr(args, 'img_dir', None) or os.path.join(proj_dir, 'img')
+    os.makedirs(img_dir, exist_ok=True)
+    fpath = os.path.join(img_dir, fname)
+    fig.savefig(fpath)
+    return fpath
+
+
 def plot_voi_corr(df_voi_corr, seeds = ['Acc', 'dPut', 'vPut'], args=None):
-    """ violinplots of FC in pahtways """
+    """ violinplots of FC in pahtways, returns paths of saved figures """
+    import matplotlib.pyplot as plt
+    import seaborn as sbn
+
     colors = ['lightgrey', 'darkgrey']
-    sbn.set_palette(colors)
     plt.rcParams.update({'font.size': 20, 'axes.linewidth':2})
     ylim = [-0.5, 0.5]
-    fig = plt.figure(figsize=[18,6])
-    
-    # 1 row per seed, 4 columns: group, pre-post, group1 pre-post, group2 pre-post
+    fig = plt.figure(figsize=[18,6*len(seeds)])
+
+    # 1 row per seed, 3 columns: group, pre-post, groups pre-post
     for i,seed in enumerate(seeds):
       # group difference
-      ax = plt.subplot(i+1,3,3*i+1)
+      ax = fig.add_subplot(len(seeds),3,3*i+1)
       tmp_df = df_voi_corr[(df_voi_corr['pathway']=='_'.join([seed,'to','stim'])) & (df_voi_corr['ses']!='pre-post')]
-      sbn.barplot(data=tmp_df, y='corr', x='pathway', hue='group', orient='v')
+      sbn.barplot(data=tmp_df, y='corr', x='pathway', hue='group', orient='v', palette=colors, ax=ax)
       ax.spines['top'].set_visible(False)
       ax.spines['right'].set_visible(False)
       ax.tick_params(width=2)
       #ax.get_legend().set_visible(False)
-      plt.legend(bbox_to_anchor=(1.02, 1), loc='upper left', borderaxespad=0)
+      ax.legend(bbox_to_anchor=(1.02, 1), loc='upper left', borderaxespad=0)
       ax.set_title(seed+' - group difference')
 
       # pre-post difference across groups
-      ax = plt.subplot(i+1,3,3*i+2)
+      ax = fig.add_subplot(len(seeds),3,3*i+2)
       tmp_df = df_voi_corr[(df_voi_corr['pathway']=='_'.join([seed,'to','stim'])) & (df_voi_corr['ses']=='pre-post')]
-      sbn.barplot(data=tmp_df, y='corr', x='pathway', hue='group', orient='v')
+      sbn.barplot(data=tmp_df, y='corr', x='pathway', hue='group', orient='v', palette=colors, ax=ax)
       ax.spines['top'].set_visible(False)
       ax.spines['right'].set_visible(False)
       ax.tick_params(width=2)
       #ax.get_legend().set_visible(False)
-      plt.legend(bbox_to_anchor=(1.02, 1), loc='upper left', borderaxespad=0)
+      ax.legend(bbox_to_anchor=(1.02, 1), loc='upper left', borderaxespad=0)
       ax.set_title(seed+' - pre-post difference')
 
       # pre-post and groups
-      ax = plt.subplot(i+1,3,3*i+3)
+      ax = fig.add_subplot(len(seeds),3,3*i+3)
       tmp_df = df_voi_corr[(df_voi_corr['pathway']=='_'.join([seed,'to','stim'])) & (df_voi_corr['ses']!='pre-post')]
-      sbn.barplot(data=tmp_df, y='corr', x='group', hue='ses', orient='v')
+      sbn.barplot(data=tmp_df, y='corr', x='group', hue='ses', orient='v', palette=colors, ax=ax)
       ax.spines['top'].set_visible(False)
       ax.spines['right'].set_visible(False)
       ax.tick_params(width=2)
-      plt.legend(bbox_to_anchor=(1.02, 1), loc='upper left', borderaxespad=0)
+      ax.legend(bbox_to_anchor=(1.02, 1), loc='upper left', borderaxespad=0)
 
-      plt.tight_layout()
+    fig.tight_layout()
 
+    fpaths = []
     if args.save_figs:
-        if args.use_group_avg_stim_site:
-            suffix = '_radius5mm_avg'
-        else:
-            suffix = '_indStimSite_{}mm_diameter'.format(int(args.stim_radius*2))
-        figname = 'seed_to_stim_VOI'+suffix+'_group_by_session.svg'
-        plt.savefig(os.path.join(proj_dir, 'img', figname))
-        #plt.savefig(os.path.join('/home/sebastin/tmp/', figname))
+        fpaths.append(save_figure(fig, get_figure_fname('voi_corr', args), args))
+    return fpaths
 
 
 def print_voi_stats(df_voi_corr, seeds = ['Acc', 'dPut', 'vPut'], args=None):
     """ print seed to VOI stats """
+    import scipy.stats
+    from OCD_baseline.structural.voxelwise_diffusion_analysis import cohen_d
+
     print('Seed to VOI statistics:\n-------------------------')
     for atlas,metric in itertools.product(args.atlases, args.metrics):
         fwhm = 'brainFWHM{}mm'.format(int(args.brain_smoothing_fwhm))
@@ -514,12 +707,24 @@ def print_voi_stats(df_voi_corr, seeds = ['Acc', 'dPut', 'vPut'], args=None):
             d = cohen_d(df_con['corr'], df_pat['corr'])
             print("{} {} {} {} pre-post  T={:.3f}   p={:.3f}   cohen's d={:.2f}".format(atlas,metric,fwhm,key,t,p,d))
 
+    if args.resampling_stats:
+        from OCD_clinical_trial.functional.resampling_stats import resampling_stats
+        print('Seed to VOI resampling statistics ({} resamples):\n-------------------------'.format(args.n_resamples))
+        df_pp = df_voi_corr[df_voi_corr['ses']=='pre-post']
+        df_deltas = df_pp.pivot_table(index='subj', columns=['atlas', 'metric', 'pathway'], values='corr').dropna()
+        df_deltas.columns = [' '.join(col) for col in df_deltas.columns]
+        groups = df_pp.groupby('subj')['group'].first()
+        df_stats = resampling_stats(df_deltas, groups, n_resamples=args.n_resamples, seed=args.random_seed, n_jobs=args.n_jobs)
+        print(df_stats[df_stats['contrast']=='group1-group2'].to_string(index=False, float_format='{:.3f}'.format))
+
 
 
 
 def get_file_lists(subjs, seed, atlas, metric, args):
     """ returns 3 file lists corresponding to controls, patients, and combined
     controls+patients paths of imgs to process """
+    from nilearn.image import math_img
+
     # naming convention in file system
     fwhm = 'brainFWHM{}mm'.format(str(int(args.brain_smoothing_fwhm)))
     # get images path
@@ -561,9 +766,29 @@ def get_file_lists(subjs, seed, atlas, metric, args):
 
 
 
-def compute_ALFF(subj, args=None):
-    """ compute Amplitude Low Frequency Fluctuation (ALFF) and fractional ALFF (fALFF) """
+def get_alff(ts):
+    """ ALFF, fALFF and power spectrum of timeseries (along first axis) """
+    import scipy.signal
+
+    freqs, Pxx = scipy.signal.welch(ts, fs=1./0.81, scaling='spectrum', nperseg=64, noverlap=32, axis=0)
+    ALFF = np.sqrt(Pxx[(freqs >= 0.01) & (freqs <= 0.08)].mean(axis=0))
+    fALFF = ALFF / np.sqrt(Pxx[(freqs <= 0.25)].mean(axis=0))
+    return ALFF, fALFF, Pxx
+
+
+@profiled()
+def compute_ALFF(subj, args=None, df_prev=None):
+    """ compute Amplitude Low Frequency Fluctuation (ALFF) and fractional ALFF (fALFF)
+        In incremental mode (df_prev given), sessions of df_prev whose BOLD file and stim site are unchanged are not recomputed.
+        With args.stim_radii, rows are computed for all radii from one load of each BOLD run. """
+    from OCD_clinical_trial.functional.stim_site import get_subj_stim_center, sphere_timeseries
+
     dfs = []
+    prev_rows = get_prev_rows(df_prev, ['subj', 'ses'], ['subj', 'ses', 'ALFF', 'fALFF', 'input_sig'])
+    stim_sig = get_stim_sig(subj)
+    if stim_sig is None:
+        return dfs
+    stim_masker = None
     for ses in args.seses:
         if 'gsr' in args.metrics[0]:
             fname = '_'.join([subj,ses])+'_task-rest_space-MNI152NLin2009cAsym_desc-detrend_gsr_smooth-6mm.nii.gz'
@@ -572,57 +797,82 @@ def compute_ALFF(subj, args=None):
             fname = '_'.join([subj,ses])+'_task-rest_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz'
             bold_file = os.path.join(proj_dir, 'data/derivatives/fmriprep-fix/', subj, ses, 'func', fname)
 
-        stim_mask,stim_masker = get_subj_stim_mask(subj, args)
+        input_sig = get_input_sig(bold_file, stim_sig)
+        prev = prev_rows.get((subj, ses))
+        if (input_sig is not None) and (prev is not None) and (prev['input_sig']==input_sig):
+            dfs.append(prev)
+            continue
+
+        if args.stim_radii:
+            # nested spheres of all radii from one load of the BOLD run
+            center = get_subj_stim_center(subj)
+            if center is None:
+                continue
+            elif input_sig is None:
+                print(bold_file+" does not exists!")
+                continue
+            ts = sphere_timeseries(bold_file, center, args.stim_radii, smoothing_fwhm=args.brain_smoothing_fwhm, clean=get_clean(args))
+            ALFFs, fALFFs, Pxx = get_alff(ts)
+            for i,radius in enumerate(args.stim_radii):
+                if np.isnan(Pxx[:,i]).any():
+                    print('{} {}mm PSD has NaNs, discard.'.format(subj, radius))
+                    continue
+                dfs.append({'subj':subj, 'ses':ses, 'stim_radius':radius, 'ALFF':ALFFs[i], 'fALFF':fALFFs[i], 'input_sig':input_sig})
+            continue
+
+        if stim_masker is None:
+            stim_mask,stim_masker = get_subj_stim_mask(subj, args)
         if (stim_masker == None) :
             print("{} {} stimulus mask error".format(subj, ses))
             continue
-        elif not(os.path.exists(bold_file)) :
+        elif input_sig is None :
             print(bold_file+" does not exists!")
             continue
         ts = stim_masker.fit()
-        ts = stim_masker.transform_single_imgs(bold_file)
+        ts = filter_ts(stim_masker.transform_single_imgs(bold_file), args, low_pass=0.25, high_pass=None, standardize=False)
 
-        freqs, Pxx = scipy.signal.welch(ts.squeeze(), fs=1./0.81, scaling='spectrum', nperseg=64, noverlap=32)
+        ALFF, fALFF, Pxx = get_alff(ts.squeeze())
         if np.isnan(Pxx).any():
             print(subj +' PSD has NaNs, discard.')
             continue
-        ALFF = np.sqrt(Pxx[(freqs >= 0.01) & (freqs <= 0.08)].mean())
-        fALFF = ALFF / np.sqrt(Pxx[(freqs <= 0.25)].mean())
 
-        dfs.append({'subj':subj, 'ses':ses, 'ALFF':ALFF, 'fALFF':fALFF}) #'stim_loc':np.array([l['x'], l['y'], l['z']]).flatten(),
+        dfs.append({'subj':subj, 'ses':ses, 'ALFF':ALFF, 'fALFF':fALFF, 'input_sig':input_sig}) #'stim_loc':np.array([l['x'], l['y'], l['z']]).flatten(),
         if args.verbose:
             print(subj + ' ' + ses + ' ALFF done.')
     return dfs
 
 
 def plot_ALFF(df_summary, args):
-    """ plot Amplitude Low Freq Fluctuations (ALFF) and Fractional ALFF """
-    plt.figure(figsize=[20,10])
-    plt.subplot(2,2,1)
-    sbn.swarmplot(data=df_summary, x='group', y='fALFF', hue='ses', dodge=True)
-    plt.legend(bbox_to_anchor=(1.02, 1), loc='upper left', borderaxespad=0)
+    """ plot Amplitude Low Freq Fluctuations (ALFF) and Fractional ALFF, returns paths of saved figures """
+    import matplotlib.pyplot as plt
+    import seaborn as sbn
 
-    plt.subplot(2,2,2)
-    sbn.pointplot(data=df_summary, x='ses', y='fALFF', hue='group', dodge=True)
-    plt.legend(bbox_to_anchor=(1.02, 1), loc='upper left', borderaxespad=0)
+    fig = plt.figure(figsize=[20,10])
+    for i,var in enumerate(['fALFF', 'ALFF']):
+        ax = fig.add_subplot(2,2,2*i+1)
+        sbn.swarmplot(data=df_summary, x='group', y=var, hue='ses', dodge=True, ax=ax)
+        ax.legend(bbox_to_anchor=(1.02, 1), loc='upper left', borderaxespad=0)
 
-    plt.subplot(2,2,3)
-    sbn.swarmplot(data=df_summary, x='group', y='ALFF', hue='ses', dodge=True)
-    plt.legend(bbox_to_anchor=(1.02, 1), loc='upper left', borderaxespad=0)
+        ax = fig.add_subplot(2,2,2*i+2)
+        sbn.pointplot(data=df_summary, x='ses', y=var, hue='group', dodge=True, ax=ax)
+        ax.legend(bbox_to_anchor=(1.02, 1), loc='upper left', borderaxespad=0)
 
-    plt.subplot(2,2,4)
-    sbn.pointplot(data=df_summary, x='ses', y='ALFF', hue='group', dodge=True)
-    plt.legend(bbox_to_anchor=(1.02, 1), loc='upper left', borderaxespad=0)
-
-    plt.tight_layout()
+    fig.tight_layout()
 
+    fpaths = []
     if args.save_figs:
-        plt.savefig(os.path.join(proj_dir, 'img', 'ALFF_fALFF_stim_site_'+str(args.stim_radius)+'mm.svg'))
+        fpaths.append(save_figure(fig, get_figure_fname('alff', args), args))
+    return fpaths
 
 
 
+@profiled()
 def compute_nbs(subjs, args):
     """ Network Based Statistics """
+    import bct
+    import h5py
+    from OCD_clinical_trial.functional.connectome import get_fc_fpath
+
     g1=[]
     g2=[]
     for subj in subjs:
@@ -630,16 +880,14 @@ def compute_nbs(subjs, args):
         if group=='none':
             print(subj +' not in any group, discard.')
             continue
-        fname = subj+'_ses-pre_task-rest_atlas-Schaefer2018_400_17+Tian_S4_desc-corr-detrend_filtered_scrub_gsr.h5'
-        fpath = os.path.join('/home/sebastin/working/lab_lucac/shared/projects/ocd_clinical_trial/data/derivatives/post-fmriprep-fix/'+subj+'/ses-pre/fc', fname)
+        fpath = get_fc_fpath(subj, 'ses-pre', args.nbs_atlas, fc_deriv_dir=args.fc_deriv_dir)
         if os.path.exists(fpath):
             with h5py.File(fpath, 'r') as f:
                 pre = f['fc'][()]
         else:
             print(subj +' file not found, discard.')
             continue
-        fname = subj+'_ses-post_task-rest_atlas-Schaefer2018_400_17+Tian_S4_desc-corr-detrend_filtered_scrub_gsr.h5'
-        fpath = os.path.join('/home/sebastin/working/lab_lucac/shared/projects/ocd_clinical_trial/data/derivatives/post-fmriprep-fix/'+subj+'/ses-post/fc', fname)
+        fpath = get_fc_fpath(subj, 'ses-post', args.nbs_atlas, fc_deriv_dir=args.fc_deriv_dir)
         if os.path.exists(fpath):
             with h5py.File(fpath, 'r') as f:
                 post = f['fc'][()]
@@ -659,25 +907,84 @@ def compute_nbs(subjs, args):
     return pvals, adj, null
 
 
+def gaussian_kde_1d(samples, x, bandwidth):
+    """ gaussian kernel density of 1D samples evaluated at x (as sklearn's KernelDensity) in one vectorised evaluation """
+    samples = np.asarray(samples, dtype=float)
+    z = (np.asarray(x, dtype=float)[:,np.newaxis] - samples[np.newaxis,:])/bandwidth
+    return np.exp(-0.5*z**2).sum(axis=1) / (len(samples)*bandwidth*np.sqrt(2*np.pi))
+
+
 def get_kde(data, var, smoothing_factor=20, args=None):
     """ create kernel density estimate for the data (used in violin-like plots) """
     mn = pointplot_ylim[args.seed_type][var][0] # min
     mx = pointplot_ylim[args.seed_type][var][1] # max
     b = (mx-mn)/smoothing_factor
-    model = KernelDensity(bandwidth=b)
-    xtrain = np.array(data[var])[:, np.newaxis]
-    model.fit(xtrain)
     xtest = np.linspace(mn,mx,100)[:, np.newaxis]
-    log_dens = model.score_samples(xtest)
-    mu = model.score_samples(np.array(data[var].mean()).reshape(1,1))
-    return xtest, np.exp(log_dens), np.exp(mu)
+    dens = gaussian_kde_1d(data[var], np.append(xtest, data[var].mean()), b)
+    return xtest, dens[:-1], dens[-1:]
+
+
+# plotting data of plot_pointplot, cached by content of the summary dataframe
+_pointplot_data = dict()
+
+def get_pointplot_data(df_summary, var, args, smoothing_factor=20):
+    """ KDEs of all group x session distributions and subjects pre-post trajectories of var (cached)
+        outputs a dict with:
+            kde_x: (100,) evaluation grid
+            kde: {(group, ses): (density on kde_x, density at the mean, mean)}
+            traj: {group: (n_subjs x 2) mean values at ses-pre and ses-post}
+    """
+    df = df_summary[['subj', 'ses', 'group', var]]
+    key = (var, args.seed_type, smoothing_factor, pd.util.hash_pandas_object(df, index=False).sum())
+    if key in _pointplot_data:
+        return _pointplot_data[key]
+
+    mn, mx = pointplot_ylim[args.seed_type][var]
+    kde_x = np.linspace(mn, mx, 100)
+    df = df[df['group'].isin(['group1', 'group2']) & df['ses'].isin(['ses-pre', 'ses-post'])]
+    kde = dict()
+    for (group,ses),data in df[~df[var].isna()].groupby(['group', 'ses']):
+        mean = data[var].mean()
+        dens = gaussian_kde_1d(data[var], np.append(kde_x, mean), (mx-mn)/smoothing_factor)
+        kde[(group,ses)] = (dens[:-1], dens[-1], mean)
+    traj = dict()
+    for group,data in df.groupby('group'):
+        # mean over rows of a subject/session (e.g. pathways), as the KDEs pool them
+        traj[group] = data.pivot_table(index='subj', columns='ses', values=var, aggfunc='mean', dropna=False) \
+                          .reindex(columns=['ses-pre', 'ses-post']).to_numpy()
+    _pointplot_data[key] = {'kde_x':kde_x, 'kde':kde, 'traj':traj}
+    return _pointplot_data[key]
+
+
+def plot_trajectories(ax, traj, color):
+    """ subjects pre-post trajectories (n_subjs x 2) as one LineCollection and one scatter """
+    from matplotlib.collections import LineCollection
+
+    x = np.broadcast_to([0., 1.], traj.shape)
+    complete = ~np.isnan(traj).any(axis=1)
+    segments = np.stack([x[complete], traj[complete]], axis=-1)
+    ax.add_collection(LineCollection(segments, colors=color, linewidths=0.75, alpha=0.5))
+    valid = ~np.isnan(traj)
+    ax.scatter(x[valid], traj[valid], s=10, color=color, alpha=0.5)
+    ax.set_xticks([0, 1])
+
+
+def plot_kde(ax, kde_x, kde, color, side=1):
+    """ half-violin of a KDE (density, density at mean, mean) on the right (side=1) or left (side=-1) """
+    dens, mu, mean = kde
+    ax.fill(side*dens, kde_x, color=color, alpha=0.5)
+    ax.plot([0,side*mu], [mean, mean], '-', color=color)
 
 
 def plot_pointplot(df_summary, args):
-    """ Show indiviudal subject point plot for longitudinal display """
+    """ Show indiviudal subject point plot for longitudinal display, returns paths of saved figures """
+    import matplotlib.pyplot as plt
+
     plt.rcParams.update({'font.size': 16})
     df_summary = df_summary[df_summary['ses']!='pre-post']
+    fpaths = []
     for i,var in enumerate(['corr', 'fALFF']):
+        data = get_pointplot_data(df_summary, var, args)
         fig = plt.figure(figsize=[12,4])
         gs = plt.GridSpec(1,10)
         # ===========
@@ -703,20 +1010,9 @@ def plot_pointplot(df_summary, args):
         ax2.set_ylabel('', visible=False)
         ax2.set_yticks([])
 
-        for subj in df_summary.subj.unique():
-            grp = str(df_summary[df_summary['subj']==subj].group.unique().squeeze())
-            if grp == 'group1':
-                plt.sca(ax2)
-            elif grp == 'group2':
-                plt.sca(ax1)
-            else:
-                continue
-            sbn.pointplot(data=df_summary[df_summary['subj']==subj], x='ses', y=var, dodge=(np.random.rand()-0.5), color=group_colors[get_group(subj)], linewidth=0.5, alpha=0.5)
-
-        plt.setp(ax1.lines, linewidth=0.75)
-        plt.setp(ax1.collections, sizes=[10])
-        plt.setp(ax2.lines, linewidth=0.75)
-        plt.setp(ax2.collections, sizes=[10])
+        for grp,ax in zip(['group1', 'group2'], [ax2, ax1]):
+            if grp in data['traj']:
+                plot_trajectories(ax, data['traj'][grp], color=group_colors[grp])
         if var=='corr':
             ax1.set_xticklabels([])
             ax1.set_xlabel('')
@@ -746,11 +1042,7 @@ def plot_pointplot(df_summary, args):
         ax0.set_xticklabels(labels=[], visible=False)
         ax0.set_xlabel('', visible=False)
         ax0.set_xticks([])
-        data = df_summary[(df_summary.group=='group2') & (df_summary.ses=='ses-pre')]
-        data = data[~data[var].isna()]
-        x,y,mu = get_kde(data, var=var, args=args)
-        ax0.fill(-y,x, color=group_colors['group2'], alpha=0.5)
-        ax0.plot([-mu,0],[data[var].mean(), data[var].mean()], '-', color=group_colors['group2'])
+        plot_kde(ax0, data['kde_x'], data['kde'][('group2','ses-pre')], color=group_colors['group2'], side=-1)
 
         ax3 = fig.add_subplot(gs[0,4])
         ax3.set_ylim(pointplot_ylim[args.seed_type][var])
@@ -764,11 +1056,7 @@ def plot_pointplot(df_summary, args):
         ax3.set_yticklabels(labels=[], visible=False)
         ax3.set_ylabel('', visible=False)
         ax3.set_yticks([])
-        data = df_summary[(df_summary.group=='group2') & (df_summary.ses=='ses-post')]
-        data = data[~data[var].isna()]
-        x,y,mu = get_kde(data, var=var, args=args)
-        ax3.fill(y,x, color=group_colors['group2'], alpha=0.5)
-        ax3.plot([0,mu],[data[var].mean(), data[var].mean()], '-', color=group_colors['group2'])
+        plot_kde(ax3, data['kde_x'], data['kde'][('group2','ses-post')], color=group_colors['group2'], side=1)
 
         ax4 = fig.add_subplot(gs[0,5])
         ax4.set_ylim(pointplot_ylim[args.seed_type][var])
@@ -782,11 +1070,7 @@ def plot_pointplot(df_summary, args):
         ax4.set_yticklabels(labels=[], visible=False)
         ax4.set_ylabel('', visible=False)
         ax4.set_yticks([])
-        data = df_summary[(df_summary.group=='group1') & (df_summary.ses=='ses-pre')]
-        data = data[~data[var].isna()]
-        x,y,mu = get_kde(data, var=var, args=args)
-        ax4.fill(-y,x, color=group_colors['group1'], alpha=0.5)
-        ax4.plot([-mu,0],[data[var].mean(), data[var].mean()], '-', color=group_colors['group1'])
+        plot_kde(ax4, data['kde_x'], data['kde'][('group1','ses-pre')], color=group_colors['group1'], side=-1)
 
         ax5 = fig.add_subplot(gs[0,9])
         ax5.set_ylim(pointplot_ylim[args.seed_type][var])
@@ -800,29 +1084,26 @@ def plot_pointplot(df_summary, args):
         ax5.set_yticklabels(labels=[], visible=False)
         ax5.set_ylabel('', visible=False)
         ax5.set_yticks([])
-        data = df_summary[(df_summary.group=='group1') & (df_summary.ses=='ses-post')]
-        data = data[~data[var].isna()]
-        x,y,mu = get_kde(data, var=var, args=args)
-        ax5.fill(y,x, color=group_colors['group1'], alpha=0.5)
-        ax5.plot([0,mu],[data[var].mean(), data[var].mean()], '-', color=group_colors['group1'])
-
-        plt.tight_layout()
+        plot_kde(ax5, data['kde_x'], data['kde'][('group1','ses-post')], color=group_colors['group1'], side=1)
 
+        fig.tight_layout()
 
         if args.save_figs:
-            fname = '_'.join(['point_plot_distrib',args.metrics[0],var,
-                            '_indStimSite_{}mm_diameter'.format(int(args.stim_radius*2)),datetime.now().strftime('%d%m%Y.pdf')])
-            plt.savefig(os.path.join(proj_dir, 'img', fname))
+            fpaths.append(save_figure(fig, get_figure_fname('pointplot', args, var=var), args))
 
         if args.plot_figs:
             plt.show(block=False)
         else:
             plt.close(fig)
+    return fpaths
 
 
 
 def print_stats(df_summary, args):
     """ print stats of pre vs post variables """
+    import pingouin as pg
+    import scipy.stats
+
     #df_summary.dropna(inplace=True)
     for var in ['corr', 'fALFF']:
         df = df_summary[~df_summary[var].isna()]
@@ -866,28 +1147,162 @@ def print_stats(df_summary, args):
         posthocs = pg.pairwise_ttests(data=df[df.ses!='pre-post'], dv=var, within='ses', between='group', subject='subj')
         pg.print_table(posthocs)
 
+    if args.resampling_stats:
+        print_resampling_stats(df_summary, args)
 
-def load_df_summary(args):
-    """ loads final results """
-    if (('df_alff' not in locals()) & ('df_alff' not in globals())):
-        save_suffix = '_'.join([metrics[0],args.seed_type,args.fwhm])
-        if not args.use_group_avg_stim_site:
-            save_suffix += '_indStimSite_{}mm_diameter'.format(int(args.stim_radius*2))
-        with open(os.path.join(proj_dir, 'postprocessing', 'df_alff_'+save_suffix+'.pkl'), 'rb') as f:
-            df_alff = pickle.load(f)
-    if (('df_voi_corr' not in locals()) & ('df_voi_corr' not in globals())):
-        save_suffix = '_'.join([metrics[0],args.seed_type,args.fwhm])
-        if args.unilateral_seed:
-            save_suffix += '_unilateral'
-        else:
-            save_suffix += '_bilateral'
-        if not args.use_group_avg_stim_site:
-            save_suffix += '_indStimSite_{}mm_diameter'.format(int(args.stim_radius*2))
-        with open(os.path.join(proj_dir, 'postprocessing', 'df_voi_corr_'+save_suffix+'.pkl'), 'rb') as f:
-            df_voi_corr = pickle.load(f)
+
+def print_resampling_stats(df_summary, args):
+    """ print permutation p-values and bootstrap CIs of pre-post effects, for all variables, groups and contrasts at once """
+    from OCD_clinical_trial.functional.resampling_stats import get_deltas, resampling_stats
+    df_summary = df_summary[df_summary['ses']!='pre-post']
+    keys = [k for k in ['pathway', 'stim_radius'] if k in df_summary.columns]
+    for key,df in df_summary.groupby(keys):
+        df_deltas = get_deltas(df, ['corr', 'fALFF', 'YBOCS_Total'])
+        groups = df.groupby('subj')['group'].first()
+        df_stats = resampling_stats(df_deltas, groups, y=df_deltas['YBOCS_Total'], y_name='YBOCS', n_resamples=args.n_resamples,
+                                    seed=args.random_seed, n_jobs=args.n_jobs)
+        df_stats = df_stats[~((df_stats['var']=='YBOCS_Total') & (df_stats['contrast']=='corr_YBOCS'))]
+        print('Resampling statistics of {} ({} resamples, seed={}):'.format(
+              ', '.join('{}={}'.format(k,v) for k,v in zip(keys, key)), args.n_resamples, args.random_seed))
+        print(df_stats.to_string(index=False, float_format='{:.3f}'.format))
+
+
+def get_ybocs_behaviour(df_pat):
+    """ delta YBOCS (pre - post) and baseline YBOCS 5 dimensions scores, one row per subject """
+    from OCD_clinical_trial import ybocs_analysis
+    from OCD_clinical_trial.functional.resampling_stats import get_deltas
+    df_delta = get_deltas(df_pat, ['YBOCS_Total']).rename(columns={'YBOCS_Total':'delta_YBOCS'})
+    df_dims = ybocs_analysis.create_df_ybocs_dims()
+    df_dims = df_dims[df_dims['session']=='Pre'].groupby('subj')[ybocs_analysis.checklist_5dims].first()
+    return df_delta.join(df_dims, how='inner')
+
+
+@profiled()
+def compute_voxelwise_ybocs_corr(subjs, seeds, df_pat, args):
+    """ correlate delta YBOCS and YBOCS dimensions with every voxel of the pre-post seed-to-voxel maps, save r and p maps """
+    from OCD_clinical_trial.functional.voxelwise_behaviour import voxelwise_corr
+    df_behav = get_ybocs_behaviour(df_pat)
+    out_dir = os.path.join(proj_dir, 'postprocessing', 'voxelwise_ybocs')
+    os.makedirs(out_dir, exist_ok=True)
+    for atlas,metric,seed in itertools.product(args.atlases, args.metrics, seeds):
+        # pre-post maps of subjects with behaviour, restricted to voxels inside all maps
+        maps, map_subjs, inside = [], [], True
+        for subj in subjs:
+            if (subj in args.revoked) or (subj not in df_behav.index):
+                continue
+            fpaths = [os.path.join(args.in_dir, metric, args.fwhm, seed, get_group(subj),
+                                   '_'.join([subj,ses,metric,args.fwhm,atlas,seed,seed_suffix[args.seed_type],'corr.nii.gz']))
+                      for ses in ['ses-pre', 'ses-post']]
+            if not all([os.path.exists(fpath) for fpath in fpaths]):
+                print('{} pre or post FC map not found, skip.'.format(subj))
+                continue
+            ref_img = nib.load(fpaths[0])
+            pre, post = ref_img.get_fdata(), nib.load(fpaths[1]).get_fdata()
+            inside = inside & ((pre!=0) | (post!=0))
+            maps.append(pre - post)
+            map_subjs.append(subj)
+        if len(map_subjs) < 3:
+            print('Not enough subjects with pre-post {} maps and YBOCS scores, skip.'.format(seed))
+            continue
+        Y = np.stack([m[inside] for m in maps])
+        X = df_behav.loc[map_subjs].to_numpy(dtype=float)
+        n_perm = args.n_perm if args.voxelwise_fwe else 0
+        r, p, p_fwe = voxelwise_corr(Y, X, n_perm=n_perm, seed=args.random_seed, n_jobs=args.n_jobs)
+
+        for i,behav in enumerate(df_behav.columns):
+            for stat,vals in [('r',r), ('p',p), ('pFWE',p_fwe)]:
+                if vals is None:
+                    continue
+                data = np.zeros(inside.shape, dtype=np.float32)
+                data[inside] = vals[i]
+                fname = '_'.join([metric, args.fwhm, atlas, seed, behav.replace('/','-'), stat])+'.nii.gz'
+                nib.save(nib.Nifti1Image(data, ref_img.affine), os.path.join(out_dir, fname))
+        print('{} voxel-wise YBOCS correlation maps saved in {} (n={})'.format(seed, out_dir, len(map_subjs)))
+
+
+def get_stim_site(args):
+    """ stim site definition of results: group average VOI mask, individual VOI mask (get_subj_stim_mask),
+        or individual spheres in the grid of each map of a radius sweep (get_nested_spheres, different voxels) """
+    if args.use_group_avg_stim_site:
+        return 'group_avg'
+    return 'individual_sphere' if args.stim_radii else 'individual'
+
+
+def get_store_partitions(args, table='voi_corr'):
+    """ partition keys (and values) of results tables in the results store """
+    partitions = {'metric':args.metrics[0], 'seed_type':args.seed_type, 'fwhm':args.fwhm,
+                  'stim_radius':list(args.stim_radii) if args.stim_radii else float(args.stim_radius),
+                  'stim_site':get_stim_site(args)}
+    if table in ['voi_corr', 'dfc_voi']:
+        partitions['seed_side'] = 'unilateral' if args.unilateral_seed else 'bilateral'
+    if table=='dfc_voi':
+        partitions['dfc_window'] = str(args.dfc_window)
+        partitions['dfc_step'] = str(args.dfc_step)
+    return partitions
+
+
+def store_results(df, table, args):
+    """ write results to the results store (partition columns already in df, e.g. stim_radius of a radius sweep, are kept) """
+    partitions = get_store_partitions(args, table)
+    append_results(df.assign(**dict((k,v) for k,v in partitions.items() if k not in df.columns)), table, partition_cols=list(partitions.keys()))
+
+
+def prune_store(df, table, subjs, args):
+    """ remove stored subjects of the slice of args without rows in df: subjects of this run whose inputs or stim site
+        are gone, and subjects no longer in the subject list (unless a single subject is run) """
+    values = [str(subj) for subj in subjs] if args.subj is not None else None
+    prune_results(df, table, get_store_partitions(args, table), values=values)
+
+
+def iter_stim_radii(df, args):
+    """ (df, args) of each stim radius in a radius sweep, (df, args) otherwise """
+    if not args.stim_radii:
+        yield df, args
+        return
+    for radius,df_radius in df.groupby('stim_radius'):
+        print('\n==== stim radius {}mm ===='.format(radius))
+        yield df_radius, argparse.Namespace(**dict(vars(args), stim_radius=radius, stim_radii=None))
+
+
+def get_pickle_fpath(table, args):
+    """ pickle of a results table ('voi_corr' or 'alff') saved by earlier versions, before the results store """
+    save_suffix = '_'.join([args.metrics[0],args.seed_type,args.fwhm])
+    if table=='voi_corr':
+        save_suffix += '_unilateral' if args.unilateral_seed else '_bilateral'
+    if not args.use_group_avg_stim_site:
+        save_suffix += '_indStimSite_{}mm_diameter'.format(int(args.stim_radius*2))
+    return os.path.join(proj_dir, 'postprocessing', 'df_'+table+'_'+save_suffix+'.pkl')
+
+
+def load_stored_results(table, args):
+    """ slice of a results table matching args, imported once into the results store from the pickle of earlier
+        versions (get_pickle_fpath) when the store has no such results """
+    partitions = get_store_partitions(args, table)
+    try:
+        df = load_results(table, **partitions)
+    except FileNotFoundError:
+        df = None
+    if (df is not None) and len(df):
+        return df
+    fpath = get_pickle_fpath(table, args)
+    if args.stim_radii or not os.path.exists(fpath):
+        raise FileNotFoundError("No {} results matching {} in the results store, nor in {}".format(table, partitions, fpath))
+    with open(fpath, 'rb') as f:
+        df = pickle.load(f)
+    store_results(df, table, args)
+    print('{} imported into the results store'.format(fpath))
+    return load_results(table, **partitions)
+
+
+def load_df_summary(args, df_alff=None, df_voi_corr=None):
+    """ loads final results (only the slice of the results store matching args, unless computed in this run) """
+    if df_alff is None:
+        df_alff = load_stored_results('alff', args)
+    if df_voi_corr is None:
+        df_voi_corr = load_stored_results('voi_corr', args)
     with open(os.path.join(proj_dir, 'postprocessing', 'df_pat.pkl'), 'rb') as f:
         df_pat = pickle.load(f)
-    df_summary = df_alff.merge(df_voi_corr).merge(df_pat)
+    df_summary = df_alff.drop(columns='input_sig', errors='ignore').merge(df_voi_corr.drop(columns='input_sig', errors='ignore')).merge(df_pat)
     return df_summary, df_alff, df_voi_corr, df_pat
 
 
@@ -928,6 +1343,7 @@ if __name__=='__main__':
     parser.add_argument('--repeated2wayANOVA', default=False, action='store_true', help="use a n_1 + n_2 + 2 columns design with session and group by session interactions (2-way ANOVA with repeated measures)")
     parser.add_argument('--paired_design', default=False, action='store_true', help="makes diagonal design matrix")
     parser.add_argument('--stim_radius', type=float, default=5., action='store', help="radius of stim site assumed, centered at stim location")
+    parser.add_argument('--stim_radii', type=float, nargs='+', default=None, action='store', help="sweep several stim site radii (e.g. 2.5 5 7.5 10) in a single pass of VOI correlations and ALFF (overrides stim_radius, stored under stim_site=individual_sphere)")
     parser.add_argument('--compute_ALFF', default=False, action='store_true', help="compute Amplitude Low Frequency Fluctuation (ALFF) and fractional ALFF (fALFF)")
     parser.add_argument('--verbose', default=False, action='store_true', help="print out more processing info")
     parser.add_argument('--compute_t_contrasts', default=False, action='store_true', help="computes T contrasts in randomise")
@@ -941,8 +1357,34 @@ if __name__=='__main__':
     parser.add_argument('--nbs_session', default=False, action='store_true', help="perform NBS on session difference rather than the default interaction")
     parser.add_argument('--nbs_thresh', type=float, default=3.5, action='store', help="NBS stat threshold")
     parser.add_argument('--nbs_paired', default=False, action='store_true', help="NBS paired t-test")
+    parser.add_argument('--nbs_atlas', type=str, default='schaefer400_tianS4', action='store', help="atlas of the connectomes used in NBS (see functional/connectome.py)")
+    parser.add_argument('--fc_deriv_dir', type=str, default=nbs_deriv_dir, action='store', help="derivatives folder containing connectomes (<subj>/<ses>/fc/*.h5)")
     parser.add_argument('--nbs_tail', type=str, default='both', action='store', help="NBS t-test tail (both, right or left); default=both")
+    parser.add_argument('--compute_dynamic_fc', default=False, action='store_true', help="compute sliding-window seed-to-voxel correlations (Harrison2009 seeds), saved as chunked HDF5")
+    parser.add_argument('--dfc_window', type=int, default=60, action='store', help="dynamic FC window length in samples (default 60, i.e. ~49s at TR=0.81s)")
+    parser.add_argument('--dfc_step', type=int, default=1, action='store', help="dynamic FC window step in samples")
+    parser.add_argument('--dfc_voi', default=False, action='store_true', help="dynamic FC between seeds and the mean timeseries of the stim site VOI only (not a windowed voi_corr; tabular output in the results store)")
+    parser.add_argument('--mem_budget_gb', type=float, default=None, action='store', help="process BOLD runs by slabs of slices within this memory budget (GB) in seed-to-voxel correlation (default: whole run in memory)")
+    parser.add_argument('--fft_filter', default=False, action='store_true', help="band-pass timeseries with the shared FFT filter bank (responses cached per run length) instead of in each nilearn masker")
+    parser.add_argument('--precision', type=str, default='float64', choices=['float64', 'float32'], action='store', help="numerical precision of BOLD, voxel timeseries, correlation maps and written images")
+    parser.add_argument('--incremental', default=False, action='store_true', help="only recompute VOI correlations and ALFF of subjects/sessions whose inputs changed since the stored results")
+    parser.add_argument('--resampling_stats', default=False, action='store_true', help="add permutation p-values and bootstrap CIs of pre-post effects to printed stats")
+    parser.add_argument('--n_resamples', type=int, default=10000, action='store', help="number of permutations/bootstrap samples for resampling stats")
+    parser.add_argument('--random_seed', type=int, default=0, action='store', help="random seed of resampling stats and permutations")
+    parser.add_argument('--voxelwise_ybocs_corr', default=False, action='store_true', help="compute voxel-wise correlation maps between pre-post FC and delta YBOCS / YBOCS dimensions")
+    parser.add_argument('--voxelwise_fwe', default=False, action='store_true', help="FWE correct voxel-wise correlation maps with max-statistic permutations (n_perm)")
+    parser.add_argument('--profile_log', type=str, default=None, action='store', help="JSONL log of stage timings and memory (default: <proj_dir>/postprocessing/profiling.jsonl, 'None' to keep records in memory)")
     args = parser.parse_args()
+    if args.stim_radii and (args.incremental or args.use_group_avg_stim_site):
+        parser.error('--stim_radii sweeps individual stim sites and does not support --incremental or --use_group_avg_stim_site')
+    if args.compute_dynamic_fc and (args.seed_type!='Harrison2009'):
+        parser.error('--compute_dynamic_fc is only implemented for Harrison2009 sphere seeds')
+    if args.compute_dynamic_fc and args.dfc_voi and args.stim_radii:
+        parser.error('--dfc_voi uses a single stim VOI radius (--stim_radius) and does not support --stim_radii')
+
+    if args.profile_log is None:
+        args.profile_log = os.path.join(proj_dir, 'postprocessing', 'profiling.jsonl')
+    profiling.configure(None if args.profile_log=='None' else args.profile_log)
 
     subjs = get_subjs(args)
 
@@ -981,6 +1423,7 @@ if __name__=='__main__':
     args.revoked=revoked
 
     # Then process data
+    df_alff = df_voi_corr = None
     if args.compute_seed_corr:
         for atlas,ses in itertools.product(atlases,seses):
                 if len(subjs)>1:
@@ -988,6 +1431,11 @@ if __name__=='__main__':
                 else:
                     seedfunc[args.seed_type](subjs.iloc[0],ses,seeds,metrics,atlases,args)
 
+    if args.compute_dynamic_fc:
+        df_lines = Parallel(n_jobs=args.n_jobs)(delayed(compute_dynamic_fc)(subj,ses,seeds,metrics,atlases,args) for subj,ses in itertools.product(subjs,seses))
+        if args.dfc_voi and args.save_outputs:
+            store_results(pd.DataFrame(itertools.chain(*df_lines)), 'dfc_voi', args)
+
     if args.unzip_corr_maps:
         unzip_correlation_maps(subjs, seses, metrics, atlases, seeds, args)
 
@@ -995,39 +1443,34 @@ if __name__=='__main__':
         in_fnames = merge_LR_hemis(subjs, subrois, seses, metrics, seed_type=str(seedfunc[args.seed_type]), args=args)
 
     if args.compute_voi_corr:
-        df_voi_corr = compute_voi_corr(subjs, seeds=subrois, args=args)
-        print_voi_stats(df_voi_corr, seeds=subrois, args=args)
-        plot_voi_corr(df_voi_corr, seeds=subrois, args=args)
+        df_prev = load_prev_results('voi_corr', args) if args.incremental else None
+        df_voi_corr = compute_voi_corr(subjs, seeds=subrois, args=args, df_prev=df_prev)
+        for df_radius,args_radius in iter_stim_radii(df_voi_corr, args):
+            print_voi_stats(df_radius, seeds=subrois, args=args_radius)
+            plot_voi_corr(df_radius, seeds=subrois, args=args_radius)
 
         if args.save_outputs:
-            save_suffix = '_'.join([args.metrics[0],args.seed_type,args.fwhm])
-            if args.unilateral_seed:
-                save_suffix += '_unilateral'
-            else:
-                save_suffix += '_bilateral'
-            if not args.use_group_avg_stim_site:
-                save_suffix += '_indStimSite_{}mm_diameter'.format(int(args.stim_radius*2))
-            with open(os.path.join(proj_dir, 'postprocessing', 'df_voi_corr_'+save_suffix+'.pkl'), 'wb') as f:
-                pickle.dump(df_voi_corr,f)
+            updated = get_updated_subjs(df_voi_corr, df_prev, ['subj', 'ses', 'atlas', 'pathway'])
+            store_results(df_voi_corr[df_voi_corr['subj'].isin(updated)], 'voi_corr', args)
+            prune_store(df_voi_corr, 'voi_corr', subjs, args)
 
     
     if args.compute_ALFF:
+        df_prev = load_prev_results('alff', args) if args.incremental else None
         if len(subjs) > 1:
-            df_lines = Parallel(n_jobs=args.n_jobs, verbose=1)(delayed(compute_ALFF)(subj,args) for subj in subjs)
+            df_lines = Parallel(n_jobs=args.n_jobs, verbose=1)(delayed(compute_ALFF)(subj,args,df_prev) for subj in subjs)
             df_lines = itertools.chain(*df_lines)
         else:
-            df_lines = compute_ALFF(subjs[0], args)
-        df_alff = pd.DataFrame(df_lines)
-        df_summary = pd.merge(df_alff, df_groups)
+            df_lines = compute_ALFF(subjs[0], args, df_prev)
+        df_alff = pd.merge(pd.DataFrame(df_lines), get_df_groups())
         if args.plot_figs:
-            plot_ALFF(df_summary, args)
+            for df_radius,args_radius in iter_stim_radii(df_alff, args):
+                plot_ALFF(df_radius, args_radius)
 
         if args.save_outputs:
-            save_suffix = '_'.join([args.metrics[0],args.seed_type,args.fwhm])
-            if not args.use_group_avg_stim_site:
-                save_suffix += '_indStimSite_{}mm_diameter'.format(int(args.stim_radius*2))
-            with open(os.path.join(proj_dir, 'postprocessing', 'df_alff_'+save_suffix+'.pkl'), 'wb') as f:
-                pickle.dump(df_summary,f)
+            updated = get_updated_subjs(df_alff, df_prev, ['subj', 'ses'])
+            store_results(df_alff[df_alff['subj'].isin(updated)], 'alff', args)
+            prune_store(df_alff, 'alff', subjs, args)
 
     if args.compute_nbs:
         out_nbs = compute_nbs(subjs, args)
@@ -1042,15 +1485,20 @@ if __name__=='__main__':
             save_suffix += '_{}_tail_{}perms'.format(args.nbs_tail, args.n_perm)
             today = datetime.now().strftime("%Y%m%d")
             save_suffix += '_'+today
-            with open(os.path.join(proj_dir, 'postprocessing', 'nbs'+save_suffix+'.pkl'), 'wb') as f:
-                pickle.dump(out_nbs,f)
+            save_arrays('nbs'+save_suffix, dict(zip(['pvals', 'adj', 'null'], out_nbs)), subdir='nbs')
+
+    df_summary, df_alff, df_voi_corr, df_pat = load_df_summary(args, df_alff=df_alff, df_voi_corr=df_voi_corr)
+
+    for df_radius,args_radius in iter_stim_radii(df_summary, args):
+        if args.plot_pointplot:
+            # plotting
+            plot_pointplot(df_radius, args_radius)
 
-    df_summary, df_alff, df_voi_corr, df_pat = load_df_summary(args)
+        # stats
+        if args.print_stats:
+            print_stats(df_radius, args_radius)
 
-    if args.plot_pointplot:
-        # plotting
-        plot_pointplot(df_summary, args)
+    if args.voxelwise_ybocs_corr:
+        compute_voxelwise_ybocs_corr(subjs, subrois, df_pat, args)
 
-    # stats
-    if args.print_stats:
-        print_stats(df_summary, args)
+    profiling.print_summary()
@@ -0,0 +1,114 @@
+# Stimulation site spheres of several radii extracted in a single pass
+# Author: Sebastien Naze
+# QIMR Berghofer 2021-2022
+#
+# Voxels around the stim site are sorted by distance to its center, so that the sphere of each
+# radius is a prefix of the same index array (nested spheres). Averages over all radii are then
+# read from one cumulative sum over the sorted voxels of an image loaded once.
+#
+# Density maps of stim sites (fraction of patients whose stim sphere contains each voxel) are
+# built in one pass from the array of stim coordinates: sphere memberships of all patients are the
+# pairs (stim site, voxel) within the radius, found with KD-trees, and counted per group.
+
+import nibabel as nib
+import numpy as np
+
+from OCD_clinical_trial.utils.cohort import get_stim_coords, stim_coords_xls_fname
+
+
+def get_subj_stim_center(subj):
+    """ MNI coordinates (mm) of a subject's stim site, None if not in the coordinates file """
+    stim_coords = get_stim_coords()
+    l = stim_coords[stim_coords['subjs']==subj]
+    if l.empty:
+        print(subj+' not in file '+stim_coords_xls_fname)
+        return None
+    return np.array([l['x'], l['y'], l['z']], dtype=float).flatten()
+
+
+def get_nested_spheres(center, ref_img, radii):
+    """ voxels of ref_img's grid sorted by distance to center (mm) and number of voxels within each radius
+        outputs:
+            idx: flat indices (in the 3D grid) of voxels within max(radii), sorted by distance
+            counts: sphere of radius radii[i] is idx[:counts[i]] (at least the nearest voxel, as in NiftiSpheresMasker)
+    """
+    affine, shape = ref_img.affine, ref_img.shape[:3]
+    vox_size = np.sqrt((affine[:3,:3]**2).sum(axis=0))
+    c = nib.affines.apply_affine(np.linalg.inv(affine), center)
+    r = np.max(radii)/vox_size
+    lo = np.maximum(np.floor(c-r), 0).astype(int)
+    hi = np.minimum(np.ceil(c+r)+1, shape).astype(int)
+    ijk = np.stack(np.meshgrid(*[np.arange(l,h) for l,h in zip(lo,hi)], indexing='ij'), axis=-1).reshape(-1,3)
+    dists = np.linalg.norm(nib.affines.apply_affine(affine, ijk) - center, axis=1)
+    order = np.argsort(dists, kind='stable')
+    dists, ijk = dists[order], ijk[order]
+    n_max = max(np.searchsorted(dists, np.max(radii), side='right'), min(1, len(dists)))
+    idx = np.ravel_multi_index(ijk[:n_max].T, shape)
+    counts = np.maximum(np.searchsorted(dists[:n_max], radii, side='right'), min(1, n_max))
+    return idx, counts
+
+
+def sphere_means(values, idx, counts, exclude_zeros=False):
+    """ average of values (..., voxels) within each nested sphere -> (..., n_radii)
+        exclude_zeros: ignore zero values (e.g. outside brain in correlation maps) """
+    X = values[..., idx]
+    cs = np.cumsum(X, axis=-1)
+    n = np.cumsum(X!=0, axis=-1) if exclude_zeros else np.broadcast_to(np.arange(1, X.shape[-1]+1), X.shape)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return cs[..., counts-1] / n[..., counts-1]
+
+
+def sphere_timeseries(img, center, radii, smoothing_fwhm=None, t_r=0.81, low_pass=0.25, clean=None):
+    """ mean timeseries of nested spheres around center in a 4D image (same processing as NiftiSpheresMasker)
+        clean: temporal filtering function with signal.clean's arguments (default: signal.clean)
+        outputs:
+            ts: (time x n_radii) array
+    """
+    from nilearn.image import load_img, smooth_img
+
+    if clean is None:
+        from nilearn.signal import clean
+    img = load_img(img)
+    if smoothing_fwhm is not None:
+        img = smooth_img(img, smoothing_fwhm)
+    idx, counts = get_nested_spheres(center, img, radii)
+    data = np.asarray(img.dataobj).reshape(-1, img.shape[-1]) # voxels x time
+    ts = sphere_means(data[idx].T, np.arange(len(idx)), counts)
+    return clean(ts, t_r=t_r, low_pass=low_pass, detrend=False, standardize=False)
+
+
+def stim_density_maps(centers, radius, ref_img=None, groups=None):
+    """ count and fraction of stim spheres containing each voxel, for all sites and per group
+        inputs:
+            centers: (n x 3) MNI coordinates (mm) of stim sites
+            radius: sphere radius (mm)
+            ref_img: grid and mask of the maps (default: MNI152 2mm brain mask)
+            groups: (n,) group of each site (optional)
+        outputs:
+            dict of {'count': img, 'mean': img} for 'all' sites and for each group
+    """
+    from scipy.spatial import cKDTree
+
+    if ref_img is None:
+        from nilearn.datasets import load_mni152_brain_mask
+        ref_img = load_mni152_brain_mask(resolution=2)
+    centers = np.asarray(centers, dtype=float).reshape(-1,3)
+    shape, affine = ref_img.shape[:3], ref_img.affine
+
+    # candidate voxels: in mask and in the bounding box of all spheres
+    ijk = np.argwhere(np.asarray(ref_img.dataobj)!=0)
+    xyz = nib.affines.apply_affine(affine, ijk)
+    in_box = ((xyz >= centers.min(axis=0)-radius) & (xyz <= centers.max(axis=0)+radius)).all(axis=1)
+    ijk, xyz = ijk[in_box], xyz[in_box]
+    pairs = cKDTree(centers).sparse_distance_matrix(cKDTree(xyz), radius, output_type='ndarray')
+    flat = np.ravel_multi_index(ijk.T, shape)
+
+    groups = np.full(len(centers), 'all') if groups is None else np.asarray(groups)
+    sets = [('all', np.ones(len(centers), dtype=bool))] + [(grp, groups==grp) for grp in np.unique(groups) if grp!='all']
+    maps = dict()
+    for name,in_set in sets:
+        counts = np.zeros(int(np.prod(shape)))
+        counts[flat] = np.bincount(pairs['j'][in_set[pairs['i']]], minlength=len(flat))
+        counts = counts.reshape(shape)
+        maps[name] = {'count': nib.Nifti1Image(counts, affine), 'mean': nib.Nifti1Image(counts/max(in_set.sum(),1), affine)}
+    return maps
@@ -0,0 +1,70 @@
+# Voxel-wise brain-behaviour correlations (e.g. pre-post seed-to-voxel FC vs. delta YBOCS)
+# Author: Sebastien Naze
+# QIMR Berghofer 2021-2022
+#
+# Correlations of all behaviours with all voxels are computed as a single product of standardised
+# (subjects x behaviours) and (subjects x voxels) matrices. Family-wise error correction uses the
+# max-statistic: the null distribution of max_voxels |r| is built by permuting subjects of the
+# behaviour matrix, each chunk of permutations being one matrix product.
+
+from joblib import Parallel, delayed
+import numpy as np
+import scipy.stats
+
+
+def standardize(X):
+    """ z-score columns of X (subjects x features), constant columns are set to 0 """
+    X = np.asarray(X, dtype=float)
+    sd = X.std(axis=0)
+    sd[sd==0] = np.inf
+    return (X - X.mean(axis=0)) / sd
+
+
+def corr_pvals(r, n):
+    """ two-sided parametric p-values of Pearson correlations from n subjects """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = r * np.sqrt((n-2) / (1. - r**2))
+    return 2*scipy.stats.t.sf(np.abs(t), n-2)
+
+
+def max_stat_chunk(seed, n_perm, Zx, Zy):
+    """ max |r| over voxels for a chunk of permutations of the behaviours -> (n_perm, n_behaviours) """
+    rng = np.random.default_rng(seed)
+    n, k = Zx.shape
+    perms = rng.permuted(np.tile(np.arange(n), (n_perm,1)), axis=1)
+    Zx_perm = Zx[perms].transpose(1,0,2).reshape(n, n_perm*k) # subjects x (permutations*behaviours)
+    r_perm = Zy.T @ Zx_perm / n                                # voxels x (permutations*behaviours)
+    return np.abs(r_perm).max(axis=0).reshape(n_perm, k)
+
+
+def voxelwise_corr(Y, X, n_perm=0, seed=0, chunk_size=20, n_jobs=1):
+    """ Correlate every behaviour with every voxel across subjects
+        inputs:
+            Y: (subjects x voxels) array, e.g. masked pre-post FC maps
+            X: (subjects x behaviours) array, e.g. delta YBOCS and YBOCS dimensions
+            n_perm: number of permutations for max-statistic FWE correction (0: no correction)
+            seed: random seed of permutations
+            chunk_size: number of permutations per matrix product
+            n_jobs: number of parallel processes over chunks of permutations
+        outputs:
+            r: (behaviours x voxels) Pearson correlations
+            p: (behaviours x voxels) uncorrected two-sided p-values
+            p_fwe: (behaviours x voxels) FWE corrected p-values (None if n_perm=0)
+    """
+    n = Y.shape[0]
+    Zx, Zy = standardize(X), standardize(Y)
+    r = (Zx.T @ Zy) / n
+    p = corr_pvals(r, n)
+    if not n_perm:
+        return r, p, None
+
+    n_chunks = int(np.ceil(n_perm/chunk_size))
+    sizes = [min(chunk_size, n_perm-i*chunk_size) for i in range(n_chunks)]
+    seeds = np.random.SeedSequence(seed).spawn(n_chunks)
+    null = Parallel(n_jobs=n_jobs)(delayed(max_stat_chunk)(s, b, Zx, Zy) for s,b in zip(seeds, sizes))
+    null = np.sort(np.concatenate(null, axis=0), axis=0) # permutations x behaviours
+    p_fwe = np.empty_like(r)
+    for i in range(r.shape[0]):
+        n_greater = n_perm - np.searchsorted(null[:,i], np.abs(r[i])*(1-1e-12), side='left')
+        p_fwe[i] = (1. + n_greater) / (1. + n_perm)
+    return r, p, p_fwe
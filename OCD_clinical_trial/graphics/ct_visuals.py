@@ -4,48 +4,31 @@
 
 import argparse
 from argparse import Namespace
-import bct
 from datetime import datetime
-import h5py
-import importlib
-from itkwidgets import view
-import itertools
-import joblib
-from joblib import Parallel, delayed
-import json
-import matplotlib
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
+import hashlib
 import nibabel as nib
 import nilearn
+import nilearn.surface
 from nilearn.image import load_img
-from nilearn.plotting import plot_matrix, plot_glass_brain, plot_stat_map, plot_img_comparison
-from nilearn.input_data import NiftiMasker, NiftiLabelsMasker
 import numpy as np
 import os
 import pandas as pd
 import pdb
 import pickle
 import pyvista as pv
-from pyvista import examples
-import scipy
-from scipy.io import loadmat
-import seaborn as sbn
-import sklearn
-from sklearn.decomposition import PCA
 import sys
-import time
 from time import time
 import warnings
 
 # paths
-proj_dir = '/home/sebastin/working/lab_lucac/sebastiN/projects/OCD_clinical_trial'
+from OCD_clinical_trial.utils.config import proj_dir
 code_dir = os.path.join(proj_dir, 'code')
 deriv_dir = os.path.join(proj_dir, 'data/derivatives')
 atlas_dir = os.path.join(proj_dir, 'utils')
 fs_dir = '/usr/local/freesurfer/'
 
-from OCD_clinical_trial.functional.seed_to_voxel_analysis import get_group, stim_coords
+from OCD_clinical_trial.graphics import surfaces
+from OCD_clinical_trial.utils.cohort import get_group, get_stim_coords
 
 # uncomment in case of using freesurfer surfaces
 #coords, faces, info, stamp = nib.freesurfer.io.read_geometry(os.path.join(fs_dir, 'subjects', 'fsaverage4', 'surf', 'lh.white'), read_metadata=True, read_stamp=True)
@@ -103,63 +86,42 @@ pointplot_ylim = {  'Harrison2009': {'corr': [-1,1], 'fALFF':[0.0,0.03]},
 tail_colors = {'left':'firebrick', 'right':'dodgerblue'}
 
 # Additionally, all the modules other than ipygany and pythreejs require a framebuffer, which can be setup on a headless environment with pyvista.start_xvfb().
-pv.start_xvfb()
+# (render workers inherit the display of the parent process)
+if os.environ.get('DISPLAY') is None:
+    pv.start_xvfb()
 
-def create_stim_site_voi(stim_radius=5., args=None):
-    """  create niftii image of stimuus locations of all subjects using a sphere of radius stim_radius mm """
-    #xls_fname = 'MNI_coordinates_FINAL.xlsx'
-    #stim_coords = pd.read_excel(os.path.join(proj_dir, 'data', xls_fname), usecols=['P ID', 'x', 'y', 'z'])
-    # now global... not needed
-
-    stim_sites = []
-    for i,stim in stim_coords.iterrows():
-        x,y,z = stim['x'], stim['y'], stim['z']
-        stim_sites.append(nltools.create_sphere([x,y,z], radius=stim_radius))
+cam_pos = {'front':[-3, 2, -1], 'medial':[1,1,-0.3]}
 
-    mean_stim_sites = mean_img(stim_sites)
+def create_stim_site_voi(stim_radius=5., args=None):
+    """  create niftii image of stimuus locations of all subjects using a sphere of radius stim_radius mm
+         (fraction of subjects whose sphere contains each voxel), and of each group """
+    from OCD_clinical_trial.functional.stim_site import stim_density_maps
+
+    stim_coords = get_stim_coords()
+    groups = [get_group(subj) for subj in stim_coords['subjs']]
+    maps = stim_density_maps(np.array(stim_coords[['x','y','z']], dtype=float), stim_radius, groups=groups)
+    mean_stim_sites = maps['all']['mean']
     if args.save_outputs:
         nib.save(mean_stim_sites, os.path.join(proj_dir, 'utils', 'stim_VOI_'+str(stim_radius)+'mm.nii.gz'))
+        for grp in group_colors.keys():
+            if grp in maps:
+                nib.save(maps[grp]['mean'], os.path.join(proj_dir, 'utils', 'stim_VOI_'+str(stim_radius)+'mm_'+grp+'.nii.gz'))
     return mean_stim_sites
 
-def get_brainnet_surf(surf_name):
-    """ Import brain net viewer surface into pyvista polyData type """
-    brainnet_path = '/home/sebastin/Downloads/BrainNetViewer/BrainNet-Viewer/Data/SurfTemplate/'
-    fname = os.path.join(brainnet_path, surf_name+'.nv')
-    with open(fname, 'r') as f:
-        n_vertices = int(f.readline())
-
-    icbm_txt = pd.read_csv(fname, sep=' ', header=None, index_col=False, skiprows=[0,n_vertices+1])
-    coords = np.array(icbm_txt.iloc[:n_vertices])
-    faces = np.array(icbm_txt.iloc[n_vertices:], dtype=int) - 1
-
-    nfaces, fdim = faces.shape
-    c = np.ones((nfaces,1))*fdim
-    icbm_surf = pv.PolyData(coords, np.hstack([c,faces]).astype(int))
-    return icbm_surf, coords, faces
-
-
 def volume_to_surface(vol_img, coords, faces, radius=5.):
-    """ project volume niftii image to cortical surface mesh """
-    left_surf = nilearn.surface.vol_to_surf(img=vol_img, surf_mesh=[coords.left, faces.left], radius=radius, interpolation='linear')
-    right_surf = nilearn.surface.vol_to_surf(img=vol_img, surf_mesh=[coords.right, faces.right], radius=radius, interpolation='linear')
-    both_surf = nilearn.surface.vol_to_surf(img=vol_img, surf_mesh=[coords.both, faces.both], radius=radius, interpolation='linear')
+    """ project volume niftii image to cortical surface mesh (cached sparse projections of each mesh) """
+    left_surf = surfaces.vol_to_surf(vol_img, coords.left, faces.left, radius=radius, interpolation='linear')
+    right_surf = surfaces.vol_to_surf(vol_img, coords.right, faces.right, radius=radius, interpolation='linear')
+    if surfaces.is_concatenation(coords.both, coords.left, coords.right):
+        both_surf = np.concatenate([left_surf, right_surf])
+    else:
+        both_surf = surfaces.vol_to_surf(vol_img, coords.both, faces.both, radius=radius, interpolation='linear')
     return Namespace(**{'left':left_surf, 'right':right_surf, 'both':both_surf})
 
 
 def get_icbm_surf(args):
     """ imports ICBM152 surfaces into Namespace """
-    if args.smoothed_surface:
-        icbm_left, coords_left, faces_left = get_brainnet_surf('BrainMesh_ICBM152Left_smoothed')
-        icbm_right, coords_right, faces_right = get_brainnet_surf('BrainMesh_ICBM152Right_smoothed')
-        icbm_both, coords_both, faces_both = get_brainnet_surf('BrainMesh_ICBM152_smoothed')
-    else:
-        icbm_left, coords_left, faces_left = get_brainnet_surf('BrainMesh_ICBM152Left')
-        icbm_right, coords_right, faces_right = get_brainnet_surf('BrainMesh_ICBM152Right')
-        icbm_both, coords_both, faces_both = get_brainnet_surf('BrainMesh_ICBM152')
-    coords = Namespace(**{'left':coords_left, 'right':coords_right, 'both':coords_both})
-    faces = Namespace(**{'left':faces_left, 'right':faces_right, 'both':faces_both})
-    surfs = Namespace(**{'left':icbm_left, 'right':icbm_right, 'both':icbm_both})
-    return surfs, coords, faces
+    return surfaces.get_icbm_surf(smoothed=args.smoothed_surface)
 
 
 def project_surface(template, img, name):
@@ -172,53 +134,37 @@ def project_surface(template, img, name):
     template.both.point_data[name] = img.both
 
 
-def plot_surface(surfs, stim_spheres, roi_spheres, names=imgs_info.keys(), args=None):
-    """  """
-    cam_pos = {'front':[-3, 2, -1], 'medial':[1,1,-0.3]}
+def add_surface_layers(pl, surfs, names):
+    """ add right and left hemisphere meshes of each image layer to plotter, sharing the surface geometry across layers """
+    for img_name in names:
+        img_info = imgs_info[img_name]
+        for surf in [surfs.right, surfs.left]:
+            mesh = surf.copy(deep=False) # only the active scalars differ between layers
+            pl.add_mesh(mesh, scalars=img_name, cmap=img_info['cmap'], smooth_shading=True, opacity=img_info['opacity'], clim=img_info['clim'],
+                        nan_color='white', nan_opacity=img_info['nan_opacity'], interpolate_before_map=False, show_scalar_bar=True)
+
 
+def add_spheres(pl, spheres):
+    """ add spheres (list of dicts with 'sphere' mesh and 'color') to plotter """
+    for s in spheres:
+        pl.add_mesh(s['sphere'], color=s['color'])
+
+
+def plot_surface(surfs, stim_spheres, roi_spheres, names=imgs_info.keys(), args=None):
+    """ plot image layers of names on ICBM surfaces with stim sites and ROI spheres, save as PDF and show interactively """
     # Plot
     pl = pv.Plotter(window_size=[800, 600], shape=(1,1), border=False)
     pl.set_plot_theme = 'document'
 
-    # between-group row
-    """pl.subplot(0,0)
-    for img_name, img_info in imgs_info.items():
-        pl.add_mesh(surfs.left.copy(), scalars=img_name, cmap=img_info['cmap'], smooth_shading=True, opacity=img_info['opacity'], clim=img_info['clim'],
-                    nan_color='white', nan_opacity=1., interpolate_before_map=False, show_scalar_bar=False)
-    pl.camera_position = cam_pos['front']
-    pl.background_color = 'white'
-
-    pl.subplot(0,1)
-    for img_name, img_info in imgs_info.items():
-        pl.add_mesh(surfs.left.copy(), scalars=img_name, cmap=img_info['cmap'], smooth_shading=True, opacity=img_info['opacity'], clim=img_info['clim'],
-                    nan_color='white', nan_opacity=1., interpolate_before_map=False, show_scalar_bar=False)
-    pl.camera_position = cam_pos['medial']
-    pl.background_color = 'white' """
-
-    #pl.subplot(0,2)
-    for img_name in names:
-        img_info = imgs_info[img_name]
-        pl.add_mesh(surfs.right.copy(), scalars=img_name, cmap=img_info['cmap'], smooth_shading=True, opacity=img_info['opacity'], clim=img_info['clim'],
-                    nan_color='white', nan_opacity=img_info['nan_opacity'], interpolate_before_map=False, show_scalar_bar=True)
-        pl.add_mesh(surfs.left.copy(), scalars=img_name, cmap=img_info['cmap'], smooth_shading=True, opacity=img_info['opacity'], clim=img_info['clim'],
-                    nan_color='white', nan_opacity=img_info['nan_opacity'], interpolate_before_map=False, show_scalar_bar=True)
+    add_surface_layers(pl, surfs, names)
     pl.camera_position = cam_pos['front']
     pl.background_color = 'white'
 
     if args.show_stim_balls:
-        for s in stim_spheres:
-            pl.add_mesh(s['sphere'], color=s['color'])
+        add_spheres(pl, stim_spheres)
 
     if args.show_roi_degree:
-        for s in roi_spheres:
-            pl.add_mesh(s['sphere'], color=s['color'])
-
-    """pl.subplot(0,3)
-    for img_name, img_info in imgs_info.items():
-        pl.add_mesh(surfs.right.copy(), scalars=img_name, cmap=img_info['cmap'], smooth_shading=True, opacity=img_info['opacity'], clim=img_info['clim'],
-                    nan_color='white', nan_opacity=1., interpolate_before_map=True, show_scalar_bar=False)
-    pl.camera_position = cam_pos['medial']
-    pl.background_color = 'white'"""
+        add_spheres(pl, roi_spheres)
 
     fname = '_'.join(names)+'_'+datetime.now().strftime('%d%m%Y')+'.pdf'
     pl.save_graphic(os.path.join(proj_dir, 'img', fname))
@@ -227,28 +173,134 @@ def plot_surface(surfs, stim_spheres, roi_spheres, names=imgs_info.keys(), args=
     pl.deep_clean()
 
 
+def prepare_surfaces(names, args):
+    """ ICBM surfaces with the images of names projected as point data """
+    surfs, coords, faces = get_icbm_surf(args)
+    for img_name in names:
+        img_surfs = volume_to_surface(load_img(imgs_info[img_name]['path']), coords, faces)
+        project_surface(surfs, img_surfs, name=img_name)
+    return surfs
+
+
+# surfaces, stim and ROI spheres of a render worker, prepared once per process and reused by its jobs
+_render_data = dict()
+
+def get_render_data(names, args):
+    """ surfaces with layers of names (projected once per process), stim spheres (per radius and scaling) and ROI spheres """
+    if 'surfs' not in _render_data:
+        _render_data['surfs'], _render_data['coords'], _render_data['faces'] = get_icbm_surf(args)
+        _render_data['names'] = set()
+    for img_name in names:
+        if img_name not in _render_data['names']:
+            img_surfs = volume_to_surface(load_img(imgs_info[img_name]['path']), _render_data['coords'], _render_data['faces'])
+            project_surface(_render_data['surfs'], img_surfs, name=img_name)
+            _render_data['names'].add(img_name)
+    stim_key = ('stim_spheres', args.stim_balls_radius, args.stim_balls_scaling)
+    if args.show_stim_balls and (stim_key not in _render_data):
+        _render_data[stim_key] = get_stim_spheres(args)
+    if args.show_roi_degree and ('roi_spheres' not in _render_data):
+        _render_data['roi_spheres'] = get_roi_spheres(args)
+    return _render_data
+
+
+def get_job_options(job, args):
+    """ args with the options overridden by a render job """
+    job_args = Namespace(**vars(args))
+    for opt in ['show_stim_balls', 'show_roi_degree', 'stim_balls_radius', 'stim_balls_scaling']:
+        if opt in job:
+            setattr(job_args, opt, job[opt])
+    return job_args
+
+
+def get_job_fname(job, args):
+    """ output file name of a render job (without extension): its fname, or layers, camera and spheres options and date """
+    if 'fname' in job:
+        return job['fname']
+    job_args = get_job_options(job, args)
+    camera = job.get('camera', 'front')
+    if not isinstance(camera, str):
+        camera = 'cam'+hashlib.sha1(str(camera).encode()).hexdigest()[:8]
+    parts = list(job['names'])+[camera]
+    if job_args.show_stim_balls:
+        parts.append('stim{}mm-{}'.format(job_args.stim_balls_radius, job_args.stim_balls_scaling))
+    if job_args.show_roi_degree:
+        parts.append('roi')
+    return '_'.join(parts+[datetime.now().strftime('%d%m%Y')])
+
+
+def render_job(job, args):
+    """ render a figure offscreen
+        job: dict with
+            names: image layers (keys of imgs_info)
+            camera: 'front', 'medial' or pyvista camera position (default: 'front')
+            show_stim_balls, show_roi_degree, stim_balls_radius, stim_balls_scaling: override args (optional)
+            fname: output file name without extension (default: layers, camera, spheres options and date, see get_job_fname)
+            formats: list of 'png' and/or 'pdf' (default: ['png'])
+            window_size: (default: [800, 600])
+        outputs:
+            paths of saved figures
+    """
+    job_args = get_job_options(job, args)
+    data = get_render_data(job['names'], job_args)
+
+    pl = pv.Plotter(off_screen=True, window_size=job.get('window_size', [800, 600]), border=False)
+    add_surface_layers(pl, data['surfs'], job['names'])
+    if job_args.show_stim_balls:
+        add_spheres(pl, data[('stim_spheres', job_args.stim_balls_radius, job_args.stim_balls_scaling)])
+    if job_args.show_roi_degree:
+        add_spheres(pl, data['roi_spheres'])
+    camera = job.get('camera', 'front')
+    pl.camera_position = cam_pos.get(camera, camera) if isinstance(camera, str) else camera
+    pl.background_color = 'white'
+
+    fname = get_job_fname(job, args)
+    fpaths = []
+    for fmt in job.get('formats', ['png']):
+        fpath = os.path.join(proj_dir, 'img', fname+'.'+fmt)
+        if fmt=='png':
+            pl.screenshot(fpath)
+        else:
+            pl.save_graphic(fpath)
+        fpaths.append(fpath)
+    pl.close()
+    return fpaths
+
+
+def render_jobs(jobs, args):
+    """ render figure jobs (see render_job) offscreen in a pool of processes """
+    from joblib import Parallel, delayed
+
+    fnames = [get_job_fname(job, args) for job in jobs]
+    duplicates = sorted(set(fname for fname in fnames if fnames.count(fname) > 1))
+    if duplicates:
+        raise ValueError("Render jobs would overwrite each other's figures, give them a unique fname: {}".format(duplicates))
+    t0 = time()
+    os.makedirs(os.path.join(proj_dir, 'img'), exist_ok=True)
+    fpaths = Parallel(n_jobs=args.n_jobs)(delayed(render_job)(job, args) for job in jobs)
+    print('{} figures rendered in {}s'.format(len(jobs), int(time()-t0)))
+    return fpaths
+
+
 def get_stim_spheres(args):
-    """ create sphere of radius given in args around the stim site for each patient, return a PyVista PolyData object """
+    """ spheres of radius given in args around the stim site of each patient, merged in one PyVista mesh per group """
+    stim_coords = get_stim_coords()
+    groups = np.array([get_group(subj) for subj in stim_coords['subjs']])
+    centers = np.array(stim_coords[['x','y','z']], dtype=float)*args.stim_balls_scaling
     stim_spheres = []
-    for i,stim in stim_coords.iterrows():
-        grp = get_group(stim['subjs'])
-        if grp != 'none':
-            s = pv.Sphere(center=np.array(stim[['x','y','z']], dtype=float)*args.stim_balls_scaling,
-                          radius=args.stim_balls_radius)
-            stim_spheres.append( {'subj':stim['subjs'], 'group':grp, 'sphere':s, 'color':group_colors[grp]} )
+    for grp in np.unique(groups[groups!='none']):
+        s = surfaces.get_sphere_glyphs(centers[groups==grp], args.stim_balls_radius)
+        stim_spheres.append( {'subjs':list(stim_coords['subjs'][groups==grp]), 'group':grp, 'sphere':s, 'color':group_colors[grp]} )
     return stim_spheres
 
 def get_roi_spheres(args):
-    """ create spheres of radius equal to the degree of the node connectivity """
+    """ spheres of radius equal to the degree of the node connectivity, merged in one PyVista mesh per tail """
     with open(os.path.join(proj_dir, 'postprocessing', 'df_atlas.pkl'), 'rb') as f:
         df_atlas = pickle.load(f)
+    centers = np.array(df_atlas['centroid'].tolist(), dtype=float)
     roi_spheres = []
-    for i,row in df_atlas.iterrows():
-        #x,y,z = row['centroid']
-        for tail in tail_colors.keys():
-            degree = row['degree_'+tail]
-            s = pv.Sphere(center=np.array(row['centroid'], dtype=float), radius=degree/3)
-            roi_spheres.append({'sphere':s, 'color':tail_colors[tail]})
+    for tail in tail_colors.keys():
+        s = surfaces.get_sphere_glyphs(centers, np.array(df_atlas['degree_'+tail], dtype=float)/3)
+        roi_spheres.append({'tail':tail, 'sphere':s, 'color':tail_colors[tail]})
     return roi_spheres
 
 
@@ -264,23 +316,20 @@ if __name__=='__main__':
     parser.add_argument('--plot_surface', default=False, action='store_true', help='plot surface mesh with stim  locations and mask')
     parser.add_argument('--smoothed_surface', default=False, action='store_true', help='use smooth cortical mesh')
     parser.add_argument('--show_roi_degree', default=False, action='store_true', help='display spheres of degree radius at roi centroids ')
+    parser.add_argument('--render_jobs', type=str, default=None, action='store', help='JSON file with a list of figure jobs (see render_job) to render offscreen')
+    parser.add_argument('--n_jobs', type=int, default=4, action='store', help='number of parallel render processes')
     args = parser.parse_args()
 
     names = ['base']
 
+    if args.render_jobs is not None:
+        import json
+        with open(args.render_jobs, 'r') as f:
+            render_jobs(json.load(f), args)
+
     if args.plot_surface:
-        # get template ICBM surfaces (left, right and both hemispheres meshes)
-        surfs, coords, faces = get_icbm_surf(args)
-
-        # create projections on surfaces
-        for img_name in names:
-            img_info = imgs_info[img_name]
-            # load image of interest
-            img = load_img(img_info['path'])
-            # project image to surface
-            img_surfs = volume_to_surface(img, coords, faces)
-            # prepare surface for rendering/plotting
-            project_surface(surfs, img_surfs, name=img_name)
+        # template ICBM surfaces (left, right and both hemispheres meshes) with images projected on them
+        surfs = prepare_surfaces(names, args)
 
         # get small balls located at stim sites
         stim_spheres = get_stim_spheres(args)
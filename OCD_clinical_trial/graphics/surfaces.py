@@ -0,0 +1,201 @@
+# BrainNet Viewer surface templates (.nv) with a binary cache
+# Author: Sebastien Naze
+# QIMR Berghofer 2021-2022
+#
+# A .nv template is a text file: number of vertices, vertices coordinates, number of faces and
+# faces (1-based vertex indices). Each template is parsed once in a single pass and its coords and
+# faces are cached as .npy files, memory-mapped on later loads. The cache is invalidated when the
+# template file changes (modification time and size).
+#
+# Volume-to-surface projections (as nilearn.surface.vol_to_surf) are linear in the volume: the
+# sampling locations and interpolation weights of a mesh in a volume grid are assembled once into
+# a sparse (vertices x voxels) matrix, cached per (mesh, grid, radius, interpolation, kind), and any
+# volume of that grid is then projected with a sparse product.
+
+from argparse import Namespace
+import hashlib
+import json
+import os
+
+import numpy as np
+import scipy.sparse
+
+brainnet_dir = '/home/sebastin/Downloads/BrainNetViewer/BrainNet-Viewer/Data/SurfTemplate/'
+cache_dirname = '.surf_cache'
+
+icbm_surf_names = {'left': 'BrainMesh_ICBM152Left', 'right': 'BrainMesh_ICBM152Right', 'both': 'BrainMesh_ICBM152'}
+
+# cached volume-to-surface projections, see get_surf_projection
+_surf_projections = dict()
+
+
+def read_nv(fpath):
+    """ parse a BrainNet .nv surface in one pass, returns coords (vertices x 3) and 0-based faces (faces x 3) """
+    import pandas as pd
+
+    with open(fpath, 'r') as f:
+        n_vertices = int(f.readline())
+        values = pd.read_csv(f, sep=' ', header=None, names=[0,1,2], dtype=float, index_col=False).to_numpy()
+    coords = np.ascontiguousarray(values[:n_vertices])
+    n_faces = int(values[n_vertices,0])
+    faces = values[n_vertices+1:n_vertices+1+n_faces].astype(np.int64) - 1
+    return coords, faces
+
+
+def get_sig(fpath):
+    """ signature of a template file (modification time and size) """
+    st = os.stat(fpath)
+    return '{}-{}'.format(st.st_mtime_ns, st.st_size)
+
+
+def load_mesh(surf_name, surf_dir=None, cache_dir=None):
+    """ coords and faces of a BrainNet template, memory-mapped from the binary cache (built on first load)
+        inputs:
+            surf_name: template name without extension, e.g. BrainMesh_ICBM152Left_smoothed
+            surf_dir: folder of .nv templates (default: brainnet_dir)
+            cache_dir: cache folder (default: hidden folder next to the templates)
+    """
+    surf_dir = brainnet_dir if surf_dir is None else surf_dir
+    cache_dir = os.path.join(surf_dir, cache_dirname) if cache_dir is None else cache_dir
+    fpath = os.path.join(surf_dir, surf_name+'.nv')
+    sig = get_sig(fpath)
+    sig_fpath = os.path.join(cache_dir, surf_name+'.json')
+    coords_fpath, faces_fpath = [os.path.join(cache_dir, surf_name+'_'+k+'.npy') for k in ['coords', 'faces']]
+
+    if os.path.exists(sig_fpath):
+        with open(sig_fpath, 'r') as f:
+            if json.load(f).get('sig')==sig:
+                return np.load(coords_fpath, mmap_mode='r'), np.load(faces_fpath, mmap_mode='r')
+
+    coords, faces = read_nv(fpath)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for arr,out_fpath in zip([coords, faces], [coords_fpath, faces_fpath]):
+            with open(out_fpath+'.tmp', 'wb') as f:
+                np.save(f, arr)
+            os.replace(out_fpath+'.tmp', out_fpath)
+        with open(sig_fpath+'.tmp', 'w') as f:
+            json.dump({'sig':sig, 'n_vertices':len(coords), 'n_faces':len(faces)}, f)
+        os.replace(sig_fpath+'.tmp', sig_fpath)
+    except OSError as e:
+        print('Could not cache surface {}: {}'.format(surf_name, e))
+    return coords, faces
+
+
+def get_brainnet_surf(surf_name, surf_dir=None, cache_dir=None):
+    """ Import brain net viewer surface into pyvista polyData type """
+    import pyvista as pv
+
+    coords, faces = load_mesh(surf_name, surf_dir=surf_dir, cache_dir=cache_dir)
+    nfaces, fdim = faces.shape
+    pv_faces = np.empty((nfaces, fdim+1), dtype=np.int64)
+    pv_faces[:,0] = fdim
+    pv_faces[:,1:] = faces
+    icbm_surf = pv.PolyData(np.asarray(coords), pv_faces.ravel())
+    return icbm_surf, coords, faces
+
+
+def get_icbm_surf(smoothed=True, surf_dir=None, cache_dir=None):
+    """ imports ICBM152 surfaces (left, right and both hemispheres) into Namespaces of pyvista surfaces, coords and faces """
+    surfs, coords, faces = dict(), dict(), dict()
+    for side,surf_name in icbm_surf_names.items():
+        surf_name = surf_name+'_smoothed' if smoothed else surf_name
+        surfs[side], coords[side], faces[side] = get_brainnet_surf(surf_name, surf_dir=surf_dir, cache_dir=cache_dir)
+    return Namespace(**surfs), Namespace(**coords), Namespace(**faces)
+
+
+def get_mesh_key(coords, faces):
+    """ hash of a mesh (coords and faces) used as key of cached projections """
+    h = hashlib.sha1()
+    for arr in [coords, faces]:
+        h.update(np.ascontiguousarray(arr).tobytes())
+    return h.hexdigest()
+
+
+def get_sample_kind(kind, interpolation):
+    """ sampling strategy of vol_to_surf: kind='auto' samples along normals ('line') with linear interpolation and in
+        balls ('ball') with nearest voxels, whatever the default of the installed nilearn version """
+    if kind=='auto':
+        return 'line' if interpolation=='linear' else 'ball'
+    return kind
+
+
+def get_surf_projection(coords, faces, ref_img, radius=3., interpolation='linear', kind='auto', n_points=None):
+    """ sparse (vertices x voxels) matrix projecting volumes of ref_img's grid onto a mesh (cached)
+        Same sampling as nilearn.surface.vol_to_surf: samples along normals (kind='line') or in balls (kind='ball')
+        around vertices, values of nearest voxels or trilinear interpolation, averaged over samples inside the volume.
+        outputs:
+            proj: CSR matrix (vertices x voxels of the 3D grid)
+            empty: vertices without samples inside the volume (NaN in vol_to_surf)
+    """
+    from nilearn.surface.surface import _sample_locations
+
+    kind = get_sample_kind(kind, interpolation)
+    shape, affine = tuple(ref_img.shape[:3]), np.asarray(ref_img.affine, dtype=float)
+    key = (get_mesh_key(coords, faces), shape, affine.tobytes(), radius, interpolation, kind, n_points)
+    if key in _surf_projections:
+        return _surf_projections[key]
+
+    locs = _sample_locations([np.asarray(coords), np.asarray(faces)], affine, radius=radius, kind=kind, n_points=n_points)
+    n_vertices, n_samples, _ = locs.shape
+    locs = locs.reshape(-1, 3)
+    if interpolation=='nearest':
+        locs = np.round(locs)
+    elif interpolation!='linear':
+        raise ValueError("Unknown interpolation {}, choose 'linear' or 'nearest'".format(interpolation))
+    rows = np.repeat(np.arange(n_vertices), n_samples)
+    inside = (locs >= 0).all(axis=1) & (locs < shape).all(axis=1)
+    rows, locs = rows[inside], locs[inside]
+    n_inside = np.bincount(rows, minlength=n_vertices).astype(float)
+    empty = n_inside==0
+    n_inside[empty] = 1.
+
+    if interpolation=='nearest':
+        vox = np.ravel_multi_index(locs.astype(int).T, shape)
+        weights = np.ones(len(vox))
+    else:
+        # trilinear weights of the 8 corners of the cell of each sample (last cell extended to the volume edge)
+        i0 = np.clip(np.floor(locs).astype(int), 0, np.array(shape)-2)
+        t = locs - i0
+        corners = np.array(np.meshgrid([0,1], [0,1], [0,1], indexing='ij')).reshape(3,-1).T
+        vox = np.concatenate([np.ravel_multi_index((i0+c).T, shape) for c in corners])
+        weights = np.concatenate([np.prod(np.where(c, t, 1-t), axis=1) for c in corners])
+        rows = np.tile(rows, len(corners))
+    proj = scipy.sparse.csr_matrix((weights/n_inside[rows], (rows, vox)), shape=(n_vertices, int(np.prod(shape))))
+    _surf_projections[key] = (proj, empty)
+    return proj, empty
+
+
+def vol_to_surf(img, coords, faces, radius=3., interpolation='linear', kind='auto', n_points=None):
+    """ project a 3D (or 4D) image onto a mesh with its cached projection, as nilearn.surface.vol_to_surf
+        (falls back to nilearn.surface.vol_to_surf, without cache, if nilearn's sampling cannot be imported) """
+    from nilearn.image import load_img
+
+    img = load_img(img)
+    try:
+        proj, empty = get_surf_projection(coords, faces, img, radius=radius, interpolation=interpolation, kind=kind, n_points=n_points)
+    except ImportError:
+        from nilearn import surface
+        return surface.vol_to_surf(img, [np.asarray(coords), np.asarray(faces)], radius=radius, interpolation=interpolation,
+                                   kind=get_sample_kind(kind, interpolation), n_samples=n_points)
+    data = np.asarray(img.dataobj, dtype=float).reshape(proj.shape[1], -1)
+    texture = proj @ data
+    texture[empty] = np.nan
+    return texture[:,0] if len(img.shape)==3 else texture
+
+
+def is_concatenation(coords_both, coords_left, coords_right):
+    """ whether the vertices of a whole-brain mesh are those of the left then right hemisphere meshes """
+    return (len(coords_both)==len(coords_left)+len(coords_right)) and \
+           np.array_equal(coords_both[:len(coords_left)], coords_left) and np.array_equal(coords_both[len(coords_left):], coords_right)
+
+
+def get_sphere_glyphs(centers, radii, theta_resolution=30, phi_resolution=30):
+    """ one merged pyvista mesh of spheres of given centers (n x 3) and radii (n,) by glyph instancing of a unit sphere
+        (the radius of each sphere is kept as 'radius' point data) """
+    import pyvista as pv
+
+    points = pv.PolyData(np.asarray(centers, dtype=float).reshape(-1,3))
+    points.point_data['radius'] = np.broadcast_to(np.asarray(radii, dtype=float), (points.n_points,)).copy()
+    sphere = pv.Sphere(radius=1., theta_resolution=theta_resolution, phi_resolution=phi_resolution)
+    return points.glyph(geom=sphere, scale='radius', orient=False)
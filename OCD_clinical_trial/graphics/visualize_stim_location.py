@@ -1,92 +1,127 @@
-# Script to be used in Jupyter Lab to visualize TMS stimulation sites
+# Visualization of TMS stimulation sites, from Jupyter Lab or as a script
 #
 # Author: Sebastien Naze
 #
 # QIMR Berghofer 2022
-
-# n.b.: script to be run on Lucky3
+#
+# Nothing is loaded at import: surfaces (binary cache of graphics/surfaces.py), stim coordinates
+# (cached Excel sheet of utils/cohort.py) and maps are loaded on first use and kept for the session.
+#
+# usage: python visualize_stim_location.py [--stim_radius 2] [--batch [--out_dir <dir>]] [--plot_surface]
 
 import argparse
-import bct
-import h5py
-import importlib
-from itkwidgets import view
-import itertools
-import joblib
-from joblib import Parallel, delayed
-import json
-import matplotlib
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
-import nibabel as nib
-import nilearn
-from nilearn.image import load_img, binarize_img, threshold_img, mean_img, new_img_like, math_img
-from nilearn.plotting import plot_matrix, plot_glass_brain, plot_stat_map, plot_img_comparison, plot_img, plot_roi, view_img
-from nilearn.input_data import NiftiMasker, NiftiLabelsMasker
-import nltools
-import numpy as np
+from functools import lru_cache
 import os
-import pickle
-import pandas as pd
-import pyvista as pv
-from pyvista import examples
-import scipy
-from scipy.io import loadmat
-import sklearn
-from sklearn.decomposition import PCA
-import sys
-import time
-from time import time
-import warnings
-
-
-proj_dir = '/home/sebastin/working/lab_lucac/sebastiN/OCD_clinical_trial/'
-ocd_baseline = '/home/sebastin/working/lab_lucac/sebastiN/projects/OCDbaseline'
-code_dir = os.path.join(proj_dir, 'code')
-data_dir = os.path.join(proj_dir, 'data')
-fs_dir = '/usr/local/freesurfer/'
-
-def get_brainnet_surf(surf_name):
-    """ Import brain net viewer surface into pyvista polyData type """
-    brainnet_path = '/home/sebastin/Downloads/BrainNetViewer/BrainNet-Viewer/Data/SurfTemplate/'
-    fname = os.path.join(brainnet_path, surf_name+'.nv')
-    with open(fname, 'r') as f:
-        n_vertices = int(f.readline())
-
-    icbm_txt = pd.read_csv(fname, sep=' ', header=None, index_col=False, skiprows=[0,n_vertices+1])
-    coords = np.array(icbm_txt.iloc[:n_vertices])
-    faces = np.array(icbm_txt.iloc[n_vertices:], dtype=int) - 1
-
-    nfaces, fdim = faces.shape
-    c = np.ones((nfaces,1))*fdim
-    icbm_surf = pv.PolyData(coords, np.hstack([c,faces]).astype(int))
-    return icbm_surf, coords, faces
-
-
-# import ICBM152 surfaces
-icbm_left, coords_left, faces_left = get_brainnet_surf('BrainMesh_ICBM152Left_smoothed')
-icbm_right, coords_right, faces_right = get_brainnet_surf('BrainMesh_ICBM152Right_smoothed')
-icbm_both, coords_both, faces_both = get_brainnet_surf('BrainMesh_ICBM152_smoothed')
-
-
-# import stim locations
-xls_fname = 'MNI_coordinates_FINAL.xlsx'
-stim_coords = pd.read_excel(os.path.join(proj_dir, 'data', xls_fname), usecols=['P ID', 'x', 'y', 'z'])
-
-stim_sites = []
-for i,stim in stim_coords.iterrows():
-    x,y,z = stim['x'], stim['y'], stim['z']
-    stim_sites.append(nltools.create_sphere([x,y,z], radius=2))
-
-mean_stim_sites = mean_img(stim_sites)
-
-plot_stat_map(mean_stim_sites, threshold=0, colormap='Blues', cut_coords=[8,64,-10])
-
-# display Acc-Fr fronto-striatal maps
-acc_map_img = os.path.join(proj_dir, 'utils', 'frontal_Acc_mapping.nii.gz')
-caud_map_img = os.path.join(proj_dir, 'utils', 'frontal_vPut_mapping.nii.gz')
-view_img(math_img('img1 + 2*img2', img1=acc_map_img, img2=caud_map_img), cut_coords=[8,64,-10])
-
-# display Acc-Fr fronto-striatal maps
-OFC_R_img = os.path.join(ocd_baseline, 'postprocessing/SPM/seeds_and_rois/OFC_R.nii.gz')
-plot_stat_map(OFC_R_img, cut_coords=[8,64,-10])
+
+import numpy as np
+
+from OCD_clinical_trial.utils import config
+
+cut_coords = [8,64,-10]
+
+
+@lru_cache(maxsize=None)
+def get_icbm_meshes(smoothed=True):
+    """ ICBM152 surfaces (left, right, both), shared with ct_visuals through the binary mesh cache """
+    from OCD_clinical_trial.graphics.surfaces import get_icbm_surf
+    return get_icbm_surf(smoothed=smoothed)
+
+
+@lru_cache(maxsize=None)
+def get_mean_stim_sites(stim_radius=2.):
+    """ fraction of patients whose stim sphere of stim_radius mm contains each voxel """
+    from OCD_clinical_trial.functional.stim_site import stim_density_maps
+    from OCD_clinical_trial.utils.cohort import get_stim_coords
+
+    stim_coords = get_stim_coords()
+    return stim_density_maps(np.array(stim_coords[['x','y','z']], dtype=float), stim_radius)['all']['mean']
+
+
+def plot_stim_sites(stim_radius=2., output_file=None):
+    """ stat map of stim sites density """
+    from nilearn.plotting import plot_stat_map
+    return plot_stat_map(get_mean_stim_sites(stim_radius), threshold=0, cmap='Blues', cut_coords=cut_coords, output_file=output_file)
+
+
+def view_fronto_striatal_maps(output_file=None):
+    """ interactive view of Acc (1) and vPut (2) fronto-striatal maps, saved as html if output_file is given """
+    from nilearn.image import math_img
+    from nilearn.plotting import view_img
+
+    acc_map_img = os.path.join(config.proj_dir, 'utils', 'frontal_Acc_mapping.nii.gz')
+    caud_map_img = os.path.join(config.proj_dir, 'utils', 'frontal_vPut_mapping.nii.gz')
+    view = view_img(math_img('img1 + 2*img2', img1=acc_map_img, img2=caud_map_img), cut_coords=cut_coords)
+    if output_file is not None:
+        view.save_as_html(output_file)
+    return view
+
+
+def plot_ofc_roi(output_file=None):
+    """ stat map of the right OFC ROI of the baseline project """
+    from nilearn.plotting import plot_stat_map
+
+    OFC_R_img = os.path.join(config.baseline_dir, 'postprocessing/SPM/seeds_and_rois/OFC_R.nii.gz')
+    return plot_stat_map(OFC_R_img, cut_coords=cut_coords, output_file=output_file)
+
+
+def plot_stim_sites_surface(stim_radius=2., smoothed=True, off_screen=False, output_file=None):
+    """ stim sites density projected on ICBM152 hemispheres (cached projections of graphics/surfaces.py) """
+    import pyvista as pv
+    from OCD_clinical_trial.graphics.surfaces import vol_to_surf
+
+    surfs, coords, faces = get_icbm_meshes(smoothed)
+    img = get_mean_stim_sites(stim_radius)
+    pl = pv.Plotter(off_screen=off_screen, window_size=[800, 600], border=False)
+    for side in ['left', 'right']:
+        mesh = getattr(surfs, side).copy(deep=False)
+        texture = vol_to_surf(img, getattr(coords, side), getattr(faces, side), radius=5.)
+        texture[texture==0] = np.NaN
+        mesh.point_data['stim_sites'] = texture
+        pl.add_mesh(mesh, scalars='stim_sites', cmap='Blues', nan_color='white', smooth_shading=True, show_scalar_bar=False)
+    pl.camera_position = [-3, 2, -1]
+    pl.background_color = 'white'
+    if output_file is not None:
+        pl.screenshot(output_file)
+    if not off_screen:
+        pl.show()
+    pl.close()
+
+
+def export_figures(args):
+    """ headless export of all figures to args.out_dir """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    plot_stim_sites(args.stim_radius, output_file=os.path.join(args.out_dir, 'stim_sites_{}mm.png'.format(args.stim_radius)))
+    view_fronto_striatal_maps(output_file=os.path.join(args.out_dir, 'fronto_striatal_maps.html'))
+    plot_ofc_roi(output_file=os.path.join(args.out_dir, 'OFC_R.png'))
+    if args.plot_surface:
+        plot_stim_sites_surface(args.stim_radius, smoothed=not args.unsmoothed_surface, off_screen=True,
+                                output_file=os.path.join(args.out_dir, 'stim_sites_{}mm_surface.png'.format(args.stim_radius)))
+    plt.close('all')
+    print('Figures exported to '+args.out_dir)
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stim_radius', type=float, default=2., action='store', help='radius (mm) of stim spheres in density maps')
+    parser.add_argument('--batch', default=False, action='store_true', help='headless export of figures to out_dir instead of displaying them')
+    parser.add_argument('--out_dir', type=str, default=None, action='store', help='output folder of exported figures (default: <proj_dir>/img/stim_location)')
+    parser.add_argument('--plot_surface', default=False, action='store_true', help='also plot stim sites density on ICBM152 surfaces')
+    parser.add_argument('--unsmoothed_surface', default=False, action='store_true', help='use unsmoothed cortical mesh (default: smoothed)')
+    args = parser.parse_args()
+
+    if args.batch:
+        if args.out_dir is None:
+            args.out_dir = os.path.join(config.proj_dir, 'img', 'stim_location')
+        export_figures(args)
+    else:
+        import matplotlib.pyplot as plt
+        plot_stim_sites(args.stim_radius)
+        view_fronto_striatal_maps().open_in_browser()
+        plot_ofc_roi()
+        plt.show()
+        if args.plot_surface:
+            plot_stim_sites_surface(args.stim_radius, smoothed=not args.unsmoothed_surface)
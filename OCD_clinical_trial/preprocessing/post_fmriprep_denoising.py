@@ -42,6 +42,10 @@ fmripop_path = os.path.join(working_dir, 'lab_lucac/sebastiN/fmripop/')
 sys.path.insert(0, fmripop_path)
 from post_fmriprep import parser, fmripop_check_args, fmripop_remove_confounds, fmripop_scrub_data, fmripop_smooth_data
 
+# stage timings and memory appended to the project's profiling log
+from OCD_clinical_trial.utils import profiling
+profiling.configure(os.path.join(in_dir, 'postprocessing', 'profiling.jsonl'))
+
 # define subj
 subj = sys.argv[1]
 print(subj)
@@ -101,66 +105,69 @@ for ses in ['ses-pre', 'ses-post']:
     for pl_label in pipelines:
         print('Running: '+pl_label)
         # use my own wrapper code (similar to __main__ in fmripop)
-        start_time = time.time()
-        pl = pipelines[pl_label]
-
-        # set up args obj
-        args = parser.parse_args('')
-
-        # Modify the arguments based on dict
-        args.niipath = pl['niipath']
-        args.maskpath = pl['maskpath']
-        args.tsvpath = pl['tsvpath']
-        args.add_orig_mean_img = pl['add_orig_mean_img']
-        args.confound_list = pl['confound_list']
-        args.detrend = pl['detrend']
-        args.fmw_disp_th = pl['fmw_disp_th']
-        args.fwhm = pl['fwhm']
-        args.high_pass = pl['high_pass']
-        args.low_pass = pl['low_pass']
-        args.num_confounds = pl['num_confounds']
-        args.remove_volumes = pl['remove_volumes']
-        args.scrubbing = pl['scrubbing']
-        args.tr = pl['tr']
-
-        # Set derived Parameters according to user specified parameters
-        args = fmripop_check_args(args)
-
-        # Convert to dict() for saving later
-        params_dict = vars(args)
-        params_dict['fwhm'] = args.fwhm.tolist()
-
-        # Performs main task -- removing confounds
-        out_img = fmripop_remove_confounds(args)
-
-        # Perform additional actions on data
-        if args.scrubbing:
-            out_img, params_dict = fmripop_scrub_data(out_img, args, params_dict)
-
-        if np.array(args.fwhm).sum() > 0.0:  # If fwhm is not zero, performs smoothing
-            out_img = fmripop_smooth_data(out_img, args.fwhm)
-
-        # Save output image and parameters used in this script
-        out_path = os.path.join(out_dir,subj,ses,'func/')
-        out_file = (out_path+subj+'_'+ses+'_task-'+pl['task']+'_space-'
-                    + img_space+'_desc-'+pl_label+'.nii.gz')
-        os.makedirs(out_path, exist_ok=True)
-
-        # make sure the out img has the correct header
-        out_img = new_img_like(
-            pl['niipath'], out_img.get_fdata(), copy_header=True)
-
-        # Save the clean data in a separate file
-        out_img.to_filename(out_file)
-
-        # Save the input arguments in a json file with a timestamp
-        timestamp = time.strftime("%Y-%m-%d-%H%M%S")
-        out_file = 'fmripop_'+pl_label+'_parameters.json'
-        with open(os.path.sep.join((out_path, out_file)), 'w') as file:
-            file.write(json.dumps(params_dict, indent=4, sort_keys=True))
-
-        print("--- %s seconds ---" % (time.time() - start_time))
+        with profiling.stage('denoising', verbose=True, subj=subj, ses=ses, pipeline=pl_label):
+            pl = pipelines[pl_label]
+
+            # set up args obj
+            args = parser.parse_args('')
+
+            # Modify the arguments based on dict
+            args.niipath = pl['niipath']
+            args.maskpath = pl['maskpath']
+            args.tsvpath = pl['tsvpath']
+            args.add_orig_mean_img = pl['add_orig_mean_img']
+            args.confound_list = pl['confound_list']
+            args.detrend = pl['detrend']
+            args.fmw_disp_th = pl['fmw_disp_th']
+            args.fwhm = pl['fwhm']
+            args.high_pass = pl['high_pass']
+            args.low_pass = pl['low_pass']
+            args.num_confounds = pl['num_confounds']
+            args.remove_volumes = pl['remove_volumes']
+            args.scrubbing = pl['scrubbing']
+            args.tr = pl['tr']
+
+            # Set derived Parameters according to user specified parameters
+            args = fmripop_check_args(args)
+
+            # Convert to dict() for saving later
+            params_dict = vars(args)
+            params_dict['fwhm'] = args.fwhm.tolist()
+
+            # Performs main task -- removing confounds
+            with profiling.stage('remove_confounds'):
+                out_img = fmripop_remove_confounds(args)
+
+            # Perform additional actions on data
+            if args.scrubbing:
+                with profiling.stage('scrubbing'):
+                    out_img, params_dict = fmripop_scrub_data(out_img, args, params_dict)
+
+            if np.array(args.fwhm).sum() > 0.0:  # If fwhm is not zero, performs smoothing
+                with profiling.stage('smoothing'):
+                    out_img = fmripop_smooth_data(out_img, args.fwhm)
+
+            # Save output image and parameters used in this script
+            out_path = os.path.join(out_dir,subj,ses,'func/')
+            out_file = (out_path+subj+'_'+ses+'_task-'+pl['task']+'_space-'
+                        + img_space+'_desc-'+pl_label+'.nii.gz')
+            os.makedirs(out_path, exist_ok=True)
+
+            # make sure the out img has the correct header
+            out_img = new_img_like(
+                pl['niipath'], out_img.get_fdata(), copy_header=True)
+
+            # Save the clean data in a separate file
+            with profiling.stage('save'):
+                out_img.to_filename(out_file)
+
+            # Save the input arguments in a json file with a timestamp
+            timestamp = time.strftime("%Y-%m-%d-%H%M%S")
+            out_file = 'fmripop_'+pl_label+'_parameters.json'
+            with open(os.path.sep.join((out_path, out_file)), 'w') as file:
+                file.write(json.dumps(params_dict, indent=4, sort_keys=True))
 
 print('Finished all pipelines')
+profiling.print_summary()
 
 # %%
@@ -0,0 +1,60 @@
+# Cohort tables (subjects, groups, stim coordinates), loaded on first use
+# Author: Sebastien Naze
+# QIMR Berghofer 2021-2022
+
+from functools import lru_cache
+import os
+
+import pandas as pd
+
+from OCD_clinical_trial.utils import config
+from OCD_clinical_trial.utils.xls_cache import read_excel_cached
+
+groups = ['group1', 'group2']
+group_colors = {'group1': 'orange', 'group2':'lightslategray'}
+
+stim_coords_xls_fname = 'MNI_coordinates_FINAL.xlsx'
+
+
+@lru_cache(maxsize=None)
+def get_df_groups():
+    """ subject to group assignment """
+    return pd.read_csv(os.path.join(config.proj_dir, 'data', 'groups.txt'), \
+                       sep=' ', index_col=False, dtype=str, encoding='utf-8')
+
+
+@lru_cache(maxsize=None)
+def get_subj_groups():
+    """ subject to group assignment as a dict, for fast lookups """
+    df_groups = get_df_groups()
+    return dict(zip(df_groups.subj, df_groups.group))
+
+
+@lru_cache(maxsize=None)
+def get_stim_coords():
+    """ MNI coordinates of individual stimulation sites """
+    stim_coords = read_excel_cached(os.path.join(config.proj_dir, 'data', stim_coords_xls_fname), usecols=['P ID', 'x', 'y', 'z'])
+    stim_coords['subjs'] = stim_coords['P ID'].apply(lambda x : 'sub-patient'+x[-2:])
+    return stim_coords
+
+
+def get_subjs(args):
+    """ import subjects """
+    if args.subj!=None:
+        subjs = pd.Series([args.subj])
+    else:
+        subjs = pd.read_table(os.path.join(config.proj_dir, 'code', 'patients_list.txt'), names=['name'])['name']
+    return subjs
+
+
+def get_group(subj):
+    return get_subj_groups().get(subj, 'none')
+
+
+def __getattr__(name):
+    """ lazy module-level access to cohort tables """
+    if name == 'df_groups':
+        return get_df_groups()
+    elif name == 'stim_coords':
+        return get_stim_coords()
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
@@ -0,0 +1,57 @@
+# Project paths and configuration, resolved on first use
+# Author: Sebastien Naze
+# QIMR Berghofer 2021-2022
+
+from functools import lru_cache
+import json
+import os
+import platform
+
+
+@lru_cache(maxsize=None)
+def get_working_dir():
+    """ get computer name to set paths """
+    if platform.node()=='qimr18844':
+        working_dir = '/home/sebastin/working/'
+    elif 'hpcnode' in platform.node():
+        working_dir = '/mnt/lustre/working/'
+    else:
+        print('Computer unknown! Setting working dir as /working')
+        working_dir = '/working/'
+    return working_dir
+
+
+@lru_cache(maxsize=None)
+def get_paths():
+    """ general paths of the project, the baseline project and its atlases.
+    proj_dir and baseline_dir can be overridden with the OCD_CT_PROJ_DIR and OCD_BASELINE_DIR environment variables. """
+    proj_dir = os.environ.get('OCD_CT_PROJ_DIR')
+    baseline_dir = os.environ.get('OCD_BASELINE_DIR')
+    working_dir = None
+    if (proj_dir is None) or (baseline_dir is None):
+        working_dir = get_working_dir()
+        proj_dir = proj_dir or working_dir+'lab_lucac/sebastiN/projects/OCD_clinical_trial'
+        baseline_dir = baseline_dir or working_dir+'lab_lucac/sebastiN/projects/OCDbaseline'
+    return {'working_dir': working_dir,
+            'proj_dir': proj_dir,
+            'deriv_dir': os.path.join(proj_dir, 'data/derivatives'),
+            'baseline_dir': baseline_dir,
+            'code_dir': os.path.join(baseline_dir, 'docs/code'),
+            'atlas_dir': os.path.join(baseline_dir, 'utils')}
+
+
+@lru_cache(maxsize=None)
+def get_atlas_cfg():
+    """ atlas configuration (qsirecon format) from the baseline project """
+    with open(os.path.join(get_paths()['atlas_dir'], 'atlas_config.json')) as jsf:
+        atlas_cfg = json.load(jsf)
+    return atlas_cfg
+
+
+def __getattr__(name):
+    """ module-level access to paths (e.g. `from OCD_clinical_trial.utils.config import proj_dir`) """
+    if name in get_paths():
+        return get_paths()[name]
+    elif name == 'atlas_cfg':
+        return get_atlas_cfg()
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
@@ -0,0 +1,235 @@
+# Stage-level timing and memory instrumentation of the pipeline
+# Author: Sebastien Naze
+# QIMR Berghofer 2021-2022
+#
+# A stage (context manager `stage` or decorator `profiled`) records its wall time, CPU time (user +
+# system of the process), peak resident memory and bytes read/written by the process (read/write
+# syscalls, from /proc/self/io on Linux), tagged with the subject and session when known. Nested
+# stages are named by their path, e.g. sphere_seed_to_voxel/brain_masker, and inherit the tags of
+# their enclosing stage.
+#
+# On Linux, the peak resident memory of a stage is its own: the high-water mark of the process is
+# reset at stage entry (/proc/self/clear_refs) and read at exit (VmHWM), and the peaks of nested
+# stages are carried over to their enclosing stage. Where it cannot be reset, only the peak of the
+# process so far (process_peak_rss_mb) and the change of resident memory of the stage are recorded.
+#
+# Records are appended as JSON lines to a log file shared by all processes of a run (joblib workers
+# inherit the log path and run ID through environment variables set by `configure`), and are kept
+# in memory when no log is configured. `print_summary` aggregates the records of the current run
+# per stage at the end of a CLI run, reading the log from its size when the run was configured.
+
+from contextlib import contextmanager
+from datetime import datetime
+import functools
+import inspect
+import json
+import os
+import platform
+import resource
+import sys
+from time import perf_counter, process_time
+
+log_env = 'OCD_CT_PROFILE_LOG'
+run_env = 'OCD_CT_PROFILE_RUN'
+offset_env = 'OCD_CT_PROFILE_OFFSET'
+
+# records of this process when no log file is configured
+_records = []
+# (name, tags, peak RSS of nested stages) of the stages currently open in this process
+_stack = []
+
+
+def configure(log_fpath=None, run_id=None):
+    """ set the JSONL log of this run (inherited by worker processes), returns the run ID """
+    if run_id is None:
+        run_id = '{}_{}'.format(datetime.now().strftime('%Y%m%d-%H%M%S'), os.getpid())
+    os.environ[run_env] = run_id
+    if log_fpath is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(log_fpath)), exist_ok=True)
+        os.environ[log_env] = log_fpath
+        os.environ[offset_env] = str(os.path.getsize(log_fpath) if os.path.exists(log_fpath) else 0)
+    else:
+        os.environ.pop(log_env, None)
+        os.environ.pop(offset_env, None)
+    return run_id
+
+
+def get_run_id():
+    """ ID of the current run (set by configure, or by the parent process) """
+    return os.environ.get(run_env)
+
+
+def get_io_counters():
+    """ bytes read and written by this process (None where /proc/self/io is not available) """
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def get_peak_rss_mb():
+    """ peak resident memory of this process (MB), since it started or since the last reset_peak_rss """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/1e6 if sys.platform=='darwin' else peak/1e3 # bytes on macOS, kB on Linux
+
+
+def get_status_mb(key):
+    """ memory field of /proc/self/status (e.g. VmRSS, VmHWM) in MB, None where it is not available """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(key+':'):
+                    return int(line.split()[1])/1e3 # kB
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """ reset the high-water mark of resident memory (VmHWM) to the current resident memory, False if not supported """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def write_record(record):
+    """ append a record to the log of the run (or keep it in memory) """
+    log_fpath = os.environ.get(log_env)
+    if log_fpath is None:
+        _records.append(record)
+        return
+    try:
+        with open(log_fpath, 'a') as f:
+            f.write(json.dumps(record, default=str)+'\n')
+    except OSError as e:
+        print('Could not write profiling record to {}: {}'.format(log_fpath, e))
+        _records.append(record)
+
+
+@contextmanager
+def stage(name, verbose=False, **tags):
+    """ record a stage of the pipeline
+        inputs:
+            name: stage name (prefixed by the names of enclosing stages)
+            verbose: print the stage timings when it ends
+            tags: e.g. subj, ses, seed (added to the tags of the enclosing stage)
+    """
+    parent = _stack[-1] if _stack else None
+    if parent is not None:
+        tags = dict(parent[1], **tags)
+        # peak of the enclosing stage so far, before the high-water mark is reset
+        parent[2]['peak'] = max(parent[2]['peak'], get_status_mb('VmHWM') or 0.)
+    rss0 = get_status_mb('VmRSS')
+    own_peak = (rss0 is not None) and reset_peak_rss()
+    mem = {'peak':0.}
+    _stack.append((name, tags, mem))
+    path = '/'.join(n for n,_,_ in _stack)
+    record = {'stage':path, 'run':get_run_id(), 'host':platform.node(), 'pid':os.getpid(),
+              'start':datetime.now().isoformat(timespec='seconds')}
+    record.update(tags)
+    read0, write0 = get_io_counters()
+    t0, c0 = perf_counter(), process_time()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = type(e).__name__
+        raise
+    finally:
+        _stack.pop()
+        record['wall'] = perf_counter()-t0
+        record['cpu'] = process_time()-c0
+        if rss0 is not None:
+            record['start_rss_mb'] = rss0
+            record['rss_delta_mb'] = get_status_mb('VmRSS')-rss0
+        if own_peak:
+            record['peak_rss_mb'] = max(mem['peak'], get_status_mb('VmHWM'))
+            if parent is not None:
+                parent[2]['peak'] = max(parent[2]['peak'], record['peak_rss_mb'])
+        else:
+            record['process_peak_rss_mb'] = get_peak_rss_mb()
+        read1, write1 = get_io_counters()
+        if read0 is not None:
+            record['read_mb'] = (read1-read0)/1e6
+            record['write_mb'] = (write1-write0)/1e6
+        write_record(record)
+        if verbose:
+            print('{} {}performed in {:.1f}s (cpu {:.1f}s, peak RSS {:.0f}MB)'.format(
+                  path, ''.join(str(tags[k])+' ' for k in ['subj', 'ses'] if isinstance(tags.get(k), str)),
+                  record['wall'], record['cpu'], record['peak_rss_mb'] if 'peak_rss_mb' in record else record['process_peak_rss_mb']))
+
+
+def profiled(name=None, tags=('subj', 'ses'), verbose=False):
+    """ decorator recording each call of a function as a stage, tagged with its arguments named in tags
+        (only string values, e.g. a single subject) """
+    def decorator(func):
+        signature = inspect.signature(func)
+        stage_name = func.__name__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind_partial(*args, **kwargs).arguments
+            stage_tags = dict((k, bound[k]) for k in tags if isinstance(bound.get(k), str))
+            with stage(stage_name, verbose=verbose, **stage_tags):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def load_records(log_fpath=None, run_id=None, offset=0):
+    """ DataFrame of the records of a log (default: log of the current run, or records in memory)
+        offset: position in the log file from which records are read (e.g. its size when the run was configured) """
+    import pandas as pd
+
+    log_fpath = os.environ.get(log_env) if log_fpath is None else log_fpath
+    if (log_fpath is not None) and os.path.exists(log_fpath):
+        with open(log_fpath, 'r') as f:
+            f.seek(offset)
+            records = [json.loads(line) for line in f if line.strip()]
+    else:
+        records = list(_records)
+    df = pd.DataFrame(records)
+    if (run_id is not None) and len(df):
+        df = df[df['run']==run_id]
+    return df
+
+
+def summarize(df):
+    """ per stage: number of calls, total and mean wall time, CPU utilisation, max peak RSS, total I/O """
+    import pandas as pd
+
+    if not len(df):
+        return pd.DataFrame()
+    for col in ['peak_rss_mb', 'read_mb', 'write_mb']:
+        if col not in df.columns:
+            df = df.assign(**{col:float('nan')})
+    if 'process_peak_rss_mb' in df.columns: # high-water mark could not be reset per stage
+        df = df.assign(peak_rss_mb=df['peak_rss_mb'].fillna(df['process_peak_rss_mb']))
+    summary = df.groupby('stage', sort=False).agg(n=('wall', 'size'), wall=('wall', 'sum'), mean_wall=('wall', 'mean'),
+                                                  cpu=('cpu', 'sum'), peak_rss_mb=('peak_rss_mb', 'max'),
+                                                  read_mb=('read_mb', 'sum'), write_mb=('write_mb', 'sum'))
+    summary['cpu_util'] = summary['cpu']/summary['wall']
+    return summary.sort_values('wall', ascending=False)
+
+
+def print_summary(log_fpath=None, run_id=None):
+    """ print the summary of a run (default: current run) """
+    import pandas as pd
+
+    # only the part of the current run's log written since configure
+    offset = int(os.environ.get(offset_env, 0)) if (log_fpath is None) and (run_id is None) else 0
+    run_id = get_run_id() if run_id is None else run_id
+    summary = summarize(load_records(log_fpath, run_id=run_id, offset=offset))
+    if not len(summary):
+        return summary
+    print('\n==== profiling summary (run {}) ===='.format(run_id))
+    with pd.option_context('display.width', 200, 'display.max_columns', None, 'display.float_format', '{:.2f}'.format):
+        print(summary)
+    log_fpath = os.environ.get(log_env) if log_fpath is None else log_fpath
+    if log_fpath is not None:
+        print('Profiling records in '+log_fpath)
+    return summary
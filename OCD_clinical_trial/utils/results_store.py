@@ -0,0 +1,153 @@
+# Partitioned, append-only store of analysis results (Parquet, hive partitioning)
+# Author: Sebastien Naze
+# QIMR Berghofer 2021-2022
+#
+# Layout:  <store_dir>/<table>/<key>=<value>/.../<subj>.parquet
+# Each write replaces only the files of the subjects being written, so adding subjects never
+# rewrites the rest of the table (files of subjects dropped from an analysis are deleted with
+# prune_results). Reads push filters on partition keys (and columns) down to
+# pyarrow, so that only the requested slice is loaded.
+
+import itertools
+import json
+import os
+
+import numpy as np
+
+from OCD_clinical_trial.utils import config
+
+schema_fname = '_partitions.json'
+partition_types = {'stim_radius': 'float64'}
+
+
+def get_store_dir(store_dir=None):
+    """ default store location in the project postprocessing folder """
+    if store_dir is None:
+        store_dir = os.path.join(config.proj_dir, 'postprocessing', 'results_store')
+    return store_dir
+
+
+def format_partition_value(key, value):
+    """ directory name of a partition value """
+    if partition_types.get(key) == 'float64':
+        return str(float(value))
+    return str(value)
+
+
+def get_partition_cols(table_dir):
+    """ partition keys of a table, in directory order """
+    fpath = os.path.join(table_dir, schema_fname)
+    if not os.path.exists(fpath):
+        return None
+    with open(fpath, 'r') as f:
+        return json.load(f)['partition_cols']
+
+
+def append_results(df, table, partition_cols, by='subj', store_dir=None):
+    """ Write results to the store, one file per partition and subject (existing files of these subjects are replaced)
+        inputs:
+            df: DataFrame of results, must contain the partition columns and the `by` column
+            table: name of the results table (e.g. 'voi_corr', 'alff')
+            partition_cols: ordered list of partition keys (e.g. ['metric', 'seed_type', 'fwhm', 'stim_radius'])
+            by: column defining the unit of append (one file per value)
+            store_dir: root of the store (default: postprocessing/results_store)
+    """
+    table_dir = os.path.join(get_store_dir(store_dir), table)
+    existing = get_partition_cols(table_dir)
+    if existing is None:
+        os.makedirs(table_dir, exist_ok=True)
+        with open(os.path.join(table_dir, schema_fname), 'w') as f:
+            json.dump({'partition_cols': list(partition_cols)}, f)
+    elif existing != list(partition_cols):
+        raise ValueError("Table {} is partitioned by {}, got {}".format(table, existing, partition_cols))
+
+    n_files = 0
+    for keys, df_part in df.groupby(list(partition_cols)+[by], sort=False):
+        part_dir = os.path.join(table_dir, *['{}={}'.format(k, format_partition_value(k, v)) for k,v in zip(partition_cols, keys[:-1])])
+        os.makedirs(part_dir, exist_ok=True)
+        fpath = os.path.join(part_dir, str(keys[-1])+'.parquet')
+        df_part.drop(columns=list(partition_cols)).to_parquet(fpath+'.tmp', index=False)
+        os.replace(fpath+'.tmp', fpath)
+        n_files += 1
+    print('{} rows written to {} table ({} files)'.format(len(df), table, n_files))
+
+
+def prune_results(df, table, partitions, by='subj', values=None, store_dir=None):
+    """ Remove files of a slice of a table whose `by` value has no rows in df (e.g. subjects no longer in the study),
+        so that the slice holds the results of df only
+        inputs:
+            df: DataFrame of results of the slice (partition columns of a list of values, e.g. stim radii, must be in df)
+            table: name of the results table
+            partitions: value (or list of values) of each partition key of the table
+            by: column defining the unit of append
+            values: only consider these `by` values (default: all files of the slice)
+            store_dir: root of the store
+    """
+    table_dir = os.path.join(get_store_dir(store_dir), table)
+    partition_cols = get_partition_cols(table_dir)
+    if partition_cols is None:
+        return
+    df = df.assign(**dict((k,v) for k,v in partitions.items() if k not in df.columns))
+    kept = set(tuple(format_partition_value(k, v) for k,v in zip(partition_cols+[by], keys))
+               for keys in df[partition_cols+[by]].drop_duplicates().itertuples(index=False))
+    slice_values = [partitions[k] if isinstance(partitions[k], (list, tuple, np.ndarray)) else [partitions[k]] for k in partition_cols]
+    removed = []
+    for keys in itertools.product(*[[format_partition_value(k, v) for v in vals] for k,vals in zip(partition_cols, slice_values)]):
+        part_dir = os.path.join(table_dir, *['{}={}'.format(k, v) for k,v in zip(partition_cols, keys)])
+        if not os.path.isdir(part_dir):
+            continue
+        for fname in sorted(os.listdir(part_dir)):
+            value = fname[:-len('.parquet')]
+            if (not fname.endswith('.parquet')) or ((values is not None) and (value not in values)) or (keys+(value,) in kept):
+                continue
+            os.remove(os.path.join(part_dir, fname))
+            removed.append(value)
+    if removed:
+        print('{} files removed from {} table ({})'.format(len(removed), table, ', '.join(sorted(set(removed)))))
+
+
+def load_results(table, columns=None, store_dir=None, **filters):
+    """ Load a slice of a results table
+        inputs:
+            table: name of the results table
+            columns: list of columns to load (None: all)
+            store_dir: root of the store
+            filters: equality (value) or membership (list of values) predicates, e.g. stim_radius=5, metric=['a','b']
+        outputs:
+            DataFrame with partition columns
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    table_dir = os.path.join(get_store_dir(store_dir), table)
+    partition_cols = get_partition_cols(table_dir)
+    if partition_cols is None:
+        raise FileNotFoundError("No results table {} in {}".format(table, get_store_dir(store_dir)))
+    schema = pa.schema([(k, pa.float64() if partition_types.get(k)=='float64' else pa.string()) for k in partition_cols])
+    dataset = ds.dataset(table_dir, format='parquet', partitioning=ds.partitioning(schema, flavor='hive'),
+                         exclude_invalid_files=True, ignore_prefixes=['.', '_'])
+
+    expr = None
+    for key,value in filters.items():
+        cast = float if partition_types.get(key)=='float64' else (str if key in partition_cols else (lambda x: x))
+        if isinstance(value, (list, tuple, np.ndarray)):
+            e = ds.field(key).isin([cast(v) for v in value])
+        else:
+            e = ds.field(key) == cast(value)
+        expr = e if expr is None else (expr & e)
+    return dataset.to_table(columns=columns, filter=expr).to_pandas()
+
+
+def save_arrays(name, arrays, subdir, store_dir=None):
+    """ save non-tabular outputs (e.g. NBS p-values, adjacency and null distribution) as a .npz archive """
+    out_dir = os.path.join(get_store_dir(store_dir), subdir)
+    os.makedirs(out_dir, exist_ok=True)
+    fpath = os.path.join(out_dir, name+'.npz')
+    np.savez_compressed(fpath, **arrays)
+    return fpath
+
+
+def load_arrays(name, subdir, store_dir=None):
+    """ load arrays saved with save_arrays into a dict """
+    with np.load(os.path.join(get_store_dir(store_dir), subdir, name+'.npz')) as f:
+        return dict(f)
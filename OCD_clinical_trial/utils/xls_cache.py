@@ -0,0 +1,173 @@
+# Columnar cache of the clinical Excel workbooks (P2253 master file, MNI stim coordinates)
+# Author: Sebastien Naze
+# QIMR Berghofer 2021-2022
+#
+# The cache lives next to the workbook, or in the user cache directory when the data folder is
+# read-only; if neither can be written, workbooks are read with pd.read_excel directly.
+# Files are written under unique temporary names and renamed, so that concurrent workers
+# converting the same workbook do not clash.
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+import pandas as pd
+
+cache_dirname = '.xls_cache'
+manifest_fname = 'manifest.json'
+
+
+def get_file_hash(fpath, block_size=2**20):
+    """ sha1 hash of file content """
+    h = hashlib.sha1()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def get_cache_dir(fpath, cache_dir=None):
+    """ default cache location: hidden folder next to the workbook, one subfolder per workbook """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(fpath)), cache_dirname)
+    return os.path.join(cache_dir, os.path.splitext(os.path.basename(fpath))[0])
+
+
+def get_user_cache_dir(fpath):
+    """ fallback cache location in the user cache directory (one folder per workbook location) """
+    root = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    loc = hashlib.sha1(os.path.dirname(os.path.abspath(fpath)).encode()).hexdigest()[:12]
+    return os.path.join(root, 'OCD_clinical_trial', 'xls_cache', loc)
+
+
+def get_tmp_fpath(fpath):
+    """ unique temporary file next to fpath, to be renamed to fpath once written """
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(fpath)+'.', suffix='.tmp', dir=os.path.dirname(fpath))
+    os.close(fd)
+    return tmp
+
+
+def sheet_to_fname(sheet):
+    """ file-system safe name of a sheet """
+    return re.sub('[^0-9a-zA-Z_-]+', '_', str(sheet))
+
+
+def write_table(df, fpath):
+    """ write a sheet as Parquet, falling back to pickle when the sheet cannot be typed
+    (e.g. mixed-type object columns or non-string headers). Returns the format used. """
+    tmp = get_tmp_fpath(fpath)
+    try:
+        try:
+            df.to_parquet(tmp, index=False)
+            fmt = 'parquet'
+        except (ImportError, ValueError, TypeError):
+            df.to_pickle(tmp)
+            fmt = 'pickle'
+        os.replace(tmp, fpath+'.'+fmt)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return fmt
+
+
+def read_table(fpath, fmt, usecols=None):
+    """ read a cached sheet, only loading usecols if given and stored as Parquet """
+    if fmt == 'parquet':
+        return pd.read_parquet(fpath+'.parquet', columns=usecols)
+    df = pd.read_pickle(fpath+'.pickle')
+    return df if usecols is None else df[usecols]
+
+
+def load_manifest(cache_dir):
+    fpath = os.path.join(cache_dir, manifest_fname)
+    if os.path.exists(fpath):
+        with open(fpath, 'r') as f:
+            return json.load(f)
+    return None
+
+
+def save_manifest(manifest, cache_dir):
+    fpath = os.path.join(cache_dir, manifest_fname)
+    tmp = get_tmp_fpath(fpath)
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp, fpath)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def convert_workbook(fpath, cache_dir, sha1, stat):
+    """ parse all sheets of the workbook once (slow, openpyxl) and store them as columnar tables """
+    os.makedirs(cache_dir, exist_ok=True)
+    xls = pd.read_excel(fpath, sheet_name=None)
+    sheets = dict()
+    for sheet, df in xls.items():
+        fname = sheet_to_fname(sheet)
+        sheets[sheet] = {'fname':fname, 'format':write_table(df, os.path.join(cache_dir, fname))}
+    manifest = {'source':os.path.abspath(fpath), 'mtime_ns':stat.st_mtime_ns, 'size':stat.st_size, 'sha1':sha1, 'sheets':sheets}
+    save_manifest(manifest, cache_dir)
+    return manifest
+
+
+def get_manifest(fpath, cache_dir=None):
+    """ returns an up-to-date manifest of the cached workbook, (re)converting it if needed.
+    The cache is valid if the workbook mtime and size are unchanged, or if its content hash is unchanged. """
+    cache_dir = get_cache_dir(fpath, cache_dir)
+    stat = os.stat(fpath)
+    manifest = load_manifest(cache_dir)
+    if manifest is not None:
+        if (manifest['mtime_ns']==stat.st_mtime_ns) and (manifest['size']==stat.st_size):
+            return manifest, cache_dir
+        sha1 = get_file_hash(fpath)
+        if manifest['sha1']==sha1:
+            # touched but not modified: refresh the key only
+            manifest['mtime_ns'], manifest['size'] = stat.st_mtime_ns, stat.st_size
+            save_manifest(manifest, cache_dir)
+            return manifest, cache_dir
+    else:
+        sha1 = get_file_hash(fpath)
+    print('Converting {} to columnar cache in {}'.format(os.path.basename(fpath), cache_dir))
+    return convert_workbook(fpath, cache_dir, sha1, stat), cache_dir
+
+
+def read_excel_cached(fpath, sheet_name=0, usecols=None, cache_dir=None):
+    """ Drop-in replacement of pd.read_excel reading from the columnar copy of the workbook
+        inputs:
+            fpath: path to the .xlsx workbook
+            sheet_name: sheet name or position, list of those, or None for all sheets (as in pd.read_excel)
+            usecols: list of column names to load (None loads all columns)
+            cache_dir: root of the cache (default: .xls_cache next to the workbook, or the user cache
+                       directory if the workbook folder is read-only)
+        outputs:
+            DataFrame, or dict of DataFrames if sheet_name is a list or None
+    """
+    cache_dirs = [cache_dir] if cache_dir is not None else [None, get_user_cache_dir(fpath)]
+    for cache_dir in cache_dirs:
+        try:
+            manifest, cache_dir = get_manifest(fpath, cache_dir)
+            break
+        except OSError as e:
+            if not os.path.exists(fpath):
+                raise
+            print('Cannot write columnar cache of {} ({}: {})'.format(os.path.basename(fpath), type(e).__name__, e))
+    else:
+        return pd.read_excel(fpath, sheet_name=sheet_name, usecols=usecols)
+    all_sheets = list(manifest['sheets'].keys())
+
+    def read_sheet(key):
+        sheet = all_sheets[key] if isinstance(key, int) else key
+        if sheet not in manifest['sheets']:
+            raise ValueError("Worksheet named '{}' not found in {}".format(sheet, fpath))
+        info = manifest['sheets'][sheet]
+        return key, read_table(os.path.join(cache_dir, info['fname']), info['format'], usecols=usecols)
+
+    if sheet_name is None:
+        return dict(read_sheet(sheet) for sheet in all_sheets)
+    elif isinstance(sheet_name, (list, tuple)):
+        return dict(read_sheet(sheet) for sheet in sheet_name)
+    else:
+        return read_sheet(sheet_name)[1]
@@ -24,6 +24,7 @@ import pickle
 import pingouin as pg
 import seaborn as sbn
 import scipy
+import scipy.sparse
 from scipy.io import loadmat
 import sklearn
 from sklearn.decomposition import PCA
@@ -33,6 +34,9 @@ import sys
 import time
 from time import time
 
+from OCD_clinical_trial.utils.results_store import load_results
+from OCD_clinical_trial.utils.xls_cache import read_excel_cached
+
 proj_dir = '/home/sebastin/working/lab_lucac/sebastiN/projects/OCD_clinical_trial'
 code_dir = os.path.join(proj_dir, 'code')
 deriv_dir = os.path.join(proj_dir, 'data/derivatives')
@@ -69,7 +73,7 @@ def get_group(subj):
 
 def create_dataframes(args):
     """ load XLS master file and currate into controls and patients pandas dataframes  """
-    xls = pd.read_excel(os.path.join(proj_dir, 'data', xls_fname), sheet_name=['OCD Patients'])
+    xls = read_excel_cached(os.path.join(proj_dir, 'data', xls_fname), sheet_name=['OCD Patients'])
 
     df_pat = xls['OCD Patients'][['Participant_ID', 'Pre/Post/6mnth', 'Age', 'Gender(F=1,M=2)', 'Handedness(R=1,L=2)', 'YBOCS_Total', 'OBQ_Total', 'HAMA_Total', 'MADRS_Total', 'OCIR_Total', 'Anx_total', 'Dep_Total', 'FSIQ-4_Comp_Score', 'Medications']]
     #df_pat = df_pat[df_pat['Pre/Post/6mnth']=='Pre'][['Participant_ID', 'Age', 'Gender(F=1,M=2)', 'Handedness(R=1,L=2)', 'YBOCS_Total', 'OBQ_Total', 'HAMA_Total', 'MADRS_Total', 'OCIR_Total', 'Anx_total', 'Dep_Total', 'FSIQ-4_Comp_Score', 'Medications']]
@@ -98,26 +102,52 @@ def print_medications(df_pat, args=None):
 
 
 
+def get_dims_weights(cols, dims, match=None, option='sum'):
+    """ Resolves the mapping between columns and dimensions into a sparse (columns x dimensions) weight matrix
+        inputs:
+            cols: list of column names (e.g. YBOCS checklist items)
+            dims: list of dimensions to score
+            match: function (col, dim) -> bool defining membership (default: case-insensitive substring)
+            option: 'sum' gives unit weights, 'mean' normalizes weights by the number of columns in each dimension
+        outputs:
+            W: scipy sparse CSC matrix of shape (len(cols), len(dims))
+    """
+    if match is None:
+        match = lambda col, dim: dim.lower() in col.lower()
+    rows, cols_idx = [], []
+    for j,dim in enumerate(dims):
+        for i,col in enumerate(cols):
+            if match(col, dim):
+                rows.append(i)
+                cols_idx.append(j)
+    W = scipy.sparse.csc_matrix((np.ones(len(rows)), (rows, cols_idx)), shape=(len(cols), len(dims)))
+    if option=='sum':
+        return W
+    elif option=='mean':
+        n_k = np.asarray(W.sum(axis=0)).flatten()
+        n_k[n_k==0] = 1
+        return W @ scipy.sparse.diags(1./n_k)
+    else:
+        raise ValueError("Option must be 'mean' or 'sum' to compute dimension scores from YBOCS checklist")
+
+
+def score_dims(df, W, cols, dims):
+    """ Computes all dimension scores from a single product of the (subjects x columns) checklist block with weight matrix W """
+    X = df[cols].to_numpy(dtype=int)
+    scores = np.asarray(W.T @ X.T).T
+    return df.assign(**dict(zip(dims, scores.T)))
+
+
 def get_obsession_compulsion_scores(df, dims, option='sum'):
     """ Extracts compulsions and obsessions dimensions from YBOCS 
         inputs:
             df: pandas dataframe of YBOCS scores 
             options: defines how to compute scores based on raw values ('sum' or 'mean')
     """
-    for dim in dims:
-        k = np.zeros((len(df),))
-        n_k = 0
-        for col in df.columns.to_list():
-            if (dim.lower() in col.lower()):
-                k += np.array(df[col], dtype=int)
-                n_k += 1
-        if option=='sum':
-            df[dim] = k
-        elif option=='mean':
-            df[dim] = k/n_k
-        else:
-            NameError("Option must be 'mean' or 'sum' to extract obsession/compulsion scores from YBOCS checklist")
-    return df
+    W = get_dims_weights(df.columns.to_list(), dims, option=option)
+    # restrict to the checklist block, i.e. columns belonging to at least one dimension
+    in_block = W.getnnz(axis=1) > 0
+    return score_dims(df, W[in_block], df.columns[in_block].to_list(), dims)
 
 
 def get_5dims_scores(df, checklist_5dims, checklist_13dims, option='sum'):
@@ -128,26 +158,19 @@ def get_5dims_scores(df, checklist_5dims, checklist_13dims, option='sum'):
             cheklist_13dims: list of 13 intermediate dimensions
             options: defines how to compute scores based on raw values ('sum' or 'mean')
     """
-    for k13 in checklist_13dims:
-        for k in df.columns.to_list():
+    # rename checklist columns to their intermediate dimension in a single pass
+    renaming = dict()
+    for k in df.columns.to_list():
+        for k13 in checklist_13dims:
             if k13 in k:
-                df.rename(columns={k:k13}, inplace=True)
-    df.dropna(inplace=True)
+                renaming[k] = k13
+                break
+    df = df.rename(columns=renaming).dropna()
+
+    # 13 -> 5 dimensions mapping, normalized by the number of intermediate dimensions if option is 'mean'
+    W = get_dims_weights(checklist_13dims, checklist_5dims, match=lambda k13, k5: (k13 in k5) or (k5 in k13), option=option)
+    return score_dims(df, W, checklist_13dims, checklist_5dims)
 
-    for k5 in checklist_5dims:
-        dim = np.zeros((len(df),))
-        n_dims = 0
-        for k13 in checklist_13dims:
-            if ((k13 in k5) or (k5 in k13)):
-                dim += np.array(df[k13], dtype=int)
-                n_dims += 1
-        if option=='sum':
-            df[k5] = dim
-        elif option=='mean':
-            df[k5] = dim/n_dims
-        else:
-            print("option must be 'mean' or 'sum' ")
-    return df
 
 def fix_session_entries(df):
     """ fix some entries which have typo/spaces """
@@ -167,7 +190,7 @@ def fix_session_entries(df):
 
 def create_df_ybocs_dims():
     """ extract columns with YBOCS dimensions """
-    xls = pd.read_excel(os.path.join(proj_dir, 'data', 'P2253_Data_Master-File.xlsx'), sheet_name=['OCD Patients', 'Healthy Controls'])
+    xls = read_excel_cached(os.path.join(proj_dir, 'data', xls_fname), sheet_name=['OCD Patients'])
 
     checklist_cols = ['YBOCS SC Aggressive Obsessions', 'YBOCS SC Contamination Obsessions', 'YBOCS SC Sexual Obsessions', 
                     'YBOCS SC Hoarding/Saving Obsessions', 'YBOCS SC Religious Obsessions', 'YBOCS SC Symmetry/Exactness Obsessions', \
@@ -208,8 +231,9 @@ def print_stat_pre_post_between_groups(df, dims):
 
 def plot_ybocs_dims_to_fc(df):
     """ simple scatter plot of FC to YBOCS dimensions relation with printing of statistics (correlation) """
-    with open(os.path.join(proj_dir, 'postprocessing', 'df_voi_corr_detrend_gsr_filtered_scrubFD05_Harrison2009_brainFWHM8mm_bilateral_indStimSite_10mm_diameter.pkl'), 'rb') as f: 
-        df_voi_corr = pickle.load(f)
+    df_voi_corr = load_results('voi_corr', columns=['subj', 'ses', 'group', 'corr'], store_dir=os.path.join(proj_dir, 'postprocessing', 'results_store'),
+                               metric='detrend_gsr_filtered_scrubFD05', seed_type='Harrison2009', fwhm='brainFWHM8mm', stim_radius=5.,
+                               stim_site='individual', seed_side='bilateral')
 
     df_ybocs = df[(df.session=='Pre')][np.concatenate([['subj'],checklist_5dims])]
     df_diff_fc = df_voi_corr[df_voi_corr.ses=='pre-post'][['subj', 'group', 'corr']]
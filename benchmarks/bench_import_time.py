@@ -0,0 +1,82 @@
+# Import-time benchmark of the package entry points
+# Author: Sebastien Naze
+# QIMR Berghofer 2021-2022
+#
+# usage: python benchmarks/bench_import_time.py [--n_repeats 5] [--top 10]
+
+import argparse
+import os
+import subprocess
+import sys
+from time import perf_counter
+
+import numpy as np
+
+modules = ['OCD_clinical_trial',
+           'OCD_clinical_trial.utils.cohort',
+           'OCD_clinical_trial.functional.seed_to_voxel_analysis',
+           'OCD_clinical_trial.graphics.ct_visuals',
+           'OCD_clinical_trial.ybocs_analysis']
+
+scripts = ['OCD_clinical_trial/functional/seed_to_voxel_analysis.py']
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_env():
+    """ make the package importable without installing it """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([root_dir, env.get('PYTHONPATH', '')])
+    return env
+
+
+def time_command(cmd, n_repeats=5):
+    """ median wall time (s) of a command run in a fresh interpreter, None if the command fails """
+    times = []
+    for _ in range(n_repeats):
+        t0 = perf_counter()
+        out = subprocess.run(cmd, cwd=root_dir, env=get_env(), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        times.append(perf_counter()-t0)
+        if out.returncode:
+            print('  failed: {}'.format(out.stderr.decode().strip().splitlines()[-1]))
+            return None
+    return np.median(times)
+
+
+def get_slowest_imports(module, top=10):
+    """ parse `python -X importtime` output and return the slowest dependencies (cumulative ms) of a module """
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import '+module], cwd=root_dir, env=get_env(),
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    rows = []
+    for line in out.stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cum_us, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        if not name.startswith('OCD_clinical_trial'):
+            rows.append((int(cum_us)/1000., name))
+    return sorted(rows, reverse=True)[:top]
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_repeats', type=int, default=5, action='store', help='number of fresh interpreters per measure')
+    parser.add_argument('--top', type=int, default=10, action='store', help='number of slowest imports to display per module')
+    args = parser.parse_args()
+
+    t_python = time_command([sys.executable, '-c', 'pass'], n_repeats=args.n_repeats)
+    print('Interpreter startup: {:.3f}s (subtracted below)'.format(t_python))
+
+    for module in modules:
+        print('import {}'.format(module))
+        t = time_command([sys.executable, '-c', 'import '+module], n_repeats=args.n_repeats)
+        if t is None:
+            continue
+        print('  {:.3f}s'.format(t-t_python))
+        for cum_ms,name in get_slowest_imports(module, top=args.top):
+            print('    {:8.1f}ms  {}'.format(cum_ms, name))
+
+    for script in scripts:
+        t = time_command([sys.executable, script, '--help'], n_repeats=args.n_repeats)
+        if t is not None:
+            print('{} --help\n  {:.3f}s'.format(script, t-t_python))
@@ -0,0 +1,89 @@
+# Parity and peak memory of out-of-core seed-to-voxel correlation (--mem_budget_gb)
+# Author: Sebastien Naze
+# QIMR Berghofer 2021-2022
+#
+# A synthetic BOLD run is saved as .nii.gz and its seed-to-voxel correlation maps are computed
+# in memory (NiftiMasker and NiftiSpheresMasker, as sphere_seed_to_voxel) and by slabs within
+# a memory budget (out_of_core.chunked_seed_to_voxel). The increase of resident memory during the
+# slab run (peak RSS of its profiling stage over the RSS at entry, Linux) is compared to the budget
+# plus the arrays held outside of slabs (output maps, mean image, mask). Maps must be equal up to --atol.
+#
+# usage: python benchmarks/bench_out_of_core.py [--shape 65 77 65] [--n_vols 300] [--mem_budget_gb 0.2]
+#                                               [--precision float32] [--fft_filter]
+
+import argparse
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+from bench_precision import make_bold
+
+
+def get_args(opts):
+    """ arguments of seed_to_voxel_analysis maskers and filters """
+    return argparse.Namespace(brain_smoothing_fwhm=8., precision=opts.precision, fft_filter=opts.fft_filter)
+
+
+def in_memory_corr(bold_fpath, opts):
+    """ correlation maps (x, y, z, seeds) and mask of the whole-run path of sphere_seed_to_voxel """
+    import nibabel as nib
+    from OCD_clinical_trial.functional import seed_to_voxel_analysis as s2v
+
+    args = get_args(opts)
+    voxels_ts, seeds_ts, brain_masker = s2v.get_sphere_seed_timeseries(nib.load(bold_fpath), list(s2v.seed_loc.keys()), args)
+    corr_img = brain_masker.inverse_transform(np.dot(voxels_ts.T, seeds_ts).T/voxels_ts.shape[0])
+    return np.asarray(corr_img.dataobj), np.asarray(brain_masker.mask_img_.dataobj).astype(bool)
+
+
+def out_of_core_corr(bold_fpath, opts):
+    """ correlation maps and mask of the slab path, and increase of resident memory during the run (MB) """
+    from OCD_clinical_trial.functional import seed_to_voxel_analysis as s2v
+    from OCD_clinical_trial.functional.out_of_core import chunked_seed_to_voxel
+    from OCD_clinical_trial.utils import profiling
+
+    args = get_args(opts)
+    clean, dtype = s2v.get_clean(args), s2v.get_dtype(args)
+    with profiling.stage('chunked_seed_to_voxel') as record:
+        corr_img, mask_img = chunked_seed_to_voxel(bold_fpath, list(s2v.seed_loc.values()), seed_radius=3.5,
+                                                   smoothing_fwhm=args.brain_smoothing_fwhm, mem_budget_gb=opts.mem_budget_gb,
+                                                   dtype=dtype, clean=clean, verbose=True)
+    if 'peak_rss_mb' not in record:
+        raise OSError('Peak resident memory of a stage is only measured on Linux')
+    return np.asarray(corr_img.dataobj), np.asarray(mask_img.dataobj).astype(bool), record['peak_rss_mb']-record['start_rss_mb']
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shape', type=int, nargs=3, default=[65, 77, 65], help='synthetic grid shape (2.5mm voxels)')
+    parser.add_argument('--n_vols', type=int, default=300, help='number of volumes')
+    parser.add_argument('--mem_budget_gb', type=float, default=0.2, help='memory budget of slabs (GB)')
+    parser.add_argument('--precision', type=str, default='float32', choices=['float32', 'float64'], help='precision of timeseries and maps')
+    parser.add_argument('--fft_filter', default=False, action='store_true', help='temporal filtering with the shared FilterBank (--fft_filter)')
+    parser.add_argument('--atol', type=float, default=1e-4, help='tolerance on correlation values')
+    opts = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.environ.setdefault('OCD_CT_PROJ_DIR', tmp_dir)
+        os.environ.setdefault('OCD_BASELINE_DIR', tmp_dir)
+        bold_fpath = os.path.join(tmp_dir, 'bold.nii.gz')
+        bold_img = make_bold(opts.shape, opts.n_vols)
+        bold_img.to_filename(bold_fpath)
+        del bold_img
+
+        corr, mask, used_mb = out_of_core_corr(bold_fpath, opts)
+        ref_corr, ref_mask = in_memory_corr(bold_fpath, opts)
+
+    # memory: slabs within the budget, plus output maps, mean image (float64) and mask held for the whole run
+    n_vox = int(np.prod(opts.shape))
+    other_mb = n_vox*(corr.shape[-1]*np.dtype(opts.precision).itemsize + 8 + 1)/1e6
+    budget_mb = opts.mem_budget_gb*1e3
+    print('peak RSS increase {:.0f}MB for a {:.0f}MB slab budget (+{:.0f}MB of maps, mean image and mask): {:.2f}x'.format(
+          used_mb, budget_mb, other_mb, used_mb/(budget_mb+other_mb)))
+
+    # parity with whole-run NiftiMasker processing
+    diff = np.abs(corr - ref_corr)[ref_mask]
+    print('masks equal: {}, max |r_out_of_core - r_in_memory| = {:.2e} (atol {:.0e})'.format(np.array_equal(mask, ref_mask), diff.max(), opts.atol))
+    ok = np.array_equal(mask, ref_mask) and (diff.max() <= opts.atol) and (used_mb <= budget_mb+other_mb)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,317 @@
+# Benchmark of the functional pipeline hot paths on a synthetic project
+# Author: Sebastien Naze
+# QIMR Berghofer 2021-2022
+#
+# A synthetic project (4D BOLD runs, groups file, stim coordinates workbook, label atlas and its
+# atlas config, connectomes) of configurable size is generated in a temporary folder, pointed to by
+# OCD_CT_PROJ_DIR and OCD_BASELINE_DIR. Each benchmark then runs in a fresh interpreter (so that
+# peak memory is its own) in pipeline order, on the outputs of the previous ones:
+#     sphere_seed_to_voxel -> merge_LR_hemis -> compute_voi_corr, mask_imgs
+#     compute_ALFF, build_connectomes, compute_nbs
+# and reports wall time, CPU time, throughput, peak RSS and I/O (stages of utils/profiling.py).
+# Benchmarks whose optional dependencies are missing (e.g. bctpy, OCD_baseline) are skipped.
+#
+# Results are appended to benchmarks/results/bench_pipeline.jsonl with the git commit, host and
+# benchmark configuration; --compare reports the ratios to the last run of another commit with the
+# same host and configuration, and flags regressions.
+#
+# usage: python benchmarks/bench_pipeline.py [--n_subjs 6] [--shape 40 48 40] [--n_vols 200] [--benchmarks ...]
+#                                             [--precision float32] [--fft_filter] [--compare [--fail_on_regression]]
+
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+from bench_precision import make_bold
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+results_fpath = os.path.join(root_dir, 'benchmarks', 'results', 'bench_pipeline.jsonl')
+
+benchmarks = ['sphere_seed_to_voxel', 'merge_LR_hemis', 'compute_voi_corr', 'mask_imgs', 'compute_ALFF', 'build_connectomes', 'compute_nbs']
+
+metric = 'detrend_gsr_filtered_scrubFD05'
+alff_desc = 'detrend_gsr_smooth-6mm'
+seses = ['ses-pre', 'ses-post']
+atlas = 'synth'
+img_space = 'MNI152NLin2009cAsym'
+
+# options defining a benchmark configuration (results are only compared within a configuration)
+config_keys = ['n_subjs', 'shape', 'n_vols', 'n_parcels', 'n_perm', 'stim_radii', 'precision', 'fft_filter', 'mem_budget_gb']
+
+
+def get_subjs(n_subjs):
+    """ synthetic patients (ID format of the stim coordinates workbook) """
+    return ['sub-patient{:02d}'.format(i+1) for i in range(n_subjs)]
+
+
+def get_bold_fpath(proj_dir, subj, ses, desc):
+    return os.path.join(proj_dir, 'data', 'derivatives', 'post-fmriprep-fix', subj, ses, 'func',
+                        '_'.join([subj, ses, 'task-rest', 'space-'+img_space, 'desc-'+desc+'.nii.gz']))
+
+
+def make_atlas(ref_img, n_parcels, seed=0):
+    """ label image of n_parcels Voronoi parcels of random centers in ref_img's grid """
+    import nibabel as nib
+    from scipy.spatial import cKDTree
+
+    rng = np.random.default_rng(seed)
+    shape = ref_img.shape[:3]
+    ijk = np.indices(shape).reshape(3, -1).T
+    centers = ijk[rng.choice(len(ijk), n_parcels, replace=False)]
+    labels = cKDTree(centers).query(ijk)[1] + 1
+    return nib.Nifti1Image(labels.reshape(shape).astype(np.int16), ref_img.affine)
+
+
+def make_project(root, n_subjs=6, shape=(40,48,40), n_vols=200, n_parcels=100, seed=0):
+    """ synthetic project in root/proj and baseline project in root/baseline, returns their paths """
+    import h5py
+    import nibabel as nib
+    import pandas as pd
+
+    proj_dir, baseline_dir = os.path.join(root, 'proj'), os.path.join(root, 'baseline')
+    rng = np.random.default_rng(seed)
+    subjs = get_subjs(n_subjs)
+
+    # cohort: groups and stim coordinates (right frontal sites)
+    os.makedirs(os.path.join(proj_dir, 'data'), exist_ok=True)
+    groups = ['group1' if i%2==0 else 'group2' for i in range(n_subjs)]
+    pd.DataFrame({'subj':subjs, 'group':groups}).to_csv(os.path.join(proj_dir, 'data', 'groups.txt'), sep=' ', index=False)
+    xyz = np.array([30., 40., 20.]) + rng.normal(0, 4, (n_subjs, 3))
+    pd.DataFrame({'P ID':['P'+s[-2:] for s in subjs], 'x':xyz[:,0], 'y':xyz[:,1], 'z':xyz[:,2]}) \
+      .to_excel(os.path.join(proj_dir, 'data', 'MNI_coordinates_FINAL.xlsx'), index=False)
+
+    # BOLD runs (the ALFF input is the same run)
+    for i,(subj,ses) in enumerate([(subj,ses) for subj in subjs for ses in seses]):
+        bold_img = make_bold(shape, n_vols, seed=seed+i)
+        fpath = get_bold_fpath(proj_dir, subj, ses, metric)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        nib.save(bold_img, fpath)
+        os.symlink(os.path.basename(fpath), get_bold_fpath(proj_dir, subj, ses, alff_desc))
+
+    # atlas in the baseline project utils folder
+    os.makedirs(os.path.join(baseline_dir, 'utils'), exist_ok=True)
+    nib.save(make_atlas(bold_img, n_parcels, seed=seed), os.path.join(baseline_dir, 'utils', atlas+'_atlas.nii.gz'))
+    with open(os.path.join(baseline_dir, 'utils', 'atlas_config.json'), 'w') as f:
+        json.dump({atlas: {'file':atlas+'_atlas.nii.gz', 'node_ids':list(range(1, n_parcels+1)),
+                           'node_names':['parcel{}'.format(i) for i in range(1, n_parcels+1)]}}, f)
+
+    # connectomes (NBS inputs), at the location of connectome.get_fc_fpath
+    for subj,ses in [(subj,ses) for subj in subjs for ses in seses]:
+        ts = rng.standard_normal((n_vols, n_parcels)) + 0.3*rng.standard_normal((n_vols, 1))
+        fpath = os.path.join(root, 'fc', 'post-fmriprep-fix', subj, ses, 'fc',
+                             '{}_{}_task-rest_atlas-{}_desc-corr-detrend_filtered_scrub_gsr.h5'.format(subj, ses, atlas))
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with h5py.File(fpath, 'w') as f:
+            f.create_dataset('fc', data=np.corrcoef(ts.T))
+    return proj_dir, baseline_dir
+
+
+def get_pipeline_args(opts):
+    """ arguments of seed_to_voxel_analysis functions for the synthetic project """
+    from OCD_clinical_trial.utils.config import proj_dir
+
+    return argparse.Namespace(seed_type='Harrison2009', atlases=['Harrison2009'], metrics=[metric], seses=seses,
+                              brain_smoothing_fwhm=8., fwhm='brainFWHM8mm', unilateral_seed=False,
+                              in_dir=os.path.join(proj_dir, 'postprocessing/SPM/input_imgs/', 'Harrison2009', 'seed_not_smoothed'),
+                              stim_radii=opts.stim_radii, stim_radius=opts.stim_radii[0], use_group_avg_stim_site=False,
+                              precision=opts.precision, fft_filter=opts.fft_filter, mem_budget_gb=opts.mem_budget_gb,
+                              n_jobs=1, verbose=False, use_gm_mask=True, use_fspt_mask=False, use_cortical_mask=False,
+                              use_frontal_mask=False, use_seed_specific_mask=False,
+                              nbs_atlas=atlas, fc_deriv_dir=os.path.join(opts.root, 'fc'), nbs_session=False,
+                              nbs_thresh=3., nbs_paired=False, nbs_tail='both', n_perm=opts.n_perm)
+
+
+def run_benchmark(name, opts):
+    """ run a benchmark in this process, returns (number of items processed, unit) """
+    import pandas as pd
+    from OCD_clinical_trial.functional import seed_to_voxel_analysis as s2v
+
+    args = get_pipeline_args(opts)
+    subjs = get_subjs(opts.n_subjs)
+    if name=='sphere_seed_to_voxel':
+        for subj in subjs:
+            for ses in seses:
+                s2v.sphere_seed_to_voxel(subj, ses, list(s2v.seed_loc.keys()), args.metrics, args.atlases, args)
+        return len(subjs)*len(seses), 'runs'
+    elif name=='merge_LR_hemis':
+        in_fnames = s2v.merge_LR_hemis(pd.Series(subjs), ['Acc'], seses, args.metrics, args=args)
+        return sum(len(v) for v in in_fnames.values()), 'maps'
+    elif name=='compute_voi_corr':
+        df = s2v.compute_voi_corr(pd.Series(subjs), seeds=['Acc'], args=args)
+        return int((df['ses']!='pre-post').sum()), 'rows'
+    elif name=='mask_imgs':
+        flist = np.array(sorted(get_merged_fpaths(args)))
+        s2v.mask_imgs(flist, masks=[], seed='Acc', args=args)
+        return len(flist), 'maps'
+    elif name=='compute_ALFF':
+        rows = [row for subj in subjs for row in s2v.compute_ALFF(subj, args)]
+        return len(rows), 'rows'
+    elif name=='build_connectomes':
+        from OCD_clinical_trial.functional.connectome import build_connectomes
+        conn_args = argparse.Namespace(metric=metric, atlases=[atlas], kind='corr', fisher_z=False, save_ts=False,
+                                       desc='detrend_filtered_scrub_gsr', fc_deriv_dir=os.path.join(opts.root, 'fc_bench'))
+        for subj in subjs:
+            for ses in seses:
+                build_connectomes(subj, ses, conn_args)
+        return len(subjs)*len(seses), 'runs'
+    elif name=='compute_nbs':
+        s2v.compute_nbs(subjs, args)
+        return opts.n_perm, 'permutations'
+    raise ValueError("Unknown benchmark {}".format(name))
+
+
+def get_merged_fpaths(args):
+    """ correlation maps written by merge_LR_hemis """
+    fpaths = []
+    for dirpath,_,fnames in os.walk(os.path.join(args.in_dir, metric)):
+        fpaths += [os.path.join(dirpath, fname) for fname in fnames if fname.endswith('.nii.gz')]
+    return fpaths
+
+
+def run_one(opts):
+    """ child process: run one benchmark within a profiling stage, print its record as JSON """
+    from OCD_clinical_trial.utils import profiling
+
+    profiling.configure(None)
+    import OCD_clinical_trial.functional.seed_to_voxel_analysis # imports are not benchmarked
+    result = {'name':opts.run_one, 'status':'ok'}
+    try:
+        with profiling.stage('bench') as record:
+            n_items, unit = run_benchmark(opts.run_one, opts)
+        peak = record['peak_rss_mb'] if 'peak_rss_mb' in record else record['process_peak_rss_mb']
+        result.update(dict((k, record.get(k)) for k in ['wall', 'cpu', 'read_mb', 'write_mb']))
+        result.update({'peak_rss_mb':peak, 'n_items':n_items, 'unit':unit, 'throughput':n_items/record['wall'],
+                       'rss_increase_mb':peak-record['start_rss_mb'] if 'start_rss_mb' in record else None})
+    except ImportError as e:
+        result['status'] = 'skipped: {}'.format(e)
+    except Exception as e:
+        result['status'] = 'error: {}: {}'.format(type(e).__name__, e)
+    print('\n'+json.dumps(result))
+
+
+def spawn(name, opts, proj_dir, baseline_dir):
+    """ run a benchmark in a fresh interpreter, returns its result """
+    env = dict(os.environ, OCD_CT_PROJ_DIR=proj_dir, OCD_BASELINE_DIR=baseline_dir)
+    env['PYTHONPATH'] = os.pathsep.join([root_dir, env.get('PYTHONPATH', '')])
+    env.pop('OCD_CT_PROFILE_LOG', None)
+    cmd = [sys.executable, os.path.abspath(__file__), '--run_one', name, '--root', opts.root]+sys.argv[1:]
+    out = subprocess.run(cmd, cwd=root_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    lines = out.stdout.strip().splitlines()
+    if out.returncode or not lines:
+        return {'name':name, 'status':'error: '+(out.stderr.strip().splitlines() or ['no output'])[-1]}
+    return json.loads(lines[-1])
+
+
+def get_git_info():
+    """ commit and dirty state of the working tree (None outside a git repository) """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root_dir, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root_dir, capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def load_history(fpath=results_fpath):
+    """ previous benchmark records """
+    if not os.path.exists(fpath):
+        return []
+    with open(fpath, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(record, history, threshold=0.2):
+    """ ratios of wall times to the last run of another commit with the same host and configuration,
+        returns the names of benchmarks slower by more than threshold """
+    prev = [r for r in history if (r['host']==record['host']) and (r['config']==record['config']) and (r['commit']!=record['commit'])]
+    if not prev:
+        print('No previous run of another commit with this configuration on this host')
+        return []
+    prev = prev[-1]
+    print('\nCompared to {} ({}):'.format(prev['commit'], prev['date']))
+    regressions = []
+    for name,res in record['results'].items():
+        old = prev['results'].get(name, {})
+        if (res['status']!='ok') or (old.get('status')!='ok'):
+            continue
+        ratio = res['wall']/old['wall']
+        flag = ''
+        if ratio > 1+threshold:
+            regressions.append(name)
+            flag = '  <-- regression'
+        print('  {:22s} {:8.2f}s -> {:8.2f}s  (x{:.2f}){}'.format(name, old['wall'], res['wall'], ratio, flag))
+    return regressions
+
+
+def print_results(results):
+    print('\n{:22s} {:>9s} {:>9s} {:>16s} {:>10s} {:>10s} {:>9s} {:>9s}'.format(
+          'benchmark', 'wall (s)', 'cpu (s)', 'throughput', 'peak MB', '+RSS MB', 'read MB', 'write MB'))
+    for name,res in results.items():
+        if res['status']!='ok':
+            print('{:22s} {}'.format(name, res['status']))
+            continue
+        print('{:22s} {:9.2f} {:9.2f} {:>16s} {:10.0f} {:10.0f} {:9.1f} {:9.1f}'.format(
+              name, res['wall'], res['cpu'], '{:.2f} {}/s'.format(res['throughput'], res['unit']), res['peak_rss_mb'],
+              *[np.nan if res.get(k) is None else res[k] for k in ['rss_increase_mb', 'read_mb', 'write_mb']]))
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmarks', type=str, nargs='+', default=benchmarks, choices=benchmarks, help='benchmarks to run (in pipeline order, later ones use outputs of earlier ones)')
+    parser.add_argument('--n_subjs', type=int, default=6, help='number of synthetic subjects (2 sessions each)')
+    parser.add_argument('--shape', type=int, nargs=3, default=[40, 48, 40], help='synthetic grid shape (2.5mm voxels)')
+    parser.add_argument('--n_vols', type=int, default=200, help='number of volumes per run')
+    parser.add_argument('--n_parcels', type=int, default=100, help='number of parcels of the synthetic atlas')
+    parser.add_argument('--n_perm', type=int, default=100, help='number of NBS permutations')
+    parser.add_argument('--stim_radii', type=float, nargs='+', default=[2.5, 5.], help='stim site radii of VOI correlations and ALFF')
+    parser.add_argument('--precision', type=str, default='float64', choices=['float64', 'float32'], help='numerical precision (--precision of seed_to_voxel_analysis)')
+    parser.add_argument('--fft_filter', default=False, action='store_true', help='band-pass with the shared FFT filter bank (--fft_filter)')
+    parser.add_argument('--mem_budget_gb', type=float, default=None, help='out-of-core seed-to-voxel correlation within this budget (--mem_budget_gb)')
+    parser.add_argument('--root', type=str, default=None, help='folder of the synthetic project (default: temporary folder, removed afterwards)')
+    parser.add_argument('--results', type=str, default=results_fpath, help='JSONL file of benchmark records')
+    parser.add_argument('--no_save', default=False, action='store_true', help='do not append results to the records')
+    parser.add_argument('--compare', default=False, action='store_true', help='compare with the last run of another commit')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative slowdown reported as a regression')
+    parser.add_argument('--fail_on_regression', default=False, action='store_true', help='exit with an error if a regression is found')
+    parser.add_argument('--run_one', type=str, default=None, help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+
+    if opts.run_one is not None:
+        run_one(opts)
+        sys.exit(0)
+
+    keep_root = opts.root is not None
+    if not keep_root:
+        opts.root = tempfile.mkdtemp(prefix='ocd_bench_')
+    try:
+        print('Generating synthetic project in '+opts.root)
+        proj_dir, baseline_dir = make_project(opts.root, n_subjs=opts.n_subjs, shape=opts.shape, n_vols=opts.n_vols, n_parcels=opts.n_parcels)
+        results = dict()
+        for name in [b for b in benchmarks if b in opts.benchmarks]:
+            print('Running '+name)
+            results[name] = spawn(name, opts, proj_dir, baseline_dir)
+    finally:
+        if not keep_root:
+            shutil.rmtree(opts.root, ignore_errors=True)
+    print_results(results)
+
+    commit, dirty = get_git_info()
+    record = {'commit':commit, 'dirty':dirty, 'date':datetime.now().isoformat(timespec='seconds'), 'host':platform.node(),
+              'python':platform.python_version(), 'config':dict((k, getattr(opts, k)) for k in config_keys), 'results':results}
+    regressions = compare(record, load_history(opts.results), threshold=opts.threshold) if opts.compare else []
+    if not opts.no_save:
+        os.makedirs(os.path.dirname(os.path.abspath(opts.results)), exist_ok=True)
+        with open(opts.results, 'a') as f:
+            f.write(json.dumps(record)+'\n')
+        print('Results appended to '+opts.results)
+    if regressions and opts.fail_on_regression:
+        print('Regressions: '+', '.join(regressions))
+        sys.exit(1)
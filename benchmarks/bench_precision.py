@@ -0,0 +1,234 @@
+# Float32 vs float64 benchmark of the seed-to-voxel pipeline (--precision)
+# Author: Sebastien Naze
+# QIMR Berghofer 2021-2022
+#
+# Runs the functions of seed_to_voxel_analysis.py affected by --precision on the synthetic project
+# of bench_pipeline.py, once with precision='float64' and once with precision='float32', each in a
+# fresh interpreter:
+#     sphere_seed_to_voxel, seed_to_voxel -> merge_LR_hemis -> compute_voi_corr, mask_imgs
+# The NIfTIs written by both runs (correlation maps, merged maps) and the VOI rows and masked maps
+# they return are compared within --atol, and timings of each function are reported, along with
+# the seeds x voxels correlation product (BLAS) in both precisions.
+# Functions whose optional dependencies are missing (e.g. OCD_baseline) are skipped.
+#
+# usage: python benchmarks/bench_precision.py [--n_subjs 2] [--shape 40 48 40] [--n_vols 200] [--atol 1e-4]
+#                                              [--fft_filter]
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+import nibabel as nib
+import numpy as np
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+precisions = ['float64', 'float32']
+functions = ['sphere_seed_to_voxel', 'seed_to_voxel', 'merge_LR_hemis', 'compute_voi_corr', 'mask_imgs']
+
+# outputs returned (not written) by functions, saved in the postprocessing folder of each run
+outputs_dir = 'precision_bench'
+
+
+def make_bold(shape, n_vols, seed=0):
+    """ synthetic BOLD run (2.5mm grid centered on the MNI origin) with a shared low-frequency component """
+    rng = np.random.default_rng(seed)
+    affine = np.diag([2.5,2.5,2.5,1.])
+    affine[:3,3] = -2.5*(np.array(shape)-1)/2.
+    common = np.cumsum(rng.standard_normal(n_vols))
+    data = rng.standard_normal(tuple(shape)+(n_vols,)).astype(np.float32) + 0.3*common.astype(np.float32)
+    return nib.Nifti1Image(data, affine)
+
+
+def run_function(name, args, subjs):
+    """ run a function of seed_to_voxel_analysis on the synthetic project, with the precision of args """
+    import pandas as pd
+    from OCD_clinical_trial.functional import seed_to_voxel_analysis as s2v
+    from OCD_clinical_trial.utils.config import proj_dir
+    from bench_pipeline import atlas, get_merged_fpaths, seses
+
+    out_dir = os.path.join(proj_dir, 'postprocessing', outputs_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    if name=='sphere_seed_to_voxel':
+        for subj in subjs:
+            for ses in seses:
+                s2v.sphere_seed_to_voxel(subj, ses, list(s2v.seed_loc.keys()), args.metrics, args.atlases, args)
+    elif name=='seed_to_voxel':
+        for subj in subjs:
+            for ses in seses:
+                s2v.seed_to_voxel(subj, ses, ['parcel7'], args.metrics, [atlas], args)
+    elif name=='merge_LR_hemis':
+        s2v.merge_LR_hemis(pd.Series(subjs), ['Acc'], seses, args.metrics, args=args)
+    elif name=='compute_voi_corr':
+        df = s2v.compute_voi_corr(pd.Series(subjs), seeds=['Acc'], args=args)
+        df.drop(columns='input_sig').to_csv(os.path.join(out_dir, 'voi_corr.csv'), index=False)
+    elif name=='mask_imgs':
+        flist = np.array(sorted(get_merged_fpaths(args)))
+        imgs = s2v.mask_imgs(flist, masks=[], seed='Acc', args=args)[0]
+        np.save(os.path.join(out_dir, 'mask_imgs.npy'), np.stack([np.asarray(img.dataobj) for img in imgs]))
+    else:
+        raise ValueError("Unknown function {}".format(name))
+
+
+def run_precision(opts):
+    """ child process: run all functions with opts.run_precision, print their status and timings as JSON """
+    from bench_pipeline import get_pipeline_args, get_subjs
+
+    opts.precision, opts.mem_budget_gb = opts.run_precision, None
+    args = get_pipeline_args(opts)
+    results = dict()
+    for name in functions:
+        t0 = perf_counter()
+        try:
+            run_function(name, args, get_subjs(opts.n_subjs))
+            results[name] = {'status':'ok', 'wall':perf_counter()-t0}
+        except ImportError as e:
+            results[name] = {'status':'skipped: {}'.format(e)}
+        except Exception as e:
+            results[name] = {'status':'error: {}: {}'.format(type(e).__name__, e)}
+    print('\n'+json.dumps(results))
+
+
+def spawn(precision, opts, proj_dir, baseline_dir):
+    """ run all functions in a fresh interpreter with a precision, returns their results """
+    env = dict(os.environ, OCD_CT_PROJ_DIR=proj_dir, OCD_BASELINE_DIR=baseline_dir)
+    env['PYTHONPATH'] = os.pathsep.join([root_dir, os.path.join(root_dir, 'benchmarks'), env.get('PYTHONPATH', '')])
+    env.pop('OCD_CT_PROFILE_LOG', None)
+    cmd = [sys.executable, os.path.abspath(__file__), '--run_precision', precision, '--root', opts.root]+sys.argv[1:]
+    out = subprocess.run(cmd, cwd=root_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    lines = out.stdout.strip().splitlines()
+    if out.returncode or not lines:
+        raise RuntimeError('{} run failed: {}'.format(precision, (out.stderr.strip().splitlines() or ['no output'])[-1]))
+    return json.loads(lines[-1])
+
+
+def get_nifti_fpaths(out_dir):
+    """ NIfTIs written in a postprocessing folder, relative to it """
+    fpaths = []
+    for dirpath,_,fnames in os.walk(out_dir):
+        fpaths += [os.path.relpath(os.path.join(dirpath, fname), out_dir) for fname in fnames if fname.endswith(('.nii', '.nii.gz'))]
+    return sorted(fpaths)
+
+
+def max_diff(x64, x32):
+    """ max absolute difference of two arrays (inf if their NaNs differ) """
+    x64, x32 = np.asarray(x64, dtype=float), np.asarray(x32, dtype=float)
+    if not np.array_equal(np.isnan(x64), np.isnan(x32)):
+        return np.inf
+    diff = np.abs(x64 - x32)[~np.isnan(x64)]
+    return diff.max() if diff.size else 0.
+
+
+def compare_outputs(dirs):
+    """ max absolute differences between float64 and float32 outputs, per output kind, and on-disk dtypes of NIfTIs """
+    import pandas as pd
+
+    diffs, dtypes = dict(), dict()
+    fpaths = get_nifti_fpaths(dirs['float64'])
+    missing = sorted(set(fpaths) ^ set(get_nifti_fpaths(dirs['float32'])))
+    if missing:
+        raise RuntimeError('NIfTIs written in only one precision: '+', '.join(missing))
+    for fpath in fpaths:
+        imgs = dict((p, nib.load(os.path.join(dirs[p], fpath))) for p in precisions)
+        kind = 'merged maps' if fpath.startswith('SPM') else ('atlas seed maps' if '_synth_' in fpath else 'sphere seed maps')
+        diff = max_diff(imgs['float64'].get_fdata(), imgs['float32'].get_fdata())
+        diffs[kind] = max(diffs.get(kind, 0.), diff)
+        dtypes.setdefault(kind, dict((p, str(img.get_data_dtype())) for p,img in imgs.items()))
+
+    fpaths = dict((p, os.path.join(dirs[p], outputs_dir, 'voi_corr.csv')) for p in precisions)
+    if all(os.path.exists(f) for f in fpaths.values()):
+        dfs = dict((p, pd.read_csv(f)) for p,f in fpaths.items())
+        keys = [col for col in dfs['float64'].columns if col!='corr']
+        df = dfs['float64'].merge(dfs['float32'], on=keys, suffixes=('64', '32'), validate='one_to_one')
+        if len(df)!=len(dfs['float64']):
+            raise RuntimeError('VOI rows differ between precisions')
+        diffs['VOI rows'] = max_diff(df['corr64'], df['corr32'])
+    fpaths = dict((p, os.path.join(dirs[p], outputs_dir, 'mask_imgs.npy')) for p in precisions)
+    if all(os.path.exists(f) for f in fpaths.values()):
+        diffs['masked maps'] = max_diff(np.load(fpaths['float64']), np.load(fpaths['float32']))
+    return diffs, dtypes
+
+
+def bench_gemm(n_vox, n_vols, n_seeds, n_repeats=5, seed=0):
+    """ median time of the seed x voxels correlation product (BLAS) in both precisions """
+    rng = np.random.default_rng(seed)
+    X = rng.standard_normal((n_vols, n_vox))
+    S = rng.standard_normal((n_vols, n_seeds))
+    times = dict()
+    for dtype in [np.float64, np.float32]:
+        Xd, Sd = X.astype(dtype), S.astype(dtype)
+        ts = []
+        for _ in range(n_repeats):
+            t0 = perf_counter()
+            Xd.T @ Sd
+            ts.append(perf_counter()-t0)
+        times[np.dtype(dtype).name] = np.median(ts)
+    return times
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_subjs', type=int, default=2, help='number of synthetic subjects (2 sessions each)')
+    parser.add_argument('--shape', type=int, nargs=3, default=[40, 48, 40], help='synthetic grid shape (2.5mm voxels)')
+    parser.add_argument('--n_vols', type=int, default=200, help='number of volumes per run')
+    parser.add_argument('--n_parcels', type=int, default=100, help='number of parcels of the synthetic atlas')
+    parser.add_argument('--stim_radii', type=float, nargs='+', default=[2.5, 5.], help='stim site radii of VOI correlations')
+    parser.add_argument('--fft_filter', default=False, action='store_true', help='band-pass with the shared FFT filter bank (--fft_filter)')
+    parser.add_argument('--n_seeds', type=int, default=16, help='number of seeds in the GEMM benchmark')
+    parser.add_argument('--atol', type=float, default=1e-4, help='tolerance on correlation values')
+    parser.add_argument('--root', type=str, default=None, help='folder of the synthetic project (default: temporary folder, removed afterwards)')
+    parser.add_argument('--run_precision', type=str, default=None, help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+    opts.n_perm = 0
+
+    if opts.run_precision is not None:
+        run_precision(opts)
+        sys.exit(0)
+
+    from bench_pipeline import make_project
+
+    keep_root = opts.root is not None
+    if not keep_root:
+        opts.root = tempfile.mkdtemp(prefix='ocd_bench_precision_')
+    try:
+        print('Generating synthetic project in '+opts.root)
+        proj_dir, baseline_dir = make_project(opts.root, n_subjs=opts.n_subjs, shape=opts.shape, n_vols=opts.n_vols, n_parcels=opts.n_parcels)
+        results, dirs = dict(), dict()
+        for precision in precisions:
+            print('Running '+precision)
+            results[precision] = spawn(precision, opts, proj_dir, baseline_dir)
+            dirs[precision] = os.path.join(opts.root, 'postprocessing_'+precision)
+            os.replace(os.path.join(proj_dir, 'postprocessing'), dirs[precision])
+        diffs, dtypes = compare_outputs(dirs)
+    finally:
+        if not keep_root:
+            shutil.rmtree(opts.root, ignore_errors=True)
+
+    print('\n{:22s} {:>12s} {:>12s}'.format('function', *['{} (s)'.format(p) for p in precisions]))
+    for name in functions:
+        res = [results[p][name] for p in precisions]
+        if any(r['status']!='ok' for r in res):
+            print('{:22s} {}'.format(name, ' / '.join(r['status'] for r in res)))
+            continue
+        print('{:22s} {:12.2f} {:12.2f}'.format(name, *[r['wall'] for r in res]))
+
+    print('\n{:18s} {:>14s} {:>16s}'.format('output', 'max |x64-x32|', 'NIfTI dtypes'))
+    for kind,diff in diffs.items():
+        print('{:18s} {:14.2e} {:>16s}'.format(kind, diff, '/'.join(dtypes[kind].values()) if kind in dtypes else ''))
+
+    n_vox = int(np.prod(opts.shape))
+    times = bench_gemm(n_vox, opts.n_vols, opts.n_seeds)
+    print('\nseeds x voxels GEMM ({} voxels, {} seeds): float64 {:.4f}s, float32 {:.4f}s (x{:.2f})'.format(
+          n_vox, opts.n_seeds, times['float64'], times['float32'], times['float64']/times['float32']))
+
+    failed = [name for name in functions if any(results[p][name]['status'].startswith('error') for p in precisions)]
+    if failed:
+        print('Errors in: '+', '.join(failed))
+    if failed or (not diffs) or any(diff > opts.atol for diff in diffs.values()):
+        print('Float32 results differ from float64 beyond tolerance!' if diffs else 'No outputs to compare!')
+        sys.exit(1)
@@ -7,11 +7,12 @@ reqs = ["bctpy", \
         "h5py", \
         "matplotlib", \
         "nibabel", \
-        "nilearn", \
+        "nilearn>=0.8,<0.11", \
         "nltools", \
         "numpy", \
         "pandas", \
         "pingouin", \
+        "pyarrow", \
         "scikit-learn", \
         "scipy", \
         "seaborn", \